@@ -0,0 +1,46 @@
+# Event loop selection.  Every entry point goes through run() so the whole process, including sharded workers, uses
+# the same loop implementation.  Components only ever use the running loop (asyncio.get_running_loop()).
+import asyncio
+from typing import Callable, Coroutine
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+LOOP_ASYNCIO = 'asyncio'
+LOOP_UVLOOP = 'uvloop'
+LOOP_AUTO = 'auto'  # uvloop when it is installed, else the stdlib loop
+
+
+def available_loops() -> list[str]:
+    return [LOOP_ASYNCIO, LOOP_UVLOOP] if uvloop else [LOOP_ASYNCIO]
+
+
+def resolve_loop(name: str = LOOP_AUTO) -> str:
+    if name == LOOP_AUTO:
+        return LOOP_UVLOOP if uvloop else LOOP_ASYNCIO
+    if name not in available_loops():
+        raise ValueError(f'Event loop not available: {name}')
+    return name
+
+
+def loop_factory(name: str = LOOP_AUTO) -> Callable[[], asyncio.AbstractEventLoop]:
+    if resolve_loop(name) == LOOP_UVLOOP:
+        return uvloop.new_event_loop
+    return asyncio.new_event_loop
+
+
+def install_loop_policy(name: str = LOOP_AUTO) -> str:
+    """ Makes new event loops use the chosen implementation, returns the name of the one installed """
+    name = resolve_loop(name)
+    if name == LOOP_UVLOOP:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    else:
+        asyncio.set_event_loop_policy(asyncio.DefaultEventLoopPolicy())
+    return name
+
+
+def run(main: Coroutine, loop: str = LOOP_AUTO):
+    install_loop_policy(loop)
+    return asyncio.run(main)
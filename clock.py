@@ -0,0 +1,16 @@
+# Time source for the scheduling code.  Request expiry, choking, dialing backoff, rate meters & bandwidth limits all
+# read the time through now(), so a simulator can run them against a virtual clock instead of the wall clock.
+import time
+from typing import Callable
+
+_source: Callable[[], float] = time.time
+
+
+def now() -> float:
+    return _source()
+
+
+def set_source(source: Callable[[], float] = time.time):
+    """ Makes now() return source(), back to the wall clock when called without arguments """
+    global _source
+    _source = source
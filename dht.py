@@ -0,0 +1,410 @@
+# Kademlia DHT node (BEP 5) used to find peers when the tracker is unavailable.
+# Speaks KRPC (bencoded dicts) over a single UDP socket.
+import asyncio
+import hashlib
+import os
+import random
+import socket
+import struct
+from typing import Optional
+
+import clock
+import event_log
+from utils import bencode, bdecode, BDecodeError
+
+K = 8  # Bucket size & number of nodes a lookup converges on
+ALPHA = 3  # Queries in flight per lookup round
+QUERY_TIMEOUT = 2
+MAX_FAILURES = 2  # Nodes failing this many queries in a row can be replaced
+TOKEN_ROTATION = 5 * 60  # Seconds a token secret is used for, tokens from the previous secret are still accepted
+PEER_TTL = 30 * 60  # Announced peers are forgotten after this
+MAX_PEERS_PER_HASH = 200
+MAX_INFO_HASHES = 2000
+MAX_VALUES = 50  # Max peers returned per get_peers response
+BUCKET_REFRESH = 15 * 60
+ANNOUNCE_INTERVAL = 15 * 60
+
+# Some well known nodes used when there is no saved routing table
+BOOTSTRAP_NODES = [('router.bittorrent.com', 6881), ('dht.transmissionbt.com', 6881)]
+
+ID_SPACE = 2 ** 160
+
+
+class DHTError(Exception):
+    pass
+
+
+def _id_int(node_id: bytes) -> int:
+    return int.from_bytes(node_id, 'big')
+
+
+def distance(a: bytes, b: bytes) -> int:
+    return _id_int(a) ^ _id_int(b)
+
+
+def encode_nodes(nodes: list['NodeInfo']) -> bytes:
+    # Compact node info: 20 byte id, 4 byte ip, 2 byte port
+    return b''.join(node.id + socket.inet_aton(node.addr[0]) + struct.pack("!H", node.addr[1]) for node in nodes)
+
+
+def decode_nodes(data: bytes) -> list['NodeInfo']:
+    nodes = []
+    for i in range(0, len(data) - len(data) % 26, 26):
+        node_id, ip, (port,) = data[i:i + 20], socket.inet_ntoa(data[i + 20:i + 24]), struct.unpack("!H", data[i + 24:i + 26])
+        if port:
+            nodes.append(NodeInfo(node_id, (ip, port)))
+    return nodes
+
+
+class NodeInfo:
+    id: bytes = None
+    addr: tuple[str, int] = None
+    last_seen: float = 0.0
+    failures: int = 0
+
+    def __init__(self, node_id: bytes, addr: tuple[str, int]):
+        self.id = node_id
+        self.addr = addr
+
+
+class KBucket:
+    lo: int = 0
+    hi: int = 0  # Covers ids in [lo, hi)
+    nodes: list[NodeInfo] = []  # Least recently seen first
+    last_changed: float = 0.0
+
+    def __init__(self, lo: int, hi: int):
+        self.lo = lo
+        self.hi = hi
+        self.nodes = []
+        self.last_changed = clock.now()
+
+    def covers(self, id_int: int) -> bool:
+        return self.lo <= id_int < self.hi
+
+
+class RoutingTable:
+    own_id: bytes = None
+    buckets: list[KBucket] = []
+
+    def __init__(self, own_id: bytes):
+        self.own_id = own_id
+        self.buckets = [KBucket(0, ID_SPACE)]
+
+    def _bucket(self, node_id: bytes) -> KBucket:
+        id_int = _id_int(node_id)
+        for bucket in self.buckets:
+            if bucket.covers(id_int):
+                return bucket
+
+    def _split(self, bucket: KBucket):
+        mid = (bucket.lo + bucket.hi) // 2
+        low, high = KBucket(bucket.lo, mid), KBucket(mid, bucket.hi)
+        for node in bucket.nodes:
+            (low if low.covers(_id_int(node.id)) else high).nodes.append(node)
+        pos = self.buckets.index(bucket)
+        self.buckets[pos:pos + 1] = [low, high]
+
+    def add(self, node: NodeInfo):
+        if node.id == self.own_id or len(node.id) != 20:
+            return
+        node.last_seen = clock.now()
+        node.failures = 0
+
+        bucket = self._bucket(node.id)
+        for i, existing in enumerate(bucket.nodes):
+            if existing.id == node.id:
+                # Move to the most recently seen end
+                bucket.nodes.pop(i)
+                bucket.nodes.append(node)
+                return
+
+        if len(bucket.nodes) < K:
+            bucket.nodes.append(node)
+            bucket.last_changed = node.last_seen
+        elif bucket.covers(_id_int(self.own_id)) and bucket.hi - bucket.lo > K:
+            # Only the bucket containing our own id is split
+            self._split(bucket)
+            self.add(node)
+        else:
+            # Full, replace a node which stopped responding.  Good nodes are never replaced.
+            for i, existing in enumerate(bucket.nodes):
+                if existing.failures >= MAX_FAILURES:
+                    bucket.nodes.pop(i)
+                    bucket.nodes.append(node)
+                    bucket.last_changed = node.last_seen
+                    return
+
+    def failed(self, node_id: bytes):
+        for node in self._bucket(node_id).nodes:
+            if node.id == node_id:
+                node.failures += 1
+
+    def closest(self, target: bytes, count: int = K) -> list[NodeInfo]:
+        nodes = [node for bucket in self.buckets for node in bucket.nodes if node.failures < MAX_FAILURES]
+        nodes.sort(key=lambda node: distance(node.id, target))
+        return nodes[:count]
+
+    def __len__(self):
+        return sum(len(bucket.nodes) for bucket in self.buckets)
+
+
+class DHTNode(asyncio.DatagramProtocol):
+    node_id: bytes = None
+    table: RoutingTable = None
+    transport: asyncio.DatagramTransport = None
+    port: int = 0
+    state_path: str = None
+
+    pending: dict[bytes, tuple[asyncio.Future, tuple[str, int]]] = {}  # Maps transaction id -> (response, addr)
+    peer_store: dict[bytes, dict[tuple[int, int], float]] = {}  # Maps info_hash -> {(ip, port): announce time}
+    secrets: list[bytes] = []  # [current, previous] token secrets
+    secret_rotated: float = 0.0
+    refresh_task: asyncio.Task = None
+
+    def __init__(self, state_path: str = None, node_id: bytes = None):
+        # Routing table is persisted to state_path so restarts don't need a full bootstrap
+        self.state_path = state_path
+        self.node_id = node_id or os.urandom(20)
+        self.pending = {}
+        self.peer_store = {}
+        self.secrets = [os.urandom(16), os.urandom(16)]
+        self.secret_rotated = clock.now()
+        self.load_state()
+        self.table = self.table or RoutingTable(self.node_id)
+
+    async def start(self, port: int, host: str = '0.0.0.0', bootstrap_nodes: list[tuple[str, int]] = None):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+        self.refresh_task = asyncio.ensure_future(self._run_refresh())
+        await self.bootstrap(bootstrap_nodes if bootstrap_nodes is not None else BOOTSTRAP_NODES)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def close(self):
+        self.save_state()
+        if self.refresh_task:
+            self.refresh_task.cancel()
+        for future, _ in self.pending.values():
+            future.cancel()
+        if self.transport:
+            self.transport.close()
+
+    # Persistence
+
+    def load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, 'rb') as f:
+                state, _ = bdecode(f.read())
+            self.node_id = state['id']
+            self.table = RoutingTable(self.node_id)
+            for node in decode_nodes(state['nodes']):
+                self.table.add(node)
+        except (BDecodeError, KeyError, OSError) as e:
+            # Start from scratch
+            event_log.event('dht', 'invalid_state', path=self.state_path, error=e)
+
+    def save_state(self):
+        if not self.state_path:
+            return
+        nodes = [node for bucket in self.table.buckets for node in bucket.nodes]
+        with open(self.state_path, 'wb') as f:
+            f.write(bencode({'id': self.node_id, 'nodes': encode_nodes(nodes)}))
+
+    # KRPC
+
+    async def query(self, addr: tuple[str, int], method: str, args: dict) -> dict:
+        tx_id = os.urandom(2)
+        while tx_id in self.pending:
+            tx_id = os.urandom(2)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tx_id] = (future, addr)
+
+        args['id'] = self.node_id
+        self.transport.sendto(bencode({'t': tx_id, 'y': 'q', 'q': method, 'a': args}), addr)
+        try:
+            return await asyncio.wait_for(future, QUERY_TIMEOUT)
+        finally:
+            self.pending.pop(tx_id, None)
+
+    def datagram_received(self, data, addr):
+        try:
+            msg, _ = bdecode(data)
+            msg_type = msg['y']
+            tx_id = msg['t']
+        except (BDecodeError, KeyError, TypeError):
+            return
+
+        if msg_type == b'q':
+            self._handle_query(msg, tx_id, addr)
+        elif tx_id in self.pending:
+            future, expected_addr = self.pending[tx_id]
+            if expected_addr != addr or future.done():
+                return
+            if msg_type == b'r' and isinstance(msg.get('r'), dict):
+                response = msg['r']
+                if isinstance(response.get('id'), bytes):
+                    self.table.add(NodeInfo(response['id'], addr))
+                future.set_result(response)
+            else:
+                future.set_exception(DHTError(msg.get('e')))
+
+    def error_received(self, exc):
+        pass  # Queries time out on their own
+
+    def _respond(self, tx_id: bytes, addr: tuple[str, int], response: dict):
+        response['id'] = self.node_id
+        self.transport.sendto(bencode({'t': tx_id, 'y': 'r', 'r': response}), addr)
+
+    def _error(self, tx_id: bytes, addr: tuple[str, int], code: int, reason: str):
+        self.transport.sendto(bencode({'t': tx_id, 'y': 'e', 'e': [code, reason]}), addr)
+
+    def _token(self, ip: str, secret: bytes) -> bytes:
+        return hashlib.sha1(secret + socket.inet_aton(ip)).digest()[:8]
+
+    def _rotate_secrets(self):
+        if clock.now() - self.secret_rotated > TOKEN_ROTATION:
+            self.secrets = [os.urandom(16), self.secrets[0]]
+            self.secret_rotated = clock.now()
+
+    def _handle_query(self, msg: dict, tx_id: bytes, addr: tuple[str, int]):
+        args = msg.get('a')
+        method = msg.get('q')
+        if not isinstance(args, dict) or not isinstance(args.get('id'), bytes):
+            self._error(tx_id, addr, 203, 'Protocol Error')
+            return
+        self.table.add(NodeInfo(args['id'], addr))
+        self._rotate_secrets()
+
+        if method == b'ping':
+            self._respond(tx_id, addr, {})
+        elif method == b'find_node' and isinstance(args.get('target'), bytes):
+            self._respond(tx_id, addr, {'nodes': encode_nodes(self.table.closest(args['target']))})
+        elif method == b'get_peers' and isinstance(args.get('info_hash'), bytes):
+            response = {'token': self._token(addr[0], self.secrets[0])}
+            peers = self._stored_peers(args['info_hash'])
+            if peers:
+                response['values'] = [struct.pack("!IH", ip, port) for ip, port in peers[:MAX_VALUES]]
+            else:
+                response['nodes'] = encode_nodes(self.table.closest(args['info_hash']))
+            self._respond(tx_id, addr, response)
+        elif method == b'announce_peer' and isinstance(args.get('info_hash'), bytes):
+            if args.get('token') not in [self._token(addr[0], secret) for secret in self.secrets]:
+                self._error(tx_id, addr, 203, 'Bad token')
+                return
+            port = addr[1] if args.get('implied_port') else args.get('port')
+            if not isinstance(port, int) or not 0 < port < 65536:
+                self._error(tx_id, addr, 203, 'Bad port')
+                return
+            self._store_peer(args['info_hash'], (struct.unpack("!I", socket.inet_aton(addr[0]))[0], port))
+            self._respond(tx_id, addr, {})
+        else:
+            self._error(tx_id, addr, 204, 'Method Unknown')
+
+    def _stored_peers(self, info_hash: bytes) -> list[tuple[int, int]]:
+        peers = self.peer_store.get(info_hash, {})
+        cutoff = clock.now() - PEER_TTL
+        for addr in [addr for addr, announced in peers.items() if announced < cutoff]:
+            del peers[addr]
+        return list(peers)
+
+    def _store_peer(self, info_hash: bytes, addr: tuple[int, int]):
+        if info_hash not in self.peer_store and len(self.peer_store) >= MAX_INFO_HASHES:
+            return
+        peers = self.peer_store.setdefault(info_hash, {})
+        if addr in peers or len(peers) < MAX_PEERS_PER_HASH:
+            peers[addr] = clock.now()
+
+    # Lookups
+
+    async def _lookup_query(self, node: NodeInfo, method: str, target: bytes) -> dict:
+        key = 'info_hash' if method == 'get_peers' else 'target'
+        return await self.query(node.addr, method, {key: target})
+
+    async def lookup(self, target: bytes, method: str = 'find_node') -> tuple[list[tuple[NodeInfo, bytes]], set]:
+        """
+        Iterative lookup.  Queries the ALPHA closest unqueried nodes at a time until the K closest nodes seen have all
+        been queried.  Returns ([(node, token)] of the closest responding nodes, peers found)
+        """
+        shortlist = {node.id: node for node in self.table.closest(target)}
+        queried = set()
+        responded = {}
+        peers = set()
+
+        while True:
+            closest = sorted(shortlist.values(), key=lambda n: distance(n.id, target))[:K]
+            to_query = [node for node in closest if node.id not in queried][:ALPHA]
+            if not to_query:
+                break
+            queried.update(node.id for node in to_query)
+
+            results = await asyncio.gather(*[self._lookup_query(node, method, target) for node in to_query],
+                                           return_exceptions=True)
+            for node, result in zip(to_query, results):
+                if isinstance(result, BaseException):
+                    self.table.failed(node.id)
+                    shortlist.pop(node.id, None)
+                    continue
+                responded[node.id] = (node, result.get('token', b''))
+                nodes = result.get('nodes', b'')
+                for found in decode_nodes(nodes if isinstance(nodes, bytes) else b''):
+                    shortlist.setdefault(found.id, found)
+                for value in result.get('values', []):
+                    if isinstance(value, bytes) and len(value) == 6:
+                        peers.add(struct.unpack("!IH", value))
+
+        closest = sorted(responded.values(), key=lambda r: distance(r[0].id, target))[:K]
+        return closest, peers
+
+    async def get_peers(self, info_hash: bytes) -> list[tuple[int, int]]:
+        _, peers = await self.lookup(info_hash, 'get_peers')
+        return list(peers)
+
+    async def announce(self, info_hash: bytes, port: int) -> list[tuple[int, int]]:
+        """ Finds peers for info_hash and announces us to the closest nodes """
+        closest, peers = await self.lookup(info_hash, 'get_peers')
+        await asyncio.gather(*[self.query(node.addr, 'announce_peer',
+                                          {'info_hash': info_hash, 'port': port, 'token': token})
+                               for node, token in closest if token], return_exceptions=True)
+        return list(peers)
+
+    async def bootstrap(self, addrs: list[tuple[str, int]]):
+        # Saved nodes & bootstrap nodes learn about us from the lookup of our own id
+        loop = asyncio.get_running_loop()
+        for addr in addrs:
+            try:
+                infos = await loop.getaddrinfo(addr[0], addr[1], family=socket.AF_INET, type=socket.SOCK_DGRAM)
+                await self.query(infos[0][4][:2], 'find_node', {'target': self.node_id})
+            except (OSError, asyncio.TimeoutError, DHTError) as e:
+                event_log.event('dht', 'bootstrap_failed', addr=f'{addr[0]}:{addr[1]}', error=e)
+        await self.lookup(self.node_id)
+
+    def add_contact(self, ip: str, port: int):
+        """ Pings a node learnt about from elsewhere i.e. a Port message, it is added to the table if it replies """
+        if self.transport:
+            future = asyncio.ensure_future(self.query((ip, port), 'ping', {}))
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())  # Failures are expected
+
+    async def _run_refresh(self):
+        while True:
+            await asyncio.sleep(BUCKET_REFRESH / 3)
+            now = clock.now()
+            for bucket in list(self.table.buckets):
+                if now - bucket.last_changed > BUCKET_REFRESH:
+                    bucket.last_changed = now
+                    await self.lookup(random.randrange(bucket.lo, bucket.hi).to_bytes(20, 'big'))
+            self.save_state()
+
+    async def run_announcer(self, info_hash: bytes, session, peer_manager):
+        """ Periodically announces a torrent & feeds the peers found to the PeerManager """
+        while session.active:
+            try:
+                peers = await self.announce(info_hash, session.listen_port)
+                peer_manager.connect_to_peers(peers)
+            except Exception as e:
+                event_log.event('dht', 'announce_failed', torrent=info_hash.hex(), error=e)
+            await asyncio.sleep(ANNOUNCE_INTERVAL)
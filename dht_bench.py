@@ -0,0 +1,118 @@
+# Lookup latency of an in-process DHT.  Starts many DHTNodes on loopback, each bootstrapping off a few of the nodes
+# started before it, then times find_node lookups of random targets & get_peers lookups of info_hashes some nodes
+# announced, from random nodes.  Reports how long lookups take, how many queries they send & whether get_peers found
+# the announced peers.
+#
+#   python dht_bench.py --nodes 300 --lookups 200
+#
+# Prints one JSON object.
+import argparse
+import json
+import random
+import statistics
+import time
+
+import bootstrap
+import dht
+
+BOOTSTRAP_CONTACTS = 3  # Earlier nodes each new node is told about
+ANNOUNCERS = 4  # Nodes announcing each info_hash
+
+
+class _CountingNode(dht.DHTNode):
+    """ Counts the queries it sends, to work out how many each lookup took """
+    queries: int = 0
+
+    async def query(self, addr: tuple[str, int], method: str, args: dict) -> dict:
+        self.queries += 1
+        return await super().query(addr, method, args)
+
+
+def _percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _summary(latencies: list[float], queries: list[int]) -> dict:
+    return {
+        'lookups': len(latencies),
+        'latency_ms_median': round(statistics.median(latencies) * 1000, 2),
+        'latency_ms_p95': round(_percentile(latencies, 0.95) * 1000, 2),
+        'latency_ms_max': round(max(latencies) * 1000, 2),
+        'queries_mean': round(statistics.mean(queries), 1),
+    }
+
+
+async def _timed(node: _CountingNode, lookup) -> tuple[float, int, object]:
+    sent = node.queries
+    start = time.perf_counter()
+    result = await lookup
+    return time.perf_counter() - start, node.queries - sent, result
+
+
+async def bench(args) -> dict:
+    rng = random.Random(args.seed)
+    nodes = []
+    start = time.perf_counter()
+    for _ in range(args.nodes):
+        node = _CountingNode(node_id=rng.randbytes(20))
+        contacts = rng.sample(nodes, min(BOOTSTRAP_CONTACTS, len(nodes)))
+        await node.start(0, '127.0.0.1', [('127.0.0.1', contact.port) for contact in contacts])
+        nodes.append(node)
+    bootstrap_seconds = time.perf_counter() - start
+
+    try:
+        find_latencies, find_queries = [], []
+        for _ in range(args.lookups):
+            node = rng.choice(nodes)
+            elapsed, queries, _ = await _timed(node, node.lookup(rng.randbytes(20)))
+            find_latencies.append(elapsed)
+            find_queries.append(queries)
+
+        # Each info_hash is announced by a few nodes, then looked up from others
+        announced = {}
+        for port in range(1, args.info_hashes + 1):
+            info_hash = rng.randbytes(20)
+            announced[info_hash] = set()
+            for node in rng.sample(nodes, ANNOUNCERS):
+                await node.announce(info_hash, port)
+                announced[info_hash].add((2130706433, port))  # 127.0.0.1
+
+        get_latencies, get_queries, found = [], [], 0
+        for _ in range(args.lookups):
+            info_hash = rng.choice(list(announced))
+            node = rng.choice(nodes)
+            elapsed, queries, peers = await _timed(node, node.get_peers(info_hash))
+            get_latencies.append(elapsed)
+            get_queries.append(queries)
+            found += bool(announced[info_hash] & set(peers))
+    finally:
+        for node in nodes:
+            node.close()
+
+    table_sizes = [len(node.table) for node in nodes]
+    return {
+        'loop': args.loop,
+        'nodes': args.nodes,
+        'bootstrap_seconds': round(bootstrap_seconds, 2),
+        'table_size_median': statistics.median(table_sizes),
+        'find_node': _summary(find_latencies, find_queries),
+        'get_peers': {**_summary(get_latencies, get_queries), 'found_fraction': round(found / args.lookups, 3)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='In-process DHT lookup latency benchmark')
+    parser.add_argument('--nodes', type=int, default=200)
+    parser.add_argument('--lookups', type=int, default=100, help='Of each kind')
+    parser.add_argument('--info-hashes', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--loop', default=bootstrap.LOOP_AUTO)
+    args = parser.parse_args()
+    args.loop = bootstrap.resolve_loop(args.loop)
+
+    print(json.dumps(bootstrap.run(bench(args), args.loop)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
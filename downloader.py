@@ -1,16 +1,20 @@
 import random
+from concurrent.futures import Executor
+from typing import Optional, Union
 
+import event_log
+import metrics
 from session import Session
-from file import File, Piece, BlockRequest, InvalidHashException
+from file import File, BlockRequest, InvalidHashException
 from peer_manager import PeerManager
 from utils import PieceTracker
-import time
 import asyncio
 
 PEER_WAIT = 3
 MAX_PEER_WAIT = 100
 NoRequestTimeout = 100
 MaxPeerRequests = 5
+MaxEventBatch = 64  # Max number of queued events handled per wakeup
 
 
 class NoPeersException(Exception):
@@ -27,66 +31,164 @@ class Downloader:
     peer_manager: PeerManager = None
 
     assigned_pieces: dict[str, int] = {}
-    assigned_requests: dict[int, set[BlockRequest]] = {}
-    piece_contributors: dict[int, set[str]] = {}
+    # Maps piece -> blocks not yet requested from any peer.  Built once when the piece is first assigned, so
+    # issuing requests never has to rebuild it from the piece's remaining blocks.
+    unsent_requests: dict[int, set[BlockRequest]] = {}
 
     piece_tracker: PieceTracker = None
+    # Scheduling events pushed by peers: a BlockRequest when a block is received/expired/returned, or a peer_id
+    # when that peer's state changed (unchoked us, announced a new piece).
     completed_requests: asyncio.Queue = None
 
     endgame: bool = False
 
+    # Hashes full pieces off the loop when set, otherwise they are verified inline
+    hash_pool: Optional[Executor] = None
+    verifying: dict[int, asyncio.Task] = {}  # Maps piece -> task hashing it
+
     def __init__(self, file: File, peer_manager: PeerManager, session: Session, completed_requests: asyncio.Queue):
         self.file = file
         self.peer_manager = peer_manager
         self.session = session
         self.completed_requests = completed_requests
 
-        self.assigned_pieces = {i: set() for i in range(self.file.total_pieces)}
-        self.piece_contributors = {i: set() for i in range(self.file.total_pieces)}
+        self.assigned_pieces = {}
+        self.unsent_requests = {}
+        self.verifying = {}
 
-        self.piece_tracker = PieceTracker()  # TODO: CONSTRUCT
+        self.piece_tracker = session.piece_tracker  # Rarities are kept up to date by the session
 
     def handle_request(self, req: BlockRequest):
         if req.successful:
-            try:
-                self.file.add_block(req)
-                self.piece_contributors[req.piece].add(req.completed_by)
-
-            except InvalidHashException:
-                # Deleting existing piece data and recreate BlockRequests
-                self.file.reset_piece(req.piece)
-                # Blacklist any peers who provided data to this piece.  Not 100% accurate, some peers may just have been
-                # assigned to this piece.  # TODO: Make this 100% correct i.e. track who has contributed.
-                for contributor in self.piece_contributors[req.piece]:
-                    peer = self.peer_manager.peers[contributor]
-                    self.peer_manager.blacklisted_peers.add((peer.host, peer.port))
-                    self.peer_manager.terminate_peer(peer)
-                self.piece_contributors[req.piece] = set()
-                # Note do not need to unassign the piece/delete assigned requests
+            if (full_piece := self.file.store_block(req)) is None:
+                return
+            if self.hash_pool is None:
+                self.complete_piece(full_piece)
+            else:
+                # Hash off the loop, no more blocks are accepted for the piece until it is verified or reset
+                self.verifying[full_piece] = asyncio.create_task(self._verify_piece(full_piece))
         else:
             req.reset()
+            if req.piece in self.unsent_requests and self.file.block_remaining(req):
+                # Make the block available to the next peer that is topped up.
+                self.unsent_requests[req.piece].add(req)
+
+    async def _verify_piece(self, piece_idx: int):
+        piece = self.file.piece(piece_idx)
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.hash_pool, piece.valid_hash)
+        finally:
+            del self.verifying[piece_idx]
+        waiting = piece.sources() | {peer_id for peer_id, assigned in self.assigned_pieces.items()
+                                     if assigned == piece_idx}
+        try:
+            self.complete_piece(piece_idx)  # Uses the cached hash result
+        except Exception as e:
+            event_log.event('download', 'error', torrent=self.session.label, error=e)
+        # Wake run() to top up the peers stalled on the piece & check for completion
+        for peer_id in waiting:
+            self.completed_requests.put_nowait(peer_id)
+
+    def complete_piece(self, piece_idx: int):
+        """ Verifies a full piece, writes it & tells peers if valid, otherwise resets it for another attempt """
+        try:
+            self.file.complete_piece(piece_idx)
+        except InvalidHashException:
+            metrics.HASH_FAILURES.inc(self.session.label)
+            piece = self.file.piece(piece_idx)
+            contributors = piece.sources()
+            event_log.event('download', 'hash_failed', torrent=self.session.label, piece=piece_idx,
+                            contributors=sorted(contributors))
+            # Recreate BlockRequests, keeping the failed data so the bad block(s) can be identified
+            self.file.reset_piece(piece_idx)
+            if len(contributors) == 1:
+                # Only one peer contributed, so it must be the culprit.
+                self.peer_manager.ban_peer(contributors.pop())
+            self.unsent_requests[piece_idx] = set(piece.remaining_blocks)
+            # Note do not need to unassign the piece
+            return
+
+        # Any peer whose block from a failed attempt differs from the verified data sent us corrupt data.
+        for peer_id in self.file.piece(piece_idx).corrupt_sources():
+            self.peer_manager.ban_peer(peer_id)
+        self.file.release_piece(piece_idx)
+        self.unsent_requests.pop(piece_idx, None)
+        # Tell everyone, other leechers can only request pieces they know we have
+        for peer in self.peer_manager.peers.values():
+            if not peer.writer.is_closing():
+                peer.send_have(piece_idx)
+
+    def drop_peer(self, peer_id: str):
+        # Its requests come back as failed events, only the assignment needs forgetting
+        self.assigned_pieces.pop(peer_id, None)
+
+    def handle_event(self, event: Union[BlockRequest, str]) -> Optional[str]:
+        """ Handles a single scheduling event, returns the id of the peer affected by it """
+        if isinstance(event, str):
+            return event
+
+        peer_id = event.completed_by  # Cleared by handle_request on failed requests
+        self.handle_request(event)
+        return peer_id
+
+    def _drain_events(self, first_event: Union[BlockRequest, str]) -> set[str]:
+        """ Handles the given event and any other queued events, returns the ids of the affected peers """
+        affected = set()
+        event = first_event
+        for _ in range(MaxEventBatch):
+            peer_id = self.handle_event(event)
+            if peer_id:
+                affected.add(peer_id)
+            try:
+                event = self.completed_requests.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+        return affected
+
+    def update_peers(self, peer_ids: set[str]):
+        # Only top up the peers affected by the handled events.
+        for peer_id in peer_ids:
+            if peer_id not in self.session.interesting or peer_id not in self.peer_manager.peers:
+                continue
+            # Fast extension peers let us request their allowed fast pieces while choking us
+            if peer_id in self.session.peers_unchoking or self.peer_manager.peers[peer_id].allowed_fast_in:
+                self.issue_requests(peer_id)
 
     def distribute_requests(self):
+        # Full sweep, only used on startup and when no events have arrived for a while.
         # Only want to issue requests to peers who are interesting and have us unchoked.
         for peer_id in self.session.interesting & self.session.peers_unchoking:
             self.issue_requests(peer_id)
 
     def _assign_piece(self, peer_id: str):
         # Peer doesn't have a piece assigned to it
-        candidate_pieces = self.file.incomplete_pieces & self.session.owned_pieces[peer_id]
+        peer = self.peer_manager.peers[peer_id]
+        candidate_pieces = (self.file.incomplete_pieces & self.session.owned_pieces[peer_id]) - self.verifying.keys()
+        if peer.peer_choking:
+            candidate_pieces &= peer.allowed_fast_in
         if not candidate_pieces:
             # Note: Shouldn't reach here, but need the sanity check
             return False
 
-        if (available_pieces := candidate_pieces - self.assigned_pieces.keys()):
+        if (available_pieces := candidate_pieces - set(self.assigned_pieces.values())):
             # Owns pieces that haven't been assigned.
             candidate_pieces = available_pieces
         # Else just have to double up
 
-        # Assign the rarest piece to this peer
-        self.assigned_pieces[peer_id] = self.piece_tracker.get_rarest(candidate_pieces)
+        if (suggested_pieces := candidate_pieces & peer.suggested_pieces):
+            # Suggested pieces are cheap for the peer to serve
+            candidate_pieces = suggested_pieces
+
+        piece = self.pick_piece(peer_id, candidate_pieces)
+        self.assigned_pieces[peer_id] = piece
+        if piece not in self.unsent_requests:
+            self.unsent_requests[piece] = set(self.file.piece(piece).remaining_blocks)
         return True
 
+    def pick_piece(self, peer_id: str, candidate_pieces: set[int]) -> int:
+        """ Piece selection policy: rarest first """
+        return self.piece_tracker.get_rarest(candidate_pieces)
+
     def issue_requests(self, peer_id: str):
         peer = self.peer_manager.peers[peer_id]
         to_request = MaxPeerRequests - peer.num_pending
@@ -94,27 +196,32 @@ class Downloader:
             # return if has max pending requests.
             return
 
-        assigned_piece = self.assigned_pieces[peer_id]
+        assigned_piece = self.assigned_pieces.get(peer_id)
         # Piece num can be 0.  No assigned piece when == None.
-        if assigned_piece == None or self.file.pieces[assigned_piece].full():
+        if assigned_piece is None or assigned_piece not in self.file.incomplete_pieces \
+                or assigned_piece in self.verifying \
+                or (peer.peer_choking and assigned_piece not in peer.allowed_fast_in):
             if not self._assign_piece(peer_id):
                 return
+            assigned_piece = self.assigned_pieces[peer_id]
 
-        piece = self.file.pieces[assigned_piece]
-        unsent_requests = set(piece.remaining_blocks) - self.assigned_requests[assigned_piece]
+        piece = self.file.piece(assigned_piece)
+        unsent_requests = self.unsent_requests[assigned_piece]
 
-        if not unsent_requests or self.endgame:
-            # If all of this piece's blocks have been requested to other peers, or in endgame mode, then
-            # request the piece's remaining unfulfilled block requests.  Want to finish pieces as quickly as
-            # possible (though it is inefficient in the former case).
-            possible_reqs = piece.remaining_blocks
-        else:
-            possible_reqs = unsent_requests
-        to_request = random.sample(possible_reqs, min(to_request, len(possible_reqs)))
+        if unsent_requests and not self.endgame:
+            # Pop straight off the unsent set so the cost only depends on the number of requests issued.
+            for _ in range(min(to_request, len(unsent_requests))):
+                peer.send_request(unsent_requests.pop())
+            return
 
-        for req in to_request:
+        # If all of this piece's blocks have been requested to other peers, or in endgame mode, then
+        # request the piece's remaining unfulfilled block requests.  Want to finish pieces as quickly as
+        # possible (though it is inefficient in the former case).
+        pending = set(peer.pending_requests)
+        possible_reqs = [req for req in piece.remaining_blocks if req not in pending]
+        for req in random.sample(possible_reqs, min(to_request, len(possible_reqs))):
+            unsent_requests.discard(req)
             peer.send_request(req)
-            self.assigned_requests[assigned_piece].add(req)
 
     async def run(self):
         try:
@@ -122,29 +229,39 @@ class Downloader:
                 try:
                     if not self._have_available_peers():
                         await self.wait_for_peers()
-                    self.distribute_requests()
+                        # Peers that were already unchoking us won't generate new events.
+                        self.distribute_requests()
 
                     # Need timeout incase no peers left
-                    req = await asyncio.wait_for(self.completed_requests.get(), timeout=NoRequestTimeout)
-                    self.handle_request(req)
+                    async with asyncio.timeout(NoRequestTimeout):
+                        event = await self.completed_requests.get()
+                    affected_peers = self._drain_events(event)
                     if self.file.is_complete():
                         raise DownloadComplete()
+                    self.update_peers(affected_peers)
 
                 except asyncio.TimeoutError:
+                    # No events for a while, fall back on a full sweep.
+                    self.distribute_requests()
                     continue
+                except DownloadComplete:
+                    break
                 except NoPeersException:
-                    # TODO: LOG
+                    event_log.event('download', 'no_peers', torrent=self.session.label, waited=MAX_PEER_WAIT)
                     break
                 except Exception as e:
-                    # TODO: LOG unknown
-                    pass
+                    event_log.event('download', 'error', torrent=self.session.label, error=e)
         finally:
-            self.shutdown()
+            for task in self.verifying.values():
+                task.cancel()
+            if not self.file.is_complete():
+                self.shutdown()
+            # Else keep the session running to seed
 
     def _have_available_peers(self):
         # Can download blocks from peers if they are interesting (have pieces we want) and aren't choking us (aren't
-        # ignoring our requests).
-        return len(self.session.peers_unchoking & self.session.interesting) > 0
+        # ignoring our requests), or have given us allowed fast pieces.  The peers keep the set up to date.
+        return bool(self.session.available_peers)
 
     async def wait_for_peers(self):
         # Waits until a peer connects
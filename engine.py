@@ -0,0 +1,294 @@
+# Runs many torrents in one process.  One listening port (TCP & uTP) is shared by every torrent and incoming
+# connections are routed to their torrent by the info_hash in their handshake.  Connection slots, the disk cache,
+# the hashing pool & the global rate limits are shared too.
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import event_log
+import loop_monitor
+import metrics
+import tracing
+from dht import DHTNode
+from downloader import Downloader
+from file import File, DiskCache
+from messages import Handshake, MessageParsingError
+from peer import HANDSHAKE_WAIT
+from peer_manager import PeerManager, ConnectionBudget
+from pex import PeerExchange
+from rate_limiter import RateLimiter
+from seeder import Seeder
+from session import Session
+from tracker import Announcer, AnnounceScheduler, UDPTrackerClient, HTTPTrackerClient
+from uploader import Uploader
+from utils import parse_metainfo, PieceTracker
+from utp import UTPSocketManager
+
+DEFAULT_PORT = 6881
+MAX_CONNECTIONS = 500  # Across every torrent
+CACHE_SIZE = 64 * 2 ** 20  # Bytes of piece data cached for uploading, across every torrent
+HASH_WORKERS = 2  # Threads used to hash check existing data
+
+
+class Torrent:
+    """
+    A torrent added to the engine.  While stopped only the metainfo is held, the File, Session & the rest of the
+    components are created by start() and dropped by stop().
+    """
+    engine: 'Engine' = None
+    metainfo: dict = None
+    info_hash: bytes = None
+    path: str = None
+
+    file: File = None
+    session: Session = None
+    peer_manager: PeerManager = None
+    downloader: Downloader = None
+    seeder: Seeder = None
+    uploader: Uploader = None
+    peer_exchange: PeerExchange = None
+    announcer: Announcer = None
+    tasks: list[asyncio.Task] = []
+    starting: asyncio.Task = None  # Set while the file is being allocated & checked
+
+    def __init__(self, engine: 'Engine', metainfo: dict, info_hash: bytes, path: str):
+        self.engine = engine
+        self.metainfo = metainfo
+        self.info_hash = info_hash
+        self.path = path
+        self.tasks = []
+
+    @property
+    def running(self):
+        return self.session is not None and self.session.active
+
+    async def start(self):
+        if self.session is not None:
+            return
+        # Set before anything is awaited, so a second start() waits on the first rather than starting again
+        if self.starting is None:
+            self.starting = asyncio.ensure_future(self._start())
+        try:
+            await asyncio.shield(self.starting)
+        finally:
+            if self.starting is not None and self.starting.done():
+                self.starting = None
+
+    async def _start(self):
+        engine = self.engine
+        loop = asyncio.get_running_loop()
+        info = self.metainfo['info']
+
+        # Allocating & hash checking the file blocks, keep it off the event loop
+        file = await loop.run_in_executor(engine.hash_pool, File, self.path, info['length'], info['piece length'],
+                                          info['piece hashes'], engine.cache)
+        file.info_hash = self.info_hash
+        file.mark_complete(await loop.run_in_executor(engine.hash_pool, file.check_pieces))
+
+        self.file = file
+        self.session = Session(file, PieceTracker(file.total_pieces), engine.rate_limiter)
+        self.peer_manager = PeerManager(engine.my_id, self.session, engine.connections, engine.port)
+        self.uploader = Uploader(file, self.session)
+        self.peer_exchange = PeerExchange(self.peer_manager, self.session)
+        completed_requests = asyncio.Queue()
+
+        self.peer_manager.uploader = self.uploader
+        self.peer_manager.peer_exchange = self.peer_exchange
+        self.peer_manager.completed_requests = completed_requests
+        self.peer_manager.dht = engine.dht
+        self.peer_manager.utp = engine.utp  # Outgoing uTP connections use the shared socket
+
+        self.downloader = Downloader(file, self.peer_manager, self.session, completed_requests)
+        self.downloader.hash_pool = engine.hash_pool
+        self.peer_manager.downloader = self.downloader
+        self.seeder = Seeder(self.peer_manager, self.session)
+        self.peer_manager.seeder = self.seeder
+        try:
+            self.announcer = Announcer(self.metainfo, engine.port, engine.my_id, file, self.session,
+                                       self.peer_manager, engine.udp_tracker, engine.http_tracker)
+        except ValueError:
+            self.announcer = None  # Unsupported tracker, rely on the DHT & PEX
+            event_log.event('torrent', 'no_trackers', torrent=self.session.label)
+
+        self.peer_manager.start()
+        coros = [self.uploader.run(), self.seeder.run(), self.peer_exchange.run()]
+        if not file.is_complete():
+            coros.append(self.downloader.run())
+        if engine.dht:
+            coros.append(engine.dht.run_announcer(self.info_hash, self.session, self.peer_manager))
+        self.tasks = [asyncio.ensure_future(coro) for coro in coros]
+        metrics.OUTSTANDING_REQUESTS.track(self.peer_manager.outstanding_requests, self.session.label)
+        metrics.DOWNLOADER_QUEUE.track(completed_requests.qsize, self.session.label)
+        metrics.UPLOAD_QUEUE.track(self.uploader.queued, self.session.label)
+        metrics.SEND_BUFFER.track(self.peer_manager.send_buffer_size, self.session.label)
+        if self.announcer:
+            engine.announces.add(self.announcer)
+
+    async def stop(self):
+        if self.starting is not None:
+            await asyncio.wait([self.starting])
+        if self.session is None:
+            return
+        self.session.active = False
+        for task in self.tasks:
+            task.cancel()
+        await self.peer_manager.shutdown()
+        if self.announcer:
+            await self.engine.announces.remove(self.announcer)
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+        self.engine.cache.discard_torrent(self.info_hash)
+        metrics.REGISTRY.remove_matching('torrent', self.session.label)
+
+        self.file = self.session = self.peer_manager = self.downloader = self.seeder = None
+        self.uploader = self.peer_exchange = self.announcer = None
+        self.tasks = []
+
+
+class Engine:
+    my_id: str = ''
+    port: int = DEFAULT_PORT
+    download_dir: str = ''
+
+    torrents: dict[bytes, Torrent] = {}  # Maps info_hash -> Torrent
+
+    # Shared by every torrent
+    rate_limiter: RateLimiter = None
+    connections: ConnectionBudget = None
+    cache: DiskCache = None
+    hash_pool: ThreadPoolExecutor = None
+    dht: DHTNode = None
+    udp_tracker: UDPTrackerClient = None  # One socket for every torrent's UDP tracker traffic
+    http_tracker: HTTPTrackerClient = None  # One connection pool for every torrent's HTTP tracker traffic
+    announces: AnnounceScheduler = None  # Spreads every torrent's announces out over time
+    announce_task: asyncio.Task = None
+    metrics_port: int = None  # Serves Prometheus metrics & the tracing/profiling toggles on 127.0.0.1 when set
+    metrics_server = None
+    log_path: str = None  # Structured event log, JSON lines
+    owns_log: bool = False  # The event log is process wide, only stopped by the engine which started it
+    monitor: loop_monitor.LoopMonitor = None
+    enable_monitor: bool = True  # Loop lag sampling & the stall watchdog
+
+    server = None
+    utp: UTPSocketManager = None
+    enable_utp: bool = True
+
+    def __init__(self, my_id: str, download_dir: str, port: int = DEFAULT_PORT,
+                 max_connections: int = MAX_CONNECTIONS, cache_size: int = CACHE_SIZE,
+                 hash_workers: int = HASH_WORKERS, dht_state_path: str = None, enable_dht: bool = False,
+                 metrics_port: int = None, log_path: str = None):
+        self.my_id = my_id
+        self.download_dir = download_dir
+        self.port = port
+        self.metrics_port = metrics_port
+        self.log_path = log_path
+        self.torrents = {}
+
+        self.rate_limiter = RateLimiter()
+        self.connections = ConnectionBudget(max_connections)
+        self.cache = DiskCache(cache_size)
+        self.hash_pool = ThreadPoolExecutor(hash_workers)
+        self.udp_tracker = UDPTrackerClient()
+        self.http_tracker = HTTPTrackerClient()
+        self.announces = AnnounceScheduler()
+        if enable_dht:
+            self.dht = DHTNode(dht_state_path)
+
+    def add_torrent(self, metainfo_path: str) -> Torrent:
+        parsed = parse_metainfo(metainfo_path)
+        if parsed is None:
+            raise ValueError(f'Invalid metainfo file: {metainfo_path}')
+        metainfo, info_hash = parsed
+        if info_hash in self.torrents:
+            return self.torrents[info_hash]
+
+        # Same data as the piece hashes, no need to hold it twice
+        del metainfo['info']['pieces']
+        name = os.path.basename(metainfo['info']['name'].decode('utf-8', errors='replace'))
+        torrent = Torrent(self, metainfo, info_hash, os.path.join(self.download_dir, name))
+        self.torrents[info_hash] = torrent
+        return torrent
+
+    async def remove_torrent(self, info_hash: bytes):
+        torrent = self.torrents.pop(info_hash, None)
+        if torrent:
+            await torrent.stop()
+
+    def set_limits(self, download_rate: float, upload_rate: float):
+        """ Caps the bandwidth of all torrents combined in bytes/sec, 0 for unlimited """
+        self.rate_limiter.set_limits(download_rate, upload_rate)
+
+    async def start(self, listen: bool = True):
+        """ listen is False when another process accepts connections & hands them to dispatch() """
+        if self.log_path and not event_log.running():
+            event_log.start(self.log_path)
+            self.owns_log = True
+        self.announce_task = asyncio.ensure_future(self.announces.run())
+        if listen:
+            self.server = await asyncio.start_server(self.handle_conn, port=self.port)
+        if self.enable_utp:
+            # Without the listening port, uTP is only used for outgoing connections
+            self.utp = UTPSocketManager(self.handle_conn if listen else None)
+            await self.utp.start(self.port if listen else 0)
+        if self.dht:
+            await self.dht.start(self.port if listen else 0)
+        if self.enable_monitor:
+            self.monitor = loop_monitor.LoopMonitor()
+            self.monitor.start()
+        if self.metrics_port is not None:
+            routes = tracing.routes() + (loop_monitor.routes(self.monitor) if self.monitor else [])
+            self.metrics_server = await metrics.serve(self.metrics_port, routes=routes)
+
+    async def handle_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # The peer speaks first when connecting to us, its handshake says which torrent it wants
+        try:
+            handshake = await asyncio.wait_for(reader.readexactly(Handshake.length), HANDSHAKE_WAIT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            writer.close()
+            return
+        await self.dispatch(reader, writer, handshake)
+
+    async def dispatch(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, handshake: bytes):
+        """ Hands a connection whose handshake has been read to its torrent """
+        try:
+            torrent = self.torrents.get(Handshake.info_hash(handshake))
+        except MessageParsingError:
+            torrent = None
+        if torrent is None or not torrent.running:
+            writer.close()
+            return
+        await torrent.peer_manager.handle_conn(reader, writer, handshake)
+
+    def stats(self) -> dict:
+        running = [torrent for torrent in self.torrents.values() if torrent.running]
+        return {
+            'torrents': len(self.torrents),
+            'running': len(running),
+            'connections': self.connections.count,
+            'downloaded': sum(torrent.session.downloaded for torrent in running),
+            'uploaded': sum(torrent.session.uploaded for torrent in running),
+            'download_rate': sum(torrent.session.download_rate.rate() for torrent in running),
+            'upload_rate': sum(torrent.session.upload_rate.rate() for torrent in running),
+        }
+
+    async def shutdown(self):
+        for torrent in list(self.torrents.values()):
+            await torrent.stop()
+        if self.dht:
+            self.dht.close()
+        if self.announce_task:
+            self.announce_task.cancel()
+        self.udp_tracker.close()
+        await self.http_tracker.close()
+        if self.utp:
+            self.utp.close()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.metrics_server:
+            await self.metrics_server.cleanup()
+        if self.monitor:
+            self.monitor.stop()
+        if self.owns_log:
+            event_log.stop()
+        self.hash_pool.shutdown(wait=False)
@@ -0,0 +1,134 @@
+# Structured event log.  event() only appends a tuple to a deque, which is thread safe without a lock, so it can be
+# called from the hot paths without blocking the loop.  A background thread drains the deque & writes JSON lines.
+# Each category is rate limited & optionally sampled, and the queue is bounded, so a misbehaving swarm can't flood
+# the disk.  What was dropped is counted & written out as 'suppressed' events.
+#
+# Until start() is called event() returns straight away.
+import json
+import random
+import threading
+import time
+from collections import deque
+
+MAX_QUEUE = 10000  # Records waiting for the writer, new ones are dropped past this
+FLUSH_INTERVAL = 0.5  # Seconds between writer wakeups
+SUMMARY_INTERVAL = 60  # Seconds between suppressed counts
+DEFAULT_RATE = 20  # Records per second per category
+DEFAULT_BURST = 100
+
+
+class _CategoryLimit:
+    """ Token bucket & sampling rate of one category """
+    rate: float = DEFAULT_RATE
+    burst: float = DEFAULT_BURST
+    sample: float = 1.0  # Fraction of the records within the rate which are kept
+    tokens: float = DEFAULT_BURST
+    updated: float = 0.0
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: float = DEFAULT_BURST, sample: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return self.sample >= 1 or random.random() < self.sample
+
+
+_queue: deque = deque()  # (time, category, event, peer, torrent, fields)
+_limits: dict[str, _CategoryLimit] = {}
+_suppressed: dict[str, int] = {}  # Maps category -> records dropped since the last summary
+_writer: '_Writer' = None
+
+
+def configure(category: str, rate: float = DEFAULT_RATE, burst: float = DEFAULT_BURST, sample: float = 1.0):
+    """ rate & burst in records per second, sample is the fraction of allowed records kept """
+    _limits[category] = _CategoryLimit(rate, burst, sample)
+
+
+def event(category: str, name: str, peer: str = None, torrent: str = None, **fields):
+    if _writer is None:
+        return
+    limit = _limits.get(category)
+    if limit is None:
+        limit = _limits[category] = _CategoryLimit()
+    if not limit.allow() or len(_queue) >= MAX_QUEUE:
+        _suppressed[category] = _suppressed.get(category, 0) + 1
+        return
+    _queue.append((time.time(), category, name, peer, torrent, fields))
+
+
+def _default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    if isinstance(value, BaseException):
+        return repr(value)
+    return str(value)
+
+
+def _format(record: tuple) -> str:
+    ts, category, name, peer, torrent, fields = record
+    line = {'ts': round(ts, 6), 'category': category, 'event': name}
+    if peer is not None:
+        line['peer'] = peer
+    if torrent is not None:
+        line['torrent'] = torrent
+    if fields:
+        line['fields'] = fields
+    return json.dumps(line, default=_default) + '\n'
+
+
+class _Writer(threading.Thread):
+    def __init__(self, path: str):
+        super().__init__(name='event-log', daemon=True)
+        self.path = path
+        self.stopping = threading.Event()
+        self.last_summary = time.monotonic()
+
+    def _drain(self, f):
+        lines = []
+        while _queue:
+            lines.append(_format(_queue.popleft()))
+        if time.monotonic() - self.last_summary >= SUMMARY_INTERVAL or self.stopping.is_set():
+            self.last_summary = time.monotonic()
+            for category in list(_suppressed):
+                count = _suppressed.pop(category)
+                lines.append(_format((time.time(), 'log', 'suppressed', None, None,
+                                      {'category': category, 'count': count})))
+        if lines:
+            f.write(''.join(lines))
+            f.flush()
+
+    def run(self):
+        with open(self.path, 'a') as f:
+            while not self.stopping.wait(FLUSH_INTERVAL):
+                self._drain(f)
+            self._drain(f)
+
+
+def running() -> bool:
+    return _writer is not None
+
+
+def start(path: str):
+    """ Starts appending JSON lines to path, a no-op if the log is already running """
+    global _writer
+    if _writer is None:
+        _writer = _Writer(path)
+        _writer.start()
+
+
+def stop():
+    """ Writes out what is queued & stops the writer """
+    global _writer
+    if _writer is not None:
+        writer, _writer = _writer, None
+        writer.stopping.set()
+        writer.join()
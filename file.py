@@ -1,7 +1,13 @@
 import os
 import hashlib
-import time
 import math
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import clock
+import event_log
+import metrics
 
 BlockSize = 2 ** 14  # 16 Kb
 
@@ -24,6 +30,7 @@ class BlockRequest:
     successful: bool = False
     data: bytes = None
 
+    sent_at: float = 0.0
     expiration_time: float = 0.0
     piece: int = 0
     begin: int = 0
@@ -38,10 +45,15 @@ class BlockRequest:
         if not isinstance(other, BlockRequest):
             return False
 
-        return self.__dict__ == other.__dict__
+        return (self.piece, self.begin, self.length) == (other.piece, other.begin, other.length)
+
+    def __hash__(self):
+        # Requests are stored in sets, so only hash the fields identifying the block.
+        return hash((self.piece, self.begin, self.length))
 
     def start(self):
-        self.expiration_time = time.time() + RequestLifespan
+        self.sent_at = clock.now()
+        self.expiration_time = self.sent_at + RequestLifespan
 
     def reset(self):
         self.expiration_time = 0.0
@@ -49,7 +61,7 @@ class BlockRequest:
         self.completed_by = ""
 
     def expired(self):
-        return time.time() > self.expiration_time
+        return clock.now() > self.expiration_time
 
 
 class Piece:
@@ -62,52 +74,126 @@ class Piece:
     num_blocks_remaining: int = 0
     remaining_blocks: set[BlockRequest] = set()
 
+    # Maps block offset -> peer_id that supplied the block currently held in data
+    block_sources: dict[int, str] = {}
+    # Maps block offset -> (sha1 of block, peer_id) for every block of a previous attempt that failed its hash check
+    failed_blocks: dict[int, set[tuple[bytes, str]]] = {}
+    verified: Optional[bool] = None  # Hash check result for the data as it is, None until checked
+
     def __init__(self, piece: int, total_size: int, sha1_hash: bytes):
         self.piece = piece
         self.total_size = total_size
         self.data = bytearray(total_size)
         self.sha1 = sha1_hash
+        self.remaining_blocks = set()
+        self.block_sources = {}
+        self.failed_blocks = {}
         self.generate_requests()
 
     def reset(self):
-        """ Clears data in case of Invalid Hash """
-        self.data = bytearray(self.total_size)
+        """
+        Re-requests every block in case of Invalid Hash.  The hash & source of each failed block is kept, once the
+        piece validates the blocks which differ show who sent corrupt data.
+        """
+        for begin, source in self.block_sources.items():
+            block_hash = hashlib.sha1(self.data[begin:begin + BlockSize]).digest()
+            self.failed_blocks.setdefault(begin, set()).add((block_hash, source))
+
+        self.block_sources = {}
         self.remaining_blocks.clear()
         self.current_size = 0
+        self.num_blocks_remaining = 0
         self.generate_requests()
 
+    def sources(self) -> set[str]:
+        return set(self.block_sources.values())
+
+    def corrupt_sources(self) -> set[str]:
+        """ Call once the piece has a valid hash.  Returns the peers which supplied bad blocks in failed attempts """
+        corrupt = set()
+        for begin, attempts in self.failed_blocks.items():
+            block_hash = hashlib.sha1(self.data[begin:begin + BlockSize]).digest()
+            corrupt.update(source for old_hash, source in attempts if old_hash != block_hash)
+        self.failed_blocks = {}
+        return corrupt
+
     def generate_requests(self):
         # Divide piece into blocks
-        for offset in range(self.total_size, BlockSize):
+        for offset in range(0, self.total_size, BlockSize):
             req = BlockRequest(self.piece, offset, min(BlockSize, self.total_size - offset))
             self.remaining_blocks.add(req)
             self.num_blocks_remaining += 1
 
-    def add_block(self, req: BlockRequest):
+    def add_block(self, req: BlockRequest) -> bool:
+        """ Returns whether the block was stored """
         if req not in self.remaining_blocks:
-            return  # Ignore them, might change later idk
-            # TODO: Log Each reset + reason i.e. MalformedPiece, InvalidHash, etc
+            # Duplicate from endgame or a late reply to an expired request
+            event_log.event('download', 'unexpected_block', req.completed_by, piece=self.piece, begin=req.begin)
+            return False
         self.remaining_blocks.remove(req)
         self.num_blocks_remaining -= 1
         block_len = len(req.data)
         self.data[req.begin:req.begin + block_len] = req.data
+        self.block_sources[req.begin] = req.completed_by
         self.current_size += block_len
+        self.verified = None
+        return True
 
     def full(self):
         return self.total_size == self.current_size
 
     def valid_hash(self):
-        sha1 = hashlib.sha1(bytes(self.data)).digest()
-        return sha1 == self.sha1
+        """ Hashes the piece once, the result is kept until a block changes the data """
+        if self.verified is None:
+            self.verified = hashlib.sha1(self.data).digest() == self.sha1
+        return self.verified
+
+
+class DiskCache:
+    """
+    LRU cache of completed pieces read for uploading, shared by every torrent.  Keyed by (info_hash, piece) and
+    bounded by the total number of bytes held.
+    """
+    max_size: int = 0
+    size: int = 0
+    pieces: OrderedDict[tuple[bytes, int], bytes] = None
+
+    def __init__(self, max_size: int = 64 * 2 ** 20):
+        self.max_size = max_size
+        self.pieces = OrderedDict()
+
+    def get(self, key: tuple[bytes, int]) -> Optional[bytes]:
+        data = self.pieces.get(key)
+        if data is not None:
+            self.pieces.move_to_end(key)
+        return data
+
+    def put(self, key: tuple[bytes, int], data: bytes):
+        if len(data) > self.max_size:
+            return
+        if key in self.pieces:
+            self.size -= len(self.pieces.pop(key))
+        self.pieces[key] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard_torrent(self, info_hash: bytes):
+        for key in [key for key in self.pieces if key[0] == info_hash]:
+            self.size -= len(self.pieces.pop(key))
 
 
 class File:
     info_hash = ""
-    piece_loc: dict[int, int] = {}  # Maps piece index -> pos in file
-    pieces: dict[int, Piece] = {}  # Maps piece piece_index -> Piece
-    incomplete_pieces: set[int] = []
-    completed_pieces: set[int] = []
+    # Maps piece_index -> Piece.  Only pieces being downloaded have one, the block buffers are allocated on demand
+    # so idle torrents hold no piece data.
+    pieces: dict[int, Piece] = {}
+    piece_hashes: list[bytes] = []
+    incomplete_pieces: set[int] = set()
+    completed_pieces: set[int] = set()
     bitfield = None
+    cache: DiskCache = None  # Optional read cache for uploads
 
     piece_count = 0
     total_pieces: int = 0
@@ -116,66 +202,134 @@ class File:
     file_size: int = 0
     piece_size: int = 0
 
-    def __int__(self, path: str, file_size: int, piece_size: int,
-                piece_hashes: list[bytes]):
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        # Allocate file size
-        with open(path, "wb") as f:
-            f.truncate(file_size)
+    def __init__(self, path: str, file_size: int, piece_size: int,
+                 piece_hashes: list[bytes], cache: DiskCache = None):
+        self.path = path
+        self._allocate(file_size)
 
         self.piece_size = piece_size
         self.file_size = file_size
         self.piece_count = math.ceil(self.file_size / self.piece_size)
         self.remaining = file_size
-        self.path = path
         self.bitfield = [0] * self.piece_count
+        self.cache = cache
+        self.init_pieces(piece_size, piece_hashes)
+
+    # Storage.  Everything else goes through these, so they can be swapped out i.e. for in memory data when simulating
+    def _allocate(self, file_size: int):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Allocate file size, keeping any data already downloaded
+        with open(self.path, "r+b" if os.path.exists(self.path) else "wb") as f:
+            f.truncate(file_size)
+
+    def _read(self, offset: int, length: int) -> bytes:
+        start = time.perf_counter()
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        metrics.DISK_LATENCY.observe(time.perf_counter() - start, 'read')
+        return data
+
+    def _write(self, offset: int, data: bytes):
+        start = time.perf_counter()
+        with open(self.path, "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+        metrics.DISK_LATENCY.observe(time.perf_counter() - start, 'write')
 
     def init_pieces(self, piece_size: int, piece_hashes: list[bytes]):
         self.piece_size = piece_size
+        self.piece_hashes = piece_hashes
         self.total_pieces = len(piece_hashes)
-
-        for piece_idx, sha1 in enumerate(piece_hashes):
-            self.pieces[piece_idx] = Piece(piece_idx,
-                min(piece_size, self.file_size - piece_idx * piece_size), sha1)
-
-            self.piece_loc[piece_idx] = piece_idx * piece_size
+        self.pieces = {}
+        self.incomplete_pieces = set(range(self.total_pieces))
+        self.completed_pieces = set()
+
+    def piece_offset(self, piece_idx: int) -> int:
+        return piece_idx * self.piece_size
+
+    def piece_length(self, piece_idx: int) -> int:
+        return min(self.piece_size, self.file_size - piece_idx * self.piece_size)
+
+    def piece(self, piece_idx: int) -> Piece:
+        """ Returns the Piece used to download piece_idx, creating it on first use """
+        if piece_idx not in self.pieces:
+            self.pieces[piece_idx] = Piece(piece_idx, self.piece_length(piece_idx), self.piece_hashes[piece_idx])
+        return self.pieces[piece_idx]
+
+    def release_piece(self, piece_idx: int):
+        # Completed pieces are served from disk, so drop the download buffer
+        self.pieces.pop(piece_idx, None)
+
+    def check_pieces(self) -> list[int]:
+        """
+        Hashes the data already on disk and returns the valid pieces.  Blocking, meant to be run in an executor
+        """
+        valid = []
+        for piece_idx, sha1 in enumerate(self.piece_hashes):
+            data = self._read(self.piece_offset(piece_idx), self.piece_length(piece_idx))
+            if any(data) and hashlib.sha1(data).digest() == sha1:
+                valid.append(piece_idx)
+        return valid
+
+    def mark_complete(self, pieces: list[int]):
+        for piece_idx in pieces:
+            if piece_idx in self.incomplete_pieces:
+                self.incomplete_pieces.remove(piece_idx)
+                self.completed_pieces.add(piece_idx)
+                self.bitfield[piece_idx] = 1
+                self.pieces_completed += 1
+                self.release_piece(piece_idx)
 
     def is_complete(self):
         return self.pieces_completed == self.total_pieces
 
+    def have_block(self, piece_idx: int, offset: int, length: int) -> bool:
+        return piece_idx in self.completed_pieces and offset + length <= self.piece_length(piece_idx)
+
     def get_block(self, piece_idx: int, offset: int, length: int) -> bytes:
-        """ Returns data if the piece is complete, None otherwise"""
-        if piece_idx in self.completed_pieces:
-            with open(self.path, 'rb') as f:
-                f.seek(offset)
-                data = f.read(length)
-            return data
-
-    def add_block(self, req: BlockRequest):
-        """ Returns piece_idx if piece is complete, None otherwise"""
-        if req.piece in self.pieces:
-            piece = self.pieces[req.piece]
-            piece.add_block(req)
-
-            if piece.full():
-                if not piece.valid_hash():
-                    raise InvalidHashException()
-
-                # Piece is complete & has correct hash -> Write to file
-                with open(self.path, "wb") as f:
-                    f.seek(self.piece_loc[req.piece])
-                    f.write(bytes(piece.data))
-
-                self.completed_pieces.add(req.piece)
-                self.incomplete_pieces.remove(req.piece)
-                self.bitfield[req.piece] = 1
-                self.pieces_completed += 1
+        """ Returns data if the piece is complete, None otherwise.  Offset is relative to the start of the piece """
+        if piece_idx not in self.completed_pieces:
+            return None
+        if self.cache is None:
+            return self._read(self.piece_offset(piece_idx) + offset, length)
+
+        # Peers usually request every block of a piece, so cache the whole piece
+        key = (self.info_hash, piece_idx)
+        data = self.cache.get(key)
+        if data is None:
+            data = self._read(self.piece_offset(piece_idx), self.piece_length(piece_idx))
+            self.cache.put(key, data)
+        return data[offset:offset + length]
+
+    def store_block(self, req: BlockRequest):
+        """ Adds the block without verifying it.  Returns piece_idx if the block filled the piece, None otherwise """
+        if req.piece in self.incomplete_pieces:
+            piece = self.piece(req.piece)
+            if piece.add_block(req) and piece.full():
+                return req.piece
+
+    def complete_piece(self, piece_idx: int) -> int:
+        """ Verifies a full piece & writes it to file, returns piece_idx.  Hashes unless the piece was checked """
+        piece = self.piece(piece_idx)
+        if not piece.valid_hash():
+            raise InvalidHashException()
+
+        # Piece is complete & has correct hash -> Write to file
+        self._write(self.piece_offset(piece_idx), bytes(piece.data))
+
+        self.completed_pieces.add(piece_idx)
+        self.incomplete_pieces.remove(piece_idx)
+        self.bitfield[piece_idx] = 1
+        self.pieces_completed += 1
+        return piece_idx
 
     def reset_piece(self, piece: int):
-        self.pieces[piece].reset()
+        self.piece(piece).reset()
         self.bitfield[piece] = 0
 
     def block_remaining(self, req: BlockRequest):
         if req.piece in self.incomplete_pieces:
-            return req in self.pieces[req.piece].remaining_blocks
+            return req in self.piece(req.piece).remaining_blocks
         return False
@@ -0,0 +1,125 @@
+# Compares the event loops from bootstrap.available_loops() against a seeding Engine on loopback:
+#  - connection setup rate: connect, exchange handshakes & disconnect
+#  - peer message throughput: Have messages parsed & handled per second on one connection
+#
+#   python loop_bench.py --connections 2000 --messages 200000
+#
+# Prints one JSON object per event loop.
+import argparse
+import asyncio
+import json
+import socket
+import tempfile
+import time
+
+import bootstrap
+from engine import Engine
+from messages import Handshake, Message, MsgID, IncompleteMessage
+from shard_bench import make_torrents
+
+CONCURRENCY = 16  # Connections being set up at once, stays under a torrent's connection limit
+WRITE_CHUNK = 1000  # Messages written per drain
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+
+
+def _peer_id(i: int) -> str:
+    return f'-BENCH-{i:013d}'
+
+
+async def _handshake(port: int, info_hash: bytes, peer_id: str):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(Handshake.tobytes(info_hash, peer_id, Handshake.reserved_bytes(Handshake.FastExtension)))
+    await reader.readexactly(Handshake.length)
+    return reader, writer
+
+
+async def connection_rate(port: int, info_hash: bytes, count: int) -> tuple[float, int]:
+    """ Returns (handshakes per second, failed attempts) """
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    failures = 0
+
+    async def connect(i: int):
+        nonlocal failures
+        async with semaphore:
+            try:
+                _, writer = await _handshake(port, info_hash, _peer_id(i))
+                writer.close()
+                await writer.wait_closed()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[connect(i) for i in range(count)])
+    elapsed = time.perf_counter() - start
+    return (count - failures) / elapsed, failures
+
+
+async def _read_until(reader: asyncio.StreamReader, buffer: bytes, msg_id: MsgID) -> tuple[Message, bytes]:
+    while True:
+        try:
+            msg, buffer = Message.parse_first(buffer)
+            if msg.id == msg_id:
+                return msg, buffer
+        except IncompleteMessage:
+            buffer += await reader.read(2 ** 16)
+
+
+async def message_rate(port: int, info_hash: bytes, count: int) -> float:
+    """ Have messages handled per second.  A request is sent last, its reply means every Have was handled """
+    reader, writer = await _handshake(port, info_hash, _peer_id(10 ** 12))
+    allowed, buffer = await _read_until(reader, b'', MsgID.AllowedFast)
+
+    haves = [bytes(Message.new(MsgID.Have, piece=i % 8)) for i in range(WRITE_CHUNK)]
+    start = time.perf_counter()
+    for _ in range(count // WRITE_CHUNK):
+        writer.writelines(haves)
+        await writer.drain()
+    writer.write(bytes(Message.new(MsgID.Request, piece=allowed.piece, begin=0, block_length=2 ** 14)))
+    await _read_until(reader, buffer, MsgID.Piece)
+    elapsed = time.perf_counter() - start
+
+    writer.close()
+    return count // WRITE_CHUNK * WRITE_CHUNK / elapsed
+
+
+async def bench(directory: str, metainfo_path: str, info_hash: bytes, args) -> dict:
+    port = _free_port()
+    engine = Engine('-OH0001-BENCHMARK000', directory, port=port)
+    engine.enable_utp = False
+    await engine.start()
+    await engine.add_torrent(metainfo_path).start()
+
+    connections_per_sec, failures = await connection_rate(port, info_hash, args.connections)
+    messages_per_sec = await message_rate(port, info_hash, args.messages)
+    await engine.shutdown()
+
+    return {
+        'loop': type(asyncio.get_running_loop()).__module__.split('.')[0],
+        'connections': args.connections,
+        'connections_per_sec': round(connections_per_sec),
+        'failed_connections': failures,
+        'messages': args.messages,
+        'messages_per_sec': round(messages_per_sec),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Event loop benchmark')
+    parser.add_argument('--loops', nargs='+', default=bootstrap.available_loops())
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=200000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        (metainfo_path, info_hash), = make_torrents(directory, 1, 2 ** 21)
+        for loop in args.loops:
+            print(json.dumps(bootstrap.run(bench(directory, metainfo_path, info_hash, args), loop)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
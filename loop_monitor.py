@@ -0,0 +1,149 @@
+# Watches the event loop for stalls.  Hashing, disk I/O & the bitfield loops all run on the loop, so one slow call
+# holds up every peer of every torrent.  Two parts, both cheap enough to leave running:
+#  - a lag sampler: a coroutine which sleeps & records how late it woke up, as a histogram
+#  - a watchdog thread: it pings the loop & when no reply comes within the threshold it grabs the loop thread's
+#    stack, working out which component & which peer or torrent was running from the frames.
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from aiohttp import web
+
+import metrics
+
+LAG_INTERVAL = 0.5  # Seconds between lag samples
+WATCHDOG_INTERVAL = 0.1  # Seconds between pings once the loop replied
+STALL_THRESHOLD = 0.1  # Seconds without a reply before the loop counts as stalled
+MAX_STALLS = 100  # Most recent stalls kept
+STACK_LIMIT = 30  # Innermost frames kept per stall
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stall:
+    started: float = 0.0  # Wall clock
+    duration: float = 0.0  # Updated once the loop replies
+    component: str = ''  # Innermost project module on the stack
+    function: str = ''
+    peer: str = None
+    torrent: str = None
+    stack: list[str] = []
+
+    def __init__(self, started: float, stack: list[str]):
+        self.started = started
+        self.stack = stack
+
+    def to_dict(self) -> dict:
+        return {
+            'started': self.started,
+            'duration': round(self.duration, 4),
+            'component': self.component,
+            'function': self.function,
+            'peer': self.peer,
+            'torrent': self.torrent,
+            'stack': self.stack,
+        }
+
+
+def _torrent_of(obj) -> str:
+    session = obj if hasattr(obj, 'piece_owners') else getattr(obj, 'session', None)
+    if getattr(session, 'label', None):
+        return session.label
+    info_hash = getattr(getattr(obj, 'file', obj), 'info_hash', None)
+    return info_hash.hex() if isinstance(info_hash, bytes) else None
+
+
+def attribute(stall: Stall, frame):
+    """ Fills in the stall's component, function, peer & torrent from the innermost project frames """
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(PROJECT_DIR) and filename != __file__:
+            if not stall.component:
+                stall.component = os.path.splitext(os.path.basename(filename))[0]
+                stall.function = frame.f_code.co_name
+            owner = frame.f_locals.get('self')
+            if owner is not None:
+                if stall.peer is None and isinstance(getattr(owner, 'their_id', None), str):
+                    stall.peer = owner.their_id
+                if stall.torrent is None:
+                    stall.torrent = _torrent_of(owner)
+            if stall.peer and stall.torrent:
+                return
+        frame = frame.f_back
+
+
+class LoopMonitor:
+    threshold: float = STALL_THRESHOLD
+    lag_interval: float = LAG_INTERVAL
+    stalls: deque[Stall] = None
+
+    loop: asyncio.AbstractEventLoop = None
+    loop_thread: int = 0
+    lag_task: asyncio.Task = None
+    watchdog: threading.Thread = None
+    replied: threading.Event = None
+    stopping: threading.Event = None
+
+    def __init__(self, threshold: float = STALL_THRESHOLD, lag_interval: float = LAG_INTERVAL):
+        self.threshold = threshold
+        self.lag_interval = lag_interval
+        self.stalls = deque(maxlen=MAX_STALLS)
+        self.replied = threading.Event()
+        self.stopping = threading.Event()
+
+    def start(self):
+        """ Call from the loop being monitored """
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.lag_task = asyncio.ensure_future(self._sample_lag())
+        self.watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self.watchdog.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.lag_task:
+            self.lag_task.cancel()
+
+    async def _sample_lag(self):
+        while True:
+            due = self.loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            metrics.LOOP_LAG.observe(max(0.0, self.loop.time() - due))
+
+    def _watch(self):
+        while not self.stopping.is_set():
+            self.replied.clear()
+            sent = time.monotonic()
+            try:
+                self.loop.call_soon_threadsafe(self.replied.set)
+            except RuntimeError:
+                return  # Loop closed
+            if not self.replied.wait(self.threshold):
+                stall = self._capture()
+                while not self.replied.wait(self.threshold) and not self.stopping.is_set():
+                    pass
+                stall.duration = time.monotonic() - sent
+                metrics.LOOP_STALLS.inc(stall.component or 'unknown')
+                metrics.STALL_DURATION.observe(stall.duration, stall.component or 'unknown')
+            self.stopping.wait(WATCHDOG_INTERVAL)
+
+    def _capture(self) -> Stall:
+        frame = sys._current_frames().get(self.loop_thread)
+        stall = Stall(time.time(), traceback.format_stack(frame, STACK_LIMIT) if frame else [])
+        attribute(stall, frame)
+        self.stalls.append(stall)
+        return stall
+
+    def recent_stalls(self) -> list[dict]:
+        return [stall.to_dict() for stall in list(self.stalls)]
+
+
+def routes(monitor: LoopMonitor) -> list[web.RouteDef]:
+    async def stalls(request: web.Request) -> web.Response:
+        return web.json_response(monitor.recent_stalls())
+
+    return [web.get('/debug/stalls', stalls)]
@@ -17,8 +17,7 @@ class DataType:
     length = 0
 
     def __init__(self, value=None):
-        if value:
-            self._value = value
+        self._value = value
 
     @property
     def value(self):
@@ -34,6 +33,9 @@ class DataType:
     def __bytes__(self):
         raise NotImplementedError()
 
+    def copy(self):
+        return type(self)(self._value)
+
     @staticmethod
     def parse(buffer, length=None):
         raise NotImplementedError()
@@ -41,6 +43,7 @@ class DataType:
 
 class _Int(DataType):
     length: int = 4  # Length in Bytes
+    format: str = 'I'  # struct format character
 
     def __bytes__(self):
         return struct.pack(">I", self.value)
@@ -53,8 +56,24 @@ class _Int(DataType):
         return value, buffer
 
 
+class _Short(DataType):
+    length: int = 2  # Length in Bytes
+    format: str = 'H'
+
+    def __bytes__(self):
+        return struct.pack(">H", self.value)
+
+    @staticmethod
+    def parse(buffer, length=None):
+        #  Kwargs not needed here
+        (value,), buffer = struct.unpack(">H", buffer[:_Short.length]), \
+                           buffer[_Short.length:]
+        return value, buffer
+
+
 class _Char(DataType):
     length: int = 1  # Length in Bytes
+    format: str = 'B'
 
     def __bytes__(self):
         return struct.pack(">B", self.value)
@@ -70,6 +89,9 @@ class _Char(DataType):
 class _Bytes(DataType):
     # Length is variable
 
+    def __init__(self, value=b''):
+        self.value = value
+
     @property
     def value(self):
         return self._value
@@ -99,29 +121,54 @@ class Handshake:
     pstr = b"BitTorrent protocol"
     pstrlen = struct.pack(">B", 19)  # 19 = len(pstr)
 
+    # Reserved bits as (byte index, mask)
+    FastExtension = (7, 0x04)  # BEP 6
+    ExtensionProtocol = (5, 0x10)  # BEP 10
+    DHT = (7, 0x01)  # BEP 5
+
     @staticmethod
-    def tobytes(info_hash: bytes, peer_id: str) -> bytes:
+    def reserved_bytes(*extensions: tuple[int, int]) -> bytes:
+        reserved = bytearray(8)
+        for byte, mask in extensions:
+            reserved[byte] |= mask
+        return bytes(reserved)
+
+    @staticmethod
+    def supports(reserved: bytes, extension: tuple[int, int]) -> bool:
+        byte, mask = extension
+        return bool(reserved[byte] & mask)
+
+    @staticmethod
+    def tobytes(info_hash: bytes, peer_id: str, reserved: bytes = bytes(8)) -> bytes:
         msg = Handshake.pstrlen + Handshake.pstr
-        msg += "\0" * 8  # 8 reserved bytes
+        msg += reserved  # 8 reserved bytes
         msg += info_hash  # sha1 hash of infokey in metainfo file
         msg += bytes(peer_id, 'ascii')  # this client's id
         return msg
 
     @staticmethod
-    def validate(buffer: bytes, info_hash: bytes) -> str:
+    def info_hash(buffer: bytes) -> bytes:
+        """ Returns the info_hash of a received handshake, used to route incoming connections to their torrent """
+        if len(buffer) != Handshake.length or buffer[:20] != Handshake.pstrlen + Handshake.pstr:
+            raise MessageParsingError()
+        return buffer[28:48]
+
+    @staticmethod
+    def validate(buffer: bytes, info_hash: bytes) -> tuple[str, bytes]:
         """
-        Parses the Peer's handshake msg.  If valud returns peer_id, else
-        throws InvalidMessage Exception
+        Parses the Peer's handshake msg.  If valid returns (peer_id, reserved bytes), else
+        throws MessageParsingError
         """
         if len(buffer) != Handshake.length:
             raise MessageParsingError()
         pstrlen, buffer = _Char.parse(buffer)
-        if pstrlen != Handshake.pstrlen:
+        if pstrlen != len(Handshake.pstr):
             raise MessageParsingError()
-        pstr, buffer = buffer[:pstrlen].decode('ascii'), buffer[pstrlen:]
+        pstr, buffer = buffer[:pstrlen], buffer[pstrlen:]
+        reserved, buffer = buffer[:8], buffer[8:]
         if pstr != Handshake.pstr or buffer[:20] != info_hash:
             raise MessageParsingError()
-        return buffer[20:].decode('ascii')
+        return buffer[20:].decode('latin-1'), reserved
 
 
 class MsgID(enum.Enum):
@@ -136,55 +183,80 @@ class MsgID(enum.Enum):
     Piece = 7
     Cancel = 8
     Port = 9
+    # Fast Extension (BEP 6)
+    SuggestPiece = 13
+    HaveAll = 14
+    HaveNone = 15
+    RejectRequest = 16
+    AllowedFast = 17
+    # Extension Protocol (BEP 10)
+    Extended = 20
+
+
+_HEADER = struct.Struct('>IB')  # Length & id
 
 
 class Message:
-    data: dict[str, DataType]
+    id: MsgID = MsgID.KeepAlive
+    # Template of the message's fields in wire order.  Each message type packs & unpacks its fixed size fields with
+    # one struct built from the template, the values are kept as attributes.
+    data: dict[str, DataType] = {}
+    _fixed: struct.Struct = struct.Struct('>')
+    _fixed_fields: tuple[str, ...] = ()
+    _tail: str = None  # The variable length bytes field, always the last one
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        if 'id' in cls.data:
+            cls.id = MsgID(cls.data['id'].value)
+        fields = [(kw, dtype) for kw, dtype in cls.data.items() if kw not in ('length', 'id')]
+        if fields and isinstance(fields[-1][1], _Bytes):
+            cls._tail = fields.pop()[0]
+            setattr(cls, cls._tail, b'')
+        cls._fixed = struct.Struct('>' + ''.join(dtype.format for _, dtype in fields))
+        cls._fixed_fields = tuple(kw for kw, _ in fields)
 
     @staticmethod
     def new(id, **kwargs):
-        msg = MessageMap[id]
+        msg = MessageMap[id.value if isinstance(id, MsgID) else id]()
         for kw, value in kwargs.items():
-            msg.data[kw].value = value
-            msg.data['length'].value += len(msg.data[kw])
+            setattr(msg, kw, value)
         return msg
 
     @staticmethod
     def parse_first(buffer: bytes):
+        """ Returns (first message in buffer, rest of buffer) """
         if len(buffer) < 4:
-            raise MessageParsingError()
+            raise IncompleteMessage()
 
         length, data = _Int.parse(buffer)
         if length == 0:
             # KeepAlive Message
-            return KeepAlive()
+            return KeepAlive(), data
         if len(data) < length:
             raise IncompleteMessage()
 
-        id, data = _Char.parse(data)
-        msg = MessageMap[id]
-
-        # Kinda inelegant so maybe refactor later.
-        # need to remove so it doesn't re-parse it
-        del msg.data['length']
-        del msg.data['id']
-        msg.id = id
-        try:
-            for kw, dtype in msg.data.items():
-                # Length only used for bytes type, so can always pass it & decrement
-                value, data = dtype.parse(data, length)
-                length -= dtype.length
-                setattr(msg, kw, value)
-        except:
+        id = buffer[4]
+        if id not in MessageMap:
+            raise MessageParsingError()
+        msg = MessageMap[id]()
+        fixed = msg._fixed
+        if length - 1 < fixed.size:
             raise MessageParsingError()
+        for kw, value in zip(msg._fixed_fields, fixed.unpack_from(buffer, 5)):
+            setattr(msg, kw, value)
+        if msg._tail:
+            setattr(msg, msg._tail, buffer[5 + fixed.size:4 + length])
 
-        return msg, data
+        return msg, data[length:]
 
     def __bytes__(self) -> bytes:
-        msg = b''
-        for kw, value in self.data.items():
-            msg += bytes(value)
-        return msg
+        if self.id is MsgID.KeepAlive:
+            return _Int(0).__bytes__()
+        msg = self._fixed.pack(*[getattr(self, kw) for kw in self._fixed_fields])
+        if self._tail:
+            msg += getattr(self, self._tail)
+        return _HEADER.pack(1 + len(msg), self.id.value) + msg
 
 
 class KeepAlive(Message):
@@ -196,35 +268,35 @@ class KeepAlive(Message):
 class Choke(Message):
     data = {
         'length': _Int(1),
-        'id': _Char(MsgID.Choke),
+        'id': _Char(MsgID.Choke.value),
     }
 
 
 class UnChoke(Message):
     data = {
         'length': _Int(1),
-        'id': _Char(MsgID.UnChoke),
+        'id': _Char(MsgID.UnChoke.value),
     }
 
 
 class Interested(Message):
     data = {
         'length': _Int(1),
-        'id': _Char(MsgID.Interested),
+        'id': _Char(MsgID.Interested.value),
     }
 
 
 class NotInterested(Message):
     data = {
         'length': _Int(1),
-        'id': _Char(MsgID.NotInterested),
+        'id': _Char(MsgID.NotInterested.value),
     }
 
 
 class Have(Message):
     data = {
         'length': _Int(5),
-        'id': _Char(MsgID.Have),
+        'id': _Char(MsgID.Have.value),
         'piece': _Int()
     }
 
@@ -232,7 +304,7 @@ class Have(Message):
 class Bitfield(Message):
     data = {
         'length': _Int(1),
-        'id': _Char(MsgID.Bitfield),
+        'id': _Char(MsgID.Bitfield.value),
         'bitfield': _Bytes(b''),
     }
 
@@ -240,7 +312,7 @@ class Bitfield(Message):
 class Request(Message):
     data = {
         'length': _Int(13),
-        'id': _Char(MsgID.Request),
+        'id': _Char(MsgID.Request.value),
         'piece': _Int(),
         'begin': _Int(),
         'block_length': _Int(),
@@ -250,7 +322,7 @@ class Request(Message):
 class Piece(Message):
     data = {
         'length': _Int(13),
-        'id': _Char(MsgID.Piece),
+        'id': _Char(MsgID.Piece.value),
         'piece': _Int(),
         'begin': _Int(),
         'block': _Bytes(),
@@ -260,7 +332,7 @@ class Piece(Message):
 class Cancel(Message):
     data = {
         'length': _Int(13),
-        'id': _Char(MsgID.Cancel),
+        'id': _Char(MsgID.Cancel.value),
         'piece': _Int(),
         'begin': _Int(),
         'block_length': _Int(),
@@ -268,10 +340,59 @@ class Cancel(Message):
 
 
 class Port(Message):
+    data = {
+        'length': _Int(3),
+        'id': _Char(MsgID.Port.value),
+        'port': _Short(),
+    }
+
+
+class SuggestPiece(Message):
+    data = {
+        'length': _Int(5),
+        'id': _Char(MsgID.SuggestPiece.value),
+        'piece': _Int()
+    }
+
+
+class HaveAll(Message):
+    data = {
+        'length': _Int(1),
+        'id': _Char(MsgID.HaveAll.value),
+    }
+
+
+class HaveNone(Message):
+    data = {
+        'length': _Int(1),
+        'id': _Char(MsgID.HaveNone.value),
+    }
+
+
+class RejectRequest(Message):
     data = {
         'length': _Int(13),
-        'id': _Char(MsgID.Port),
-        'port': _Int(),
+        'id': _Char(MsgID.RejectRequest.value),
+        'piece': _Int(),
+        'begin': _Int(),
+        'block_length': _Int(),
+    }
+
+
+class AllowedFast(Message):
+    data = {
+        'length': _Int(5),
+        'id': _Char(MsgID.AllowedFast.value),
+        'piece': _Int()
+    }
+
+
+class Extended(Message):
+    data = {
+        'length': _Int(2),
+        'id': _Char(MsgID.Extended.value),
+        'ext_id': _Char(),  # 0 for the extension handshake, otherwise the id the receiver assigned the extension
+        'payload': _Bytes(),
     }
 
 
@@ -287,4 +408,10 @@ MessageMap = {
     7: Piece,
     8: Cancel,
     9: Port,
+    13: SuggestPiece,
+    14: HaveAll,
+    15: HaveNone,
+    16: RejectRequest,
+    17: AllowedFast,
+    20: Extended,
 }
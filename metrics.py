@@ -0,0 +1,244 @@
+# Counters, gauges & histograms for watching a running client.  An update is a dict lookup & an add, cheap enough for
+# the per-message paths.  Series are keyed by label values, i.e. the torrent's info_hash in hex & the peer_id.
+# Read them in-process with snapshot(), or as Prometheus text from the endpoint serve() starts.
+import bisect
+from typing import Callable
+
+from aiohttp import web
+
+# Block request round trips, tracker announces & disk I/O all fit in these
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+_enabled = True
+
+
+def set_enabled(enabled: bool):
+    """ When disabled every update is a no-op, series already recorded are kept """
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+class _Metric:
+    kind: str = ''
+    name: str = ''
+    help: str = ''
+    labels: tuple[str, ...] = ()
+    series: dict[tuple, object] = {}  # Maps label values -> value
+
+    def __init__(self, name: str, help: str, *labels: str):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+
+    def remove(self, *label_values):
+        self.series.pop(label_values, None)
+
+    def remove_matching(self, label: str, value: str):
+        """ Drops every series whose label has this value, i.e. those of a stopped torrent """
+        if label not in self.labels:
+            return
+        i = self.labels.index(label)
+        for key in [key for key in self.series if key[i] == value]:
+            del self.series[key]
+
+    def collect(self) -> list[tuple[tuple, object]]:
+        return list(self.series.items())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values):
+        if _enabled:
+            self.series[label_values] = self.series.get(label_values, 0) + 1
+
+    def add(self, amount: float, *label_values):
+        if _enabled:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    """ Either set directly, or tracked: a callable read each time the gauge is collected """
+    kind = 'gauge'
+    tracked: dict[tuple, Callable[[], float]] = {}
+
+    def __init__(self, name: str, help: str, *labels: str):
+        super().__init__(name, help, *labels)
+        self.tracked = {}
+
+    def set(self, value: float, *label_values):
+        if _enabled:
+            self.series[label_values] = value
+
+    def add(self, amount: float, *label_values):
+        if _enabled:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def track(self, read: Callable[[], float], *label_values):
+        self.tracked[label_values] = read
+
+    def remove(self, *label_values):
+        super().remove(*label_values)
+        self.tracked.pop(label_values, None)
+
+    def remove_matching(self, label: str, value: str):
+        super().remove_matching(label, value)
+        if label in self.labels:
+            i = self.labels.index(label)
+            for key in [key for key in self.tracked if key[i] == value]:
+                del self.tracked[key]
+
+    def collect(self) -> list[tuple[tuple, object]]:
+        return super().collect() + [(key, read()) for key, read in self.tracked.items()]
+
+
+class Histogram(_Metric):
+    """ Each series is [count per bucket..., count above the last bucket, sum] """
+    kind = 'histogram'
+    buckets: tuple[float, ...] = LATENCY_BUCKETS
+
+    def __init__(self, name: str, help: str, *labels: str, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, *labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *label_values):
+        if not _enabled:
+            return
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+
+class Registry:
+    metrics: dict[str, _Metric] = {}
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, *labels: str) -> Counter:
+        return self.register(Counter(name, help, *labels))
+
+    def gauge(self, name: str, help: str, *labels: str) -> Gauge:
+        return self.register(Gauge(name, help, *labels))
+
+    def histogram(self, name: str, help: str, *labels: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, *labels, buckets=buckets))
+
+    def remove_matching(self, label: str, value: str):
+        for metric in self.metrics.values():
+            metric.remove_matching(label, value)
+
+    def snapshot(self) -> dict[str, list[dict]]:
+        """
+        Maps metric name -> [{'labels': {...}, 'value': ...}].  Histogram values are
+        {'count': ..., 'sum': ..., 'buckets': {upper bound: cumulative count}}
+        """
+        snapshot = {}
+        for metric in self.metrics.values():
+            entries = []
+            for key, value in metric.collect():
+                if isinstance(metric, Histogram):
+                    cumulative, buckets = 0, {}
+                    for bound, count in zip(metric.buckets, value):
+                        cumulative += count
+                        buckets[bound] = cumulative
+                    value = {'count': sum(value[:-1]), 'sum': value[-1], 'buckets': buckets}
+                entries.append({'labels': dict(zip(metric.labels, key)), 'value': value})
+            snapshot[metric.name] = entries
+        return snapshot
+
+    def prometheus(self) -> str:
+        """ Text exposition format """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for key, value in metric.collect():
+                labels = list(zip(metric.labels, key))
+                if not isinstance(metric, Histogram):
+                    lines.append(f'{metric.name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), value):
+                    cumulative += count
+                    bucket_labels = _format_labels(labels + [('le', _format_value(bound))])
+                    lines.append(f'{metric.name}_bucket{bucket_labels} {cumulative}')
+                lines.append(f'{metric.name}_sum{_format_labels(labels)} {_format_value(value[-1])}')
+                lines.append(f'{metric.name}_count{_format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: list[tuple[str, object]]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
+
+# Transfer
+DOWNLOADED = REGISTRY.counter('bt_downloaded_bytes_total', 'Piece data received', 'torrent')
+UPLOADED = REGISTRY.counter('bt_uploaded_bytes_total', 'Piece data sent', 'torrent')
+PEER_DOWNLOADED = REGISTRY.counter('bt_peer_downloaded_bytes_total', 'Piece data received per peer', 'torrent', 'peer')
+PEER_UPLOADED = REGISTRY.counter('bt_peer_uploaded_bytes_total', 'Piece data sent per peer', 'torrent', 'peer')
+REQUEST_LATENCY = REGISTRY.histogram('bt_block_request_seconds', 'Block request to piece message round trip',
+                                     'torrent')
+OUTSTANDING_REQUESTS = REGISTRY.gauge('bt_outstanding_requests', 'Block requests awaiting a reply', 'torrent')
+HASH_FAILURES = REGISTRY.counter('bt_hash_failures_total', 'Downloaded pieces which failed their hash check',
+                                 'torrent')
+CHOKES = REGISTRY.counter('bt_choke_transitions_total', 'Choke state changes, sent by us or received from peers',
+                          'torrent', 'direction', 'state')
+
+# Queues
+DOWNLOADER_QUEUE = REGISTRY.gauge('bt_downloader_queue_depth', 'Events waiting for the downloader', 'torrent')
+UPLOAD_QUEUE = REGISTRY.gauge('bt_upload_queue_depth', 'Peer requests waiting for the uploader', 'torrent')
+SEND_BUFFER = REGISTRY.gauge('bt_send_buffer_bytes', 'Bytes written to peer connections but not yet sent', 'torrent')
+
+# I/O
+DISK_LATENCY = REGISTRY.histogram('bt_disk_seconds', 'File reads & writes', 'op')
+ANNOUNCE_LATENCY = REGISTRY.histogram('bt_announce_seconds', 'Tracker announce round trip', 'scheme')
+ANNOUNCE_FAILURES = REGISTRY.counter('bt_announce_failures_total', 'Tracker announces which failed', 'scheme')
+
+# Event loop
+LOOP_LAG = REGISTRY.histogram('bt_loop_lag_seconds', 'How late sleeping coroutines wake up')
+LOOP_STALLS = REGISTRY.counter('bt_loop_stalls_total', 'Times the loop was blocked past the watchdog threshold',
+                               'component')
+STALL_DURATION = REGISTRY.histogram('bt_loop_stall_seconds', 'How long the loop was blocked', 'component')
+
+
+def snapshot() -> dict[str, list[dict]]:
+    return REGISTRY.snapshot()
+
+
+async def serve(port: int, host: str = '127.0.0.1', registry: Registry = REGISTRY,
+                routes: list[web.RouteDef] = ()) -> web.AppRunner:
+    """ Serves /metrics in the Prometheus text format, plus any extra routes, until the runner is cleaned up """
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(body=registry.prometheus().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    app.add_routes(routes)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,175 @@
+# In-process HTTP & UDP (BEP 15) tracker for benchmarks & local swarms.  Both share one registry of the peers
+# announcing each info_hash, announces get compact peer lists and scrapes the swarm counts.  The HTTP side counts the
+# TCP connections it has accepted, so clients can be checked for connection reuse.
+import asyncio
+import random
+import socket
+import struct
+import urllib.parse
+
+from aiohttp import web
+
+from utils import bencode
+
+ANNOUNCE_INTERVAL = 30 * 60
+MAX_PEERS = 50  # Peers returned per announce
+
+EVENTS = {0: b'', 1: b'completed', 2: b'started', 3: b'stopped'}  # UDP event values -> HTTP event names
+
+
+class MockTracker:
+    swarms: dict[bytes, dict[bytes, tuple[int, int, bool]]] = {}  # info_hash -> {peer_id: (ip, port, seeding)}
+    completed: dict[bytes, int] = {}  # info_hash -> completed events
+    interval: int = ANNOUNCE_INTERVAL
+
+    announces: int = 0
+    scrapes: int = 0
+    connections: set = set()  # Transports seen, one per TCP connection
+
+    runner: web.AppRunner = None
+    port: int = 0
+    udp: '_UDPMockProtocol' = None
+    udp_port: int = 0
+
+    def __init__(self, interval: int = ANNOUNCE_INTERVAL):
+        self.interval = interval
+        self.swarms = {}
+        self.completed = {}
+        self.connections = set()
+
+    @property
+    def announce_url(self) -> str:
+        return f'http://127.0.0.1:{self.port}/announce'
+
+    @property
+    def udp_announce_url(self) -> str:
+        return f'udp://127.0.0.1:{self.udp_port}'
+
+    async def start(self, port: int = 0, udp_port: int = None):
+        """ The UDP tracker is only started when udp_port is given, 0 picks a free port """
+        app = web.Application()
+        app.router.add_get('/announce', self.handle_announce)
+        app.router.add_get('/scrape', self.handle_scrape)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+        if udp_port is not None:
+            loop = asyncio.get_running_loop()
+            transport, self.udp = await loop.create_datagram_endpoint(lambda: _UDPMockProtocol(self),
+                                                                      local_addr=('127.0.0.1', udp_port))
+            self.udp_port = transport.get_extra_info('sockname')[1]
+
+    async def close(self):
+        if self.udp:
+            self.udp.transport.close()
+        if self.runner:
+            await self.runner.cleanup()
+
+    def announce(self, info_hash: bytes, peer_id: bytes, ip: int, port: int, left: int,
+                 event: bytes) -> tuple[int, int, list[tuple[int, int]]]:
+        """ Updates the swarm, returns (seeders, leechers, [(ip, port)]) """
+        self.announces += 1
+        swarm = self.swarms.setdefault(info_hash, {})
+        if event == b'stopped':
+            swarm.pop(peer_id, None)
+            return 0, 0, []
+        if event == b'completed':
+            self.completed[info_hash] = self.completed.get(info_hash, 0) + 1
+
+        swarm[peer_id] = (ip, port, left == 0)
+        others = [(ip, port) for other_id, (ip, port, _) in swarm.items() if other_id != peer_id]
+        seeders = sum(seeding for _, _, seeding in swarm.values())
+        return seeders, len(swarm) - seeders, random.sample(others, min(len(others), MAX_PEERS))
+
+    def scrape(self, info_hash: bytes) -> tuple[int, int, int]:
+        """ Returns (seeders, completed, leechers) """
+        swarm = self.swarms.get(info_hash, {})
+        seeders = sum(seeding for _, _, seeding in swarm.values())
+        return seeders, self.completed.get(info_hash, 0), len(swarm) - seeders
+
+    @staticmethod
+    def _query(request: web.Request) -> dict[str, list[bytes]]:
+        # info_hash & peer_id are raw bytes, they have to be unquoted as bytes not utf-8
+        query = {}
+        raw_query = request.raw_path.partition('?')[2]
+        for key, value in urllib.parse.parse_qsl(raw_query, keep_blank_values=True, encoding='latin-1'):
+            query.setdefault(key, []).append(value.encode('latin-1'))
+        return query
+
+    def _reply(self, request: web.Request, data: dict) -> web.Response:
+        self.connections.add(request.transport)
+        return web.Response(body=bencode(data), content_type='text/plain')
+
+    async def handle_announce(self, request: web.Request) -> web.Response:
+        query = self._query(request)
+        try:
+            info_hash, = query['info_hash']
+            peer_id, = query['peer_id']
+            port = int(query['port'][0])
+            left = int(query['left'][0])
+        except (KeyError, ValueError):
+            return self._reply(request, {'failure reason': 'invalid announce'})
+        if len(info_hash) != 20 or len(peer_id) != 20:
+            return self._reply(request, {'failure reason': 'invalid info_hash or peer_id'})
+
+        ip = struct.unpack('!I', socket.inet_aton(request.remote or '127.0.0.1'))[0]
+        seeders, leechers, peers = self.announce(info_hash, peer_id, ip, port, left, query.get('event', [b''])[0])
+        return self._reply(request, {
+            'interval': self.interval,
+            'complete': seeders,
+            'incomplete': leechers,
+            'peers': b''.join(struct.pack('!IH', ip, port) for ip, port in peers),
+        })
+
+    async def handle_scrape(self, request: web.Request) -> web.Response:
+        self.scrapes += 1
+        files = {}
+        for info_hash in self._query(request).get('info_hash', []):
+            seeders, completed, leechers = self.scrape(info_hash)
+            files[info_hash] = {'complete': seeders, 'downloaded': completed, 'incomplete': leechers}
+        return self._reply(request, {'files': files})
+
+
+class _UDPMockProtocol(asyncio.DatagramProtocol):
+    """ BEP 15 side of the mock tracker.  Any connection id it handed out is accepted, they never expire """
+    protocol_id: int = 0x41727101980
+
+    def __init__(self, tracker: MockTracker):
+        self.tracker = tracker
+        self.transport = None
+        self.connection_ids = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def _error(self, tx_id: int, message: str, addr):
+        self.transport.sendto(struct.pack('>ii', 3, tx_id) + message.encode(), addr)
+
+    def datagram_received(self, data, addr):
+        if len(data) < 16:
+            return
+        conn_id, action, tx_id = struct.unpack('>qii', data[:16])
+        if action == 0:
+            if conn_id != self.protocol_id:
+                return
+            conn_id = random.randint(-2 ** 63, 2 ** 63 - 1)
+            self.connection_ids.add(conn_id)
+            self.transport.sendto(struct.pack('>iiq', 0, tx_id, conn_id), addr)
+        elif conn_id not in self.connection_ids:
+            self._error(tx_id, 'unknown connection id', addr)
+        elif action == 1 and len(data) >= 98:
+            info_hash, peer_id, _, left, _, event, ip, _, _, port = struct.unpack('>20s20sqqqiIIiH', data[16:98])
+            ip = ip or struct.unpack('!I', socket.inet_aton(addr[0]))[0]
+            seeders, leechers, peers = self.tracker.announce(info_hash, peer_id, ip, port, left, EVENTS.get(event))
+            self.transport.sendto(struct.pack('>iiiii', 1, tx_id, self.tracker.interval, leechers, seeders)
+                                  + b''.join(struct.pack('!IH', ip, port) for ip, port in peers), addr)
+        elif action == 2:
+            self.tracker.scrapes += 1
+            info_hashes = [data[i:i + 20] for i in range(16, len(data) - 19, 20)]
+            self.transport.sendto(struct.pack('>ii', 2, tx_id) + b''.join(
+                struct.pack('>iii', *self.tracker.scrape(info_hash)) for info_hash in info_hashes), addr)
+        else:
+            self._error(tx_id, 'invalid request', addr)
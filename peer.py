@@ -1,15 +1,26 @@
 import asyncio
-import time
+import socket
+import struct
 
+import clock
+import event_log
+import metrics
 from session import Session
 from file import File, BlockRequest
 from messages import *
 from bitarray import bitarray
+from rate_limiter import LIMITED_READ_SIZE
+from uploader import Uploader
+from utils import allowed_fast_set, bencode, bdecode, BDecodeError
+from pex import PeerExchange, UT_PEX_ID
+from dht import DHTNode
 
 # Constants
 MAX_BUFFER = 64 * 1024  # 64 kb
 DEAD_TIMEOUT = 2 * 60  # 2 minutes
 HANDSHAKE_WAIT = 15  # seconds
+ALLOWED_FAST_COUNT = 10  # Size of the allowed fast set we give fast extension peers
+CLIENT_VERSION = 'python-bittorrent 0.1'
 
 
 class Peer:
@@ -19,13 +30,21 @@ class Peer:
 
     host: int = 0
     port: int = 0
+    listen_port: int = 0  # Port the peer accepts connections on, 0 if unknown
+    outgoing: bool = False  # We dialed them
 
     reader: asyncio.StreamReader = None
     writer: asyncio.StreamWriter = None
     last_response: float = 0
+    connected_at: float = 0
+    last_piece: float = 0  # Last time the peer sent us a block we requested
 
     session: Session = None
     file: File = None
+    uploader: Uploader = None
+    peer_exchange: PeerExchange = None
+    dht: DHTNode = None  # Set if the DHT is enabled
+    seeder = None  # Told when the peer becomes interested, so it can be unchoked without waiting for a rechoke
 
     num_pending = 0
     pending_requests: list[BlockRequest] = []  # Sent requests awaiting response
@@ -36,28 +55,83 @@ class Peer:
     _peer_choking = True
     _peer_interested = False
 
+    # Fast Extension (BEP 6)
+    fast_extension: bool = False  # True if both sides support it
+    allowed_fast_in: set[int] = set()  # Pieces we may request while they choke us
+    allowed_fast_out: set[int] = set()  # Pieces they may request while we choke them
+    suggested_pieces: set[int] = set()
+
+    # Extension Protocol (BEP 10)
+    extension_protocol: bool = False
+    extension_ids: dict[str, int] = {}  # Maps extension name -> id the peer wants it sent with
+
     def __init__(self, my_id: str, reader: asyncio.StreamReader = None, writer: asyncio.StreamWriter = None):
         self.reader = reader
         self.writer = writer
         self.my_id = my_id
+        self.pending_requests = []
+        self.allowed_fast_in = set()
+        self.allowed_fast_out = set()
+        self.suggested_pieces = set()
+        self.extension_ids = {}
 
-    async def handshake(self):
+    async def handshake(self, their_handshake: bytes = None):
+        """ their_handshake is passed in when it was already read to find out which torrent the peer wants """
         try:
-            msg = Handshake.tobytes(self.file.info_hash, self.my_id)
+            extensions = [Handshake.FastExtension, Handshake.ExtensionProtocol]
+            if self.dht:
+                extensions.append(Handshake.DHT)
+            reserved = Handshake.reserved_bytes(*extensions)
+            msg = Handshake.tobytes(self.file.info_hash, self.my_id, reserved)
             self.writer.write(msg)
-            self.buffer += await asyncio.wait_for(self.reader.readexactly(Handshake.length), HANDSHAKE_WAIT)
-            self.their_id = Handshake.validate(self.buffer, self.file.info_hash)
-            self.send_bitfield()
+            if their_handshake is None:
+                their_handshake = await asyncio.wait_for(self.reader.readexactly(Handshake.length), HANDSHAKE_WAIT)
+            self.buffer += their_handshake
+            self.their_id, their_reserved = Handshake.validate(self.buffer, self.file.info_hash)
+            self.buffer = b''
+            self.fast_extension = Handshake.supports(their_reserved, Handshake.FastExtension)
+            self.extension_protocol = Handshake.supports(their_reserved, Handshake.ExtensionProtocol)
+            self.send_initial_state()
+            if self.extension_protocol:
+                self.send_extension_handshake()
+            if self.dht and Handshake.supports(their_reserved, Handshake.DHT):
+                self.writer.write(bytes(Message.new(MsgID.Port, port=self.dht.port)))
             return True
-        except (asyncio.TimeoutError, MessageParsingError):
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, MessageParsingError):
             return False
 
+    def send_initial_state(self):
+        if not self.fast_extension:
+            self.send_bitfield()
+            return
+
+        if self.file.is_complete():
+            self.writer.write(bytes(HaveAll()))
+        elif not self.file.pieces_completed:
+            self.writer.write(bytes(HaveNone()))
+        else:
+            self.send_bitfield()
+
+        # Lets a new peer start downloading before it is unchoked
+        self.allowed_fast_out = set(allowed_fast_set(self.host, self.file.info_hash, self.file.total_pieces,
+                                                     ALLOWED_FAST_COUNT))
+        for piece in self.allowed_fast_out:
+            self.writer.write(bytes(Message.new(MsgID.AllowedFast, piece=piece)))
+
     async def run(self):
         """ The main running-loop"""
+        download_limit = self.session.peer_download_limits[self.their_id]
         while self.session.active:
             try:
-                self.buffer += await asyncio.wait_for(self.reader.read(MAX_BUFFER), HANDSHAKE_WAIT)
-                self.last_response = time.time()
+                read_size = LIMITED_READ_SIZE if download_limit.limited() else MAX_BUFFER
+                async with asyncio.timeout(HANDSHAKE_WAIT):  # Unlike wait_for, doesn't wrap each read in a task
+                    data = await self.reader.read(read_size)
+                if not data:
+                    return  # Connection closed
+                self.last_response = clock.now()
+                # Pay for what was read before reading again.  Not reading lets TCP flow control slow the peer down.
+                await download_limit.consume(len(data))
+                self.buffer += data
 
                 while self.buffer:
                     msg, self.buffer = Message.parse_first(self.buffer)
@@ -67,36 +141,76 @@ class Peer:
                 # When the end of a message is clipped. The rest might come through on next read
                 pass
             except MessageParsingError:
-                return  # TODO: LOG
+                event_log.event('peer', 'protocol_error', self.their_id, self.session.label)
+                return
             except asyncio.TimeoutError:
+                # Also what a transport failure can look like, TimeoutError is asyncio.TimeoutError since 3.11.  Every
+                # read would raise it again straight away, so give up rather than spin.
+                if (error := self.reader.exception()) is not None:
+                    event_log.event('peer', 'error', self.their_id, self.session.label, error=error)
+                    return
                 if not self.connection_alive():
+                    event_log.event('peer', 'dead', self.their_id, self.session.label)
                     return
-            except:
-                # For any unknown error.  # TODO: LOG
+            except asyncio.CancelledError:
+                event_log.event('peer', 'cancelled', self.their_id, self.session.label)
+                raise
+            except Exception as e:
+                event_log.event('peer', 'error', self.their_id, self.session.label, error=e)
                 return
             finally:
                 self.refresh()
 
     def connection_alive(self):
-        return time.time() - self.last_response < DEAD_TIMEOUT
+        return clock.now() - self.last_response < DEAD_TIMEOUT
 
     def return_block_requests(self):
         for req in self.pending_requests:
             req.successful = False
+            req.completed_by = self.their_id
             self.completed_requests.put_nowait(req)
         self.pending_requests = []
+        self.num_pending = 0
+
+    def notify_downloader(self):
+        # Tells the downloader this peer may be able to take more requests.
+        if (not self.peer_choking or self.allowed_fast_in) and self.their_id in self.session.interesting:
+            self.completed_requests.put_nowait(self.their_id)
+
+    def _pop_pending(self, piece: int, begin: int, length: int):
+        """ Removes & returns the matching pending request, None if there isn't one """
+        try:
+            req_pos = self.pending_requests.index(BlockRequest(piece, begin, length))
+        except ValueError:
+            return None
+        self.num_pending -= 1
+        return self.pending_requests.pop(req_pos)
+
+    def send_buffer_size(self) -> int:
+        """ Bytes written to the peer that haven't gone out yet, 0 if the transport doesn't say """
+        transport = getattr(self.writer, 'transport', None)
+        return transport.get_write_buffer_size() if transport else 0
 
     def terminate(self):
         self.writer.close()
+        self.uploader.drop_peer(self.their_id)
         self.session.terminate_peer(self.their_id)
         self.return_block_requests()
 
     def check_if_interesting(self):
-        if self.session.owned_pieces[self.their_id].intersection(self.file.incomplete_pieces):
+        interesting = bool(self.session.owned_pieces[self.their_id].intersection(self.file.incomplete_pieces))
+        if interesting:
             self.session.interesting.add(self.their_id)
         else:
-            if self.their_id in self.session.interesting:
-                self.session.interesting.remove(self.their_id)
+            self.session.interesting.discard(self.their_id)
+        if interesting != self.am_interested:
+            # Peers only unchoke us once they know we're interested
+            self.am_interested = interesting
+        self.update_available()
+
+    def update_available(self):
+        available = (not self.peer_choking or bool(self.allowed_fast_in)) and self.their_id in self.session.interesting
+        self.session.set_available(self.their_id, available)
 
     def handle_message(self, msg: Message):
         if msg.id == MsgID.KeepAlive:
@@ -113,35 +227,87 @@ class Peer:
         elif msg.id == MsgID.Have:
             self.session.add_piece_owner(self.their_id, msg.piece)
             self.check_if_interesting()
+            self.notify_downloader()
         elif msg.id == MsgID.Bitfield:
             bitarr = bitarray(endian='big')
             bitarr.frombytes(msg.bitfield)
-            bitarr = bitarr.tolist(as_ints=True)
+            bitarr = [int(bit) for bit in bitarr]  # tolist() gives bools or ints depending on the bitarray version
             self.session.register_bitfield(self.their_id, bitarr)
             self.check_if_interesting()
+            self.notify_downloader()
 
         elif msg.id == MsgID.Piece:
-            req_pos = self.pending_requests.index(BlockRequest(msg.piece, msg.begin, len(msg.block)))
-            if req_pos >= 0:
-                req = self.pending_requests.pop(req_pos)
-                req.data = msg.block
-                req.successful = True
-                req.completed_by = self.their_id
-                self.completed_requests.put_nowait(req)
-            # if req_pos < 0, ignore.  Indicates delayed response to an expired request
+            req = self._pop_pending(msg.piece, msg.begin, len(msg.block))
+            if req is None:
+                # Ignore.  Indicates delayed response to an expired request
+                return
+            self.last_piece = clock.now()
+            metrics.REQUEST_LATENCY.observe(self.last_piece - req.sent_at, self.session.label)
+            self.session.record_download(self.their_id, len(msg.block))
+            req.data = msg.block
+            req.successful = True
+            req.completed_by = self.their_id
+            self.completed_requests.put_nowait(req)
 
         elif msg.id == MsgID.Request:
-            # Currently responds to all requests, no specific algo.
-            if not self.am_choking and self.file.have_block(msg.piece, msg.begin, msg.block_length):
-                block = self.file.get_block(msg.piece, msg.begin, msg.block_length)
-                self.send_piece(msg.piece, msg.begin, block)
+            # Queued & served fairly by the uploader, dropped if we are choking them.
+            if not self.uploader.enqueue(self, msg.piece, msg.begin, msg.block_length):
+                self.send_reject(msg.piece, msg.begin, msg.block_length)
 
         elif msg.id == MsgID.Cancel:
-            # Not useable atm
-            pass
+            self.uploader.cancel(self.their_id, msg.piece, msg.begin, msg.block_length)
         elif msg.id == MsgID.Port:
-            # DHT not supported
-            pass
+            # Port of the peer's DHT node
+            if self.dht and msg.port:
+                self.dht.add_contact(socket.inet_ntoa(struct.pack("!I", self.host)), msg.port)
+        elif msg.id == MsgID.Extended:
+            if not self.extension_protocol:
+                raise MessageParsingError()
+            if msg.ext_id == 0:
+                self.handle_extension_handshake(msg.payload)
+            elif msg.ext_id == UT_PEX_ID and self.peer_exchange:
+                self.peer_exchange.handle_message(self, msg.payload)
+            # Ignore extensions we didn't advertise
+
+        elif not self.fast_extension:
+            # Fast extension messages are only valid if it was negotiated
+            raise MessageParsingError()
+        elif msg.id == MsgID.HaveAll:
+            self.session.register_bitfield(self.their_id, [1] * self.file.total_pieces)
+            self.check_if_interesting()
+            self.notify_downloader()
+        elif msg.id == MsgID.HaveNone:
+            pass  # Nothing to register
+        elif msg.id == MsgID.RejectRequest:
+            # Hand the block straight back instead of waiting for it to expire
+            req = self._pop_pending(msg.piece, msg.begin, msg.block_length)
+            if req:
+                req.successful = False
+                req.completed_by = self.their_id
+                self.completed_requests.put_nowait(req)
+        elif msg.id == MsgID.SuggestPiece:
+            self.suggested_pieces.add(msg.piece)
+        elif msg.id == MsgID.AllowedFast:
+            self.allowed_fast_in.add(msg.piece)
+            self.update_available()
+            self.notify_downloader()
+
+    def handle_extension_handshake(self, payload: bytes):
+        try:
+            data, _ = bdecode(payload)
+        except BDecodeError:
+            raise MessageParsingError()
+        if not isinstance(data, dict):
+            raise MessageParsingError()
+
+        # An id of 0 disables the extension
+        for name, ext_id in data.get('m', {}).items():
+            if isinstance(ext_id, int) and ext_id > 0:
+                self.extension_ids[name] = ext_id
+            else:
+                self.extension_ids.pop(name, None)
+        if isinstance(data.get('p'), int):
+            self.listen_port = data['p']
 
     def refresh(self):
         for req in self.pending_requests[:]:
@@ -186,13 +352,43 @@ class Peer:
         self.pending_requests.append(req)
         self.writer.write(bytes(msg))
 
+    def send_reject(self, piece: int, begin: int, length: int):
+        if self.fast_extension:
+            msg = Message.new(MsgID.RejectRequest, piece=piece, begin=begin, block_length=length)
+            self.writer.write(bytes(msg))
+
+    def send_suggestions(self):
+        # Point the peer at pieces we have recently read, they are cheap to serve
+        for piece in self.uploader.hot_pieces:
+            if piece not in self.session.owned_pieces[self.their_id]:
+                self.writer.write(bytes(Message.new(MsgID.SuggestPiece, piece=piece)))
+
+    def send_extension_handshake(self):
+        payload = {
+            'm': {'ut_pex': UT_PEX_ID},
+            'p': self.session.listen_port,
+            'v': CLIENT_VERSION,
+        }
+        self.writer.write(bytes(Message.new(MsgID.Extended, ext_id=0, payload=bencode(payload))))
+
+    def send_extended(self, name: str, payload: bytes):
+        if name in self.extension_ids:
+            msg = Message.new(MsgID.Extended, ext_id=self.extension_ids[name], payload=payload)
+            self.writer.write(bytes(msg))
+
     def send_bitfield(self):
         bitstring = ''.join(str(field) for field in self.file.bitfield)
         bitfield = bitarray(bitstring).tobytes()
         msg = Message.new(MsgID.Bitfield, **{"bitfield": bitfield})
         self.writer.write(bytes(msg))
 
-    def send_piece(self, piece: int, begin: int, block: bytes):
+    async def send_piece(self, piece: int, begin: int, block: bytes):
+        upload_limit = self.session.peer_upload_limits.get(self.their_id)
+        if upload_limit is None:
+            return  # Disconnected
+        await upload_limit.consume(len(block))
+        if (self.am_choking and piece not in self.allowed_fast_out) or self.writer.is_closing():
+            return  # Choked or disconnected while waiting for bandwidth
         kwargs = {
             'piece': piece,
             'begin': begin,
@@ -200,6 +396,8 @@ class Peer:
         }
         msg = Message.new(MsgID.Piece, **kwargs)
         self.writer.write(bytes(msg))
+        self.session.record_upload(self.their_id, len(block))
+        await self.writer.drain()
 
     @property
     def am_choking(self):
@@ -207,8 +405,17 @@ class Peer:
 
     @am_choking.setter
     def am_choking(self, value):
-        self.send_choke(value)
+        changed = value != self._am_choking
+        if changed:
+            self.send_choke(value)
+            metrics.CHOKES.inc(self.session.label, 'sent', 'choke' if value else 'unchoke')
         self._am_choking = value
+        if value:
+            # Choked peers' requests are discarded, fast extension peers are told which ones
+            for piece, begin, length in self.uploader.choke_peer(self):
+                self.send_reject(piece, begin, length)
+        elif changed and self.fast_extension:
+            self.send_suggestions()
 
     @property
     def am_interested(self):
@@ -225,12 +432,19 @@ class Peer:
 
     @peer_choking.setter
     def peer_choking(self, choked):
+        if choked != self._peer_choking:
+            metrics.CHOKES.inc(self.session.label, 'received', 'choke' if choked else 'unchoke')
+        self._peer_choking = choked
         if choked:
             self.session.am_choked(self.their_id)
-            self.return_block_requests()
+            if not self.fast_extension:
+                # Choking implicitly rejects our requests.  Fast extension peers reject them explicitly instead.
+                self.return_block_requests()
         else:
             self.session.am_unchoked(self.their_id)
-        self._peer_choking = choked
+        self.update_available()
+        if not choked:
+            self.notify_downloader()
 
     @property
     def peer_interested(self):
@@ -238,5 +452,8 @@ class Peer:
 
     @peer_interested.setter
     def peer_interested(self, value):
+        became_interested = value and not self._peer_interested
         self._peer_interested = value
+        if became_interested and self.seeder:
+            self.seeder.peer_interested(self)
 
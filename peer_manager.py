@@ -1,13 +1,82 @@
+import heapq
 import ipaddress
 import socket
 import struct
+import sys
 
+import clock
+import event_log
 from peer import Peer
 import asyncio
 from session import Session
+from utp import UTPSocketManager
 
 
-REQUEST_TIMEOUT = 60
+DIAL_TIMEOUT = 10
+UTP_HEAD_START = 0.5  # uTP is tried first, TCP races it after this unless we know which one the address takes
+DIAL_INTERVAL = 1  # Seconds between dial rounds when nothing else wakes the dialer
+MAX_HALF_OPEN = 8  # Max number of connection attempts in flight at once
+
+# Failed addresses are retried after BACKOFF_BASE * 2^(failures - 1) seconds, capped at MAX_BACKOFF.
+BACKOFF_BASE = 30
+MAX_BACKOFF = 60 * 60
+MAX_DIAL_FAILURES = 8  # Addresses are forgotten after this many failures in a row
+MAX_CANDIDATES = 2000  # New addresses past this are ignored, stops PEX floods from growing the table forever
+
+TRANSPORT_TCP = 'tcp'
+TRANSPORT_UTP = 'utp'
+
+# Every CHURN_INTERVAL seconds, up to CHURN_FRACTION of the connections which have been open for at least
+# CHURN_MIN_AGE seconds are replaced if they are the slowest and there are other addresses to try.
+CHURN_INTERVAL = 30
+CHURN_MIN_AGE = 60
+CHURN_FRACTION = 0.1
+
+
+def _close_connection(attempt: asyncio.Future):
+    if not attempt.cancelled() and attempt.exception() is None:
+        attempt.result()[1].close()
+
+
+class PeerCandidate:
+    """ Dial bookkeeping for an address we know about but aren't necessarily connected to """
+    addr: tuple[int, int] = None
+
+    failures: int = 0
+    next_attempt: float = 0.0
+    last_seen: float = 0.0
+    download_rate: float = 0.0  # Rate achieved the last time we were connected
+    transport: str = None  # TRANSPORT_TCP or TRANSPORT_UTP once a dial got through, redials go straight to it
+
+    def __init__(self, addr: tuple[int, int]):
+        self.addr = addr
+        self.last_seen = clock.now()
+
+    def priority(self):
+        # Lowest value is dialed first: previously fast peers, then recently seen ones.
+        return -self.download_rate, -self.last_seen
+
+    def dial_failed(self):
+        self.failures += 1
+        self.next_attempt = clock.now() + min(BACKOFF_BASE * 2 ** (self.failures - 1), MAX_BACKOFF)
+
+    def dial_succeeded(self):
+        self.failures = 0
+        self.next_attempt = 0.0
+
+
+class ConnectionBudget:
+    """ Connection slots shared by every torrent of an engine, on top of each torrent's own limit """
+    max_connections: int = 0  # 0 for no limit
+    count: int = 0
+
+    def __init__(self, max_connections: int = 0):
+        self.max_connections = max_connections
+
+    def available(self) -> int:
+        if not self.max_connections:
+            return sys.maxsize
+        return max(0, self.max_connections - self.count)
 
 
 class PeerManager:
@@ -16,113 +85,388 @@ class PeerManager:
 
     blacklisted_peers: set[tuple[int, int]] = []
     connected_addrs: set[tuple[int, int]] = []
+    dialing_addrs: set[tuple[int, int]] = []
+    candidates: dict[tuple[int, int], PeerCandidate] = {}
 
     peers: dict[str, Peer] = {}
     peer_tasks: dict[str, asyncio.Task] = {}
+    dial_tasks: set[asyncio.Task] = set()
 
     session: Session = None
-    server = None
+    budget: ConnectionBudget = None
+    # Handed to every Peer this manager creates
+    file = None
+    uploader = None
+    completed_requests: asyncio.Queue = None
+    peer_exchange = None
+    dht = None
+    seeder = None
+    downloader = None  # Told when a peer disconnects
+
+    server = None  # None when an engine accepts connections for us
+    utp: UTPSocketManager = None  # Shares the listening port number with the TCP server when enabled
+    enable_utp: bool = True
+    dialer_task: asyncio.Task = None
+    optimizer_task: asyncio.Task = None
+    dialer_wakeup: asyncio.Event = None
 
     peer_count = 0
 
     max_connections = 35
     min_connections = 25
 
-    def __init__(self, my_id, session):
+    def __init__(self, my_id, session, budget: ConnectionBudget = None, port: int = None):
         self.my_id = my_id
         self.session = session
+        self.file = session.file
+        self.budget = budget or ConnectionBudget()
+        if port is not None:
+            self.port = port
+        self.session.listen_port = self.port
 
-    async def _cold_connect_peer(self, ip: int, port: int):
+        self.blacklisted_peers = set()
+        self.connected_addrs = set()
+        self.dialing_addrs = set()
+        self.candidates = {}
+        self.peers = {}
+        self.peer_tasks = {}
+        self.dial_tasks = set()
+        self.dialer_wakeup = asyncio.Event()
+
+    async def _open_connection(self, host: str, port: int, transport: str = None):
+        """ Returns (reader, writer, transport).  Without a known transport uTP & TCP race, uTP with a head start """
+        # Peer works the same over either transport, prefer uTP as it yields to other traffic on the link.
+        if not self.utp or transport == TRANSPORT_TCP:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), DIAL_TIMEOUT)
+            return reader, writer, TRANSPORT_TCP
+        if transport == TRANSPORT_UTP:
+            reader, writer = await asyncio.wait_for(self.utp.connect(host, port), DIAL_TIMEOUT)
+            return reader, writer, TRANSPORT_UTP
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + DIAL_TIMEOUT
+        attempts = {asyncio.ensure_future(self.utp.connect(host, port)): TRANSPORT_UTP}
+        tcp_started = False
+        try:
+            while attempts:
+                timeout = deadline - loop.time() if tcp_started else UTP_HEAD_START
+                done, _ = await asyncio.wait(attempts, timeout=max(0.0, timeout),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    name = attempts.pop(attempt)
+                    if attempt.exception() is None:
+                        return (*attempt.result(), name)
+                if not tcp_started:
+                    # uTP is slow or failed, the peer may only take TCP
+                    tcp_started = True
+                    attempts[asyncio.ensure_future(asyncio.open_connection(host, port))] = TRANSPORT_TCP
+                elif not done:
+                    raise asyncio.TimeoutError()
+            raise ConnectionError('uTP & TCP both failed')
+        finally:
+            for attempt in attempts:
+                # The loser, close its connection if it got one
+                attempt.cancel()
+                attempt.add_done_callback(_close_connection)
+
+    async def _cold_connect_peer(self, candidate: PeerCandidate):
+        ip, port = candidate.addr
+        host = socket.inet_ntoa(struct.pack("!I", ip))
         try:
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection(socket.inet_ntoa(struct.pack("!I", ip)), port), REQUEST_TIMEOUT)
+            reader, writer, candidate.transport = await self._open_connection(host, port, candidate.transport)
 
-            peer = Peer(self.my_id, reader, writer)
+            peer = self._new_peer(reader, writer)
+            peer.host, peer.port = ip, port
+            peer.listen_port = port
+            peer.outgoing = True
             if await peer.handshake():
                 # Successfully connected to peer
                 return peer
+            writer.close()
         except asyncio.TimeoutError:
-            # Log timeouts
-            pass
+            event_log.event('dial', 'timeout', torrent=self.session.label, addr=f'{host}:{port}')
         except Exception as e:
-            # Unknown errors # TODO: LOg
-            pass
+            event_log.event('dial', 'failed', torrent=self.session.label, addr=f'{host}:{port}', error=e)
         return None
 
-    async def _start_peer(self, peer: Peer):
-        try:
-            self.peers[peer.their_id] = peer
-            self.peer_count += 1
+    def _new_peer(self, reader, writer) -> Peer:
+        peer = Peer(self.my_id, reader, writer)
+        peer.session = self.session
+        peer.file = self.file
+        peer.uploader = self.uploader
+        peer.completed_requests = self.completed_requests
+        peer.peer_exchange = self.peer_exchange
+        peer.dht = self.dht
+        peer.seeder = self.seeder
+        return peer
 
+    def _at_capacity(self) -> bool:
+        return self.peer_count >= self.max_connections or not self.budget.available()
+
+    def _replaces(self, peer: Peer) -> bool:
+        """
+        True if a newly handshaken peer should replace our other connection to them.  When both ends dial each other
+        at once, e.g. after learning of each other from the same PEX round, each end would otherwise close the
+        connection it opened last & both die.  Both ends keep the connection opened by the lower peer_id instead.
+        """
+        existing = self.peers.get(peer.their_id)
+        if existing is None or existing.outgoing == peer.outgoing:
+            return False
+        return (self.my_id < peer.their_id) == peer.outgoing
+
+    def _start_peer(self, peer: Peer):
+        """
+        Registers the peer straight after its handshake, without awaiting in between, so a second connection which
+        handshakes in the same tick already sees its their_id taken.
+        """
+        self.session.add_peer(peer.their_id)
+        self.peers[peer.their_id] = peer
+        self.connected_addrs.add((peer.host, peer.port))
+        self.peer_count += 1
+        self.budget.count += 1
+        peer.connected_at = clock.now()
+        self.peer_tasks[peer.their_id] = asyncio.ensure_future(self._run_peer(peer))
+
+    async def _run_peer(self, peer: Peer):
+        try:
             await peer.run()
-        except:
-            pass  # TODO: Log
+        except asyncio.CancelledError:
+            event_log.event('peer', 'task_cancelled', peer.their_id, self.session.label, active=self.session.active)
+            raise
+        except Exception as e:
+            event_log.event('peer', 'error', peer.their_id, self.session.label, error=e)
         finally:
             # If here peer terminated
             self.terminate_peer(peer)
 
-    async def handle_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        if self.peer_count == self.max_connections:
+    async def handle_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                          their_handshake: bytes = None):
+        """ their_handshake is set when an engine already read it to route the connection here """
+        if self._at_capacity():
             writer.close()
             return
 
-        addr = writer.get_extra_info('peername')  # 0 -> ip (str), 1->port (int)
-        addr[0] = ipaddress.IPv4Address(addr[0])  # convert string ip to int.
+        host, port = writer.get_extra_info('peername')[:2]  # 0 -> ip (str), 1->port (int)
+        addr = (int(ipaddress.IPv4Address(host)), port)  # convert string ip to int.
 
-        if addr in self.blacklisted_peers:
+        if addr in self.blacklisted_peers or addr in self.connected_addrs:
             writer.close()
             return
 
-        peer = Peer(self.my_id, reader, writer)
-        if not await peer.handshake():
+        peer = self._new_peer(reader, writer)
+        peer.host, peer.port = addr
+        if not await peer.handshake(their_handshake):
+            writer.close()
             return
+        if self._replaces(peer):
+            self.terminate_peer(self.peers[peer.their_id])
+        elif peer.their_id in self.peers:
+            # A second connection to a peer we're already connected to
+            writer.close()
+            return
+
+        self._start_peer(peer)
 
-        self.peer_tasks[peer.their_id] = asyncio.ensure_future(self._start_peer(peer))
+    def ban_peer(self, peer_id: str):
+        # Ban peers which sent us corrupt data
+        if peer_id in self.peers:
+            peer = self.peers[peer_id]
+            self.blacklisted_peers.add((peer.host, peer.port))
+            self.candidates.pop((peer.host, peer.port), None)
+            self.terminate_peer(peer)
 
     def terminate_peer(self, peer: Peer):
+        if self.peers.get(peer.their_id) is not peer:
+            return  # Already terminated, or replaced by another connection to the same peer
+
+        addr = (peer.host, peer.port)
+        if addr in self.candidates and peer.their_id in self.session.peer_download_rates:
+            # Remember how useful this peer was, so it is preferred if we redial.
+            self.candidates[addr].download_rate = self.session.peer_download_rates[peer.their_id].rate()
+
         peer.terminate()
         del self.peers[peer.their_id]
-        del self.peer_tasks[peer.their_id]
-        self.connected_addrs.remove((peer.host, peer.port))
+        if self.downloader:
+            self.downloader.drop_peer(peer.their_id)
+        task = self.peer_tasks.pop(peer.their_id, None)
+        if task and task is not asyncio.current_task():
+            task.cancel()
+        self.connected_addrs.discard(addr)
         self.peer_count -= 1
-
+        self.budget.count -= 1
+        # Free slot -> top up connections
+        self.dialer_wakeup.set()
 
     async def start_server(self):
         # Can take ports in the range 6881-6889 so switch ports if exception
         self.server = await asyncio.start_server(
             self.handle_conn, port=self.port)
-        self.session.active = True
+        if self.enable_utp:
+            self.utp = UTPSocketManager(self.handle_conn)
+            await self.utp.start(self.port)
         await self.server.start_serving()
-        self.session.active = False
+        self.start()
+
+    def start(self):
+        """ Starts dialing & churning connections.  Incoming connections are up to start_server or an engine """
+        self.session.active = True
+        self.dialer_task = asyncio.ensure_future(self.run_dialer())
+        self.optimizer_task = asyncio.ensure_future(self.run_optimizer())
 
     def connect_to_peers(self, peer_addrs: list[tuple[int, int]]):
-        if self.peer_count >= self.max_connections:
+        """ Queues addresses for the dialer, which connects to them in the background """
+        now = clock.now()
+        for addr in peer_addrs:
+            if addr in self.blacklisted_peers:
+                continue
+            if addr in self.candidates:
+                self.candidates[addr].last_seen = now
+            elif len(self.candidates) < MAX_CANDIDATES:
+                self.candidates[addr] = PeerCandidate(addr)
+        self.dialer_wakeup.set()
+
+    def forget_peers(self, peer_addrs: list[tuple[int, int]]):
+        """
+        Drops addresses another peer has disconnected from, they may well have left the swarm.  Only hearsay goes:
+        addresses we are connected or dialing to, or have connected to before, are kept.
+        """
+        for addr in peer_addrs:
+            candidate = self.candidates.get(addr)
+            if (candidate is not None and candidate.transport is None and addr not in self.connected_addrs
+                    and addr not in self.dialing_addrs):
+                del self.candidates[addr]
+
+    def outstanding_requests(self) -> int:
+        return sum(peer.num_pending for peer in self.peers.values())
+
+    def send_buffer_size(self) -> int:
+        return sum(peer.send_buffer_size() for peer in self.peers.values())
+
+    def needs_peers(self) -> bool:
+        """ True when below min_connections with no addresses left to dial """
+        if self.peer_count >= self.min_connections:
+            return False
+        now = clock.now()
+        return not any(candidate.next_attempt <= now and addr not in self.connected_addrs
+                       and addr not in self.dialing_addrs for addr, candidate in self.candidates.items())
+
+    def _dial_targets(self, count: int) -> list[PeerCandidate]:
+        """ Returns up to count of the highest priority addresses that can be dialed right now """
+        now = clock.now()
+        ready = [candidate for addr, candidate in self.candidates.items()
+                 if candidate.next_attempt <= now and addr not in self.connected_addrs
+                 and addr not in self.dialing_addrs]
+        return heapq.nsmallest(count, ready, key=PeerCandidate.priority)
+
+    async def _dial(self, candidate: PeerCandidate):
+        self.dialing_addrs.add(candidate.addr)
+        try:
+            peer = await self._cold_connect_peer(candidate)
+        finally:
+            self.dialing_addrs.discard(candidate.addr)
+
+        if peer is None:
+            candidate.dial_failed()
+            if candidate.failures >= MAX_DIAL_FAILURES:
+                del self.candidates[candidate.addr]
+        elif self.session.active and self._replaces(peer):
+            self.terminate_peer(self.peers[peer.their_id])
+            candidate.dial_succeeded()
+            self._start_peer(peer)
+        elif peer.their_id in self.peers or self._at_capacity() or not self.session.active:
+            # Already connected to them via another address, or the slots filled up while handshaking.  Not a
+            # failure, but don't redial straight away either
+            peer.writer.close()
+            candidate.next_attempt = clock.now() + BACKOFF_BASE
+        else:
+            candidate.dial_succeeded()
+            self._start_peer(peer)
+        self.dialer_wakeup.set()
+
+    async def run_dialer(self):
+        """
+        Keeps the number of connections between min_connections and max_connections.  Below min_connections up to
+        MAX_HALF_OPEN dials run in parallel, above it only one at a time so idle slots fill up gradually.
+        """
+        while self.session.active:
+            open_slots = min(self.max_connections - self.peer_count, self.budget.available()) - len(self.dialing_addrs)
+            if self.peer_count < self.min_connections:
+                max_dials = MAX_HALF_OPEN - len(self.dialing_addrs)
+            else:
+                max_dials = 1 - len(self.dialing_addrs)
+
+            for candidate in self._dial_targets(min(open_slots, max_dials)):
+                task = asyncio.ensure_future(self._dial(candidate))
+                self.dial_tasks.add(task)
+                task.add_done_callback(self.dial_tasks.discard)
+
+            self.dialer_wakeup.clear()
+            try:
+                await asyncio.wait_for(self.dialer_wakeup.wait(), DIAL_INTERVAL)
+            except asyncio.TimeoutError:
+                # Check for addresses whose backoff expired
+                pass
+
+    def _useful_rate(self, peer: Peer) -> tuple[float, float]:
+        # Each peer's own RateMeter, never a meter shared between peers, else every peer ranks the same.  Equally
+        # slow peers, e.g. ones that never sent us a block, go oldest connection first.
+        return self.session.peer_download_rates[peer.their_id].rate(), peer.connected_at
+
+    def _pick_slowest(self, peers: list[Peer], count: int) -> list[Peer]:
+        return heapq.nsmallest(count, peers, key=self._useful_rate)
+
+    def replace_slowest_peers(self):
+        """ Drops the slowest connections so the dialer can replace them with untried addresses """
+        if self.peer_count < self.min_connections:
+            return  # Dialer is still filling empty slots
+
+        now = clock.now()
+        max_drops = max(1, int(self.peer_count * CHURN_FRACTION))
+        to_drop = len(self._dial_targets(max_drops))
+        if not to_drop:
+            return  # No one to replace them with
+
+        # Peers we are uploading to are left to the choker.
+        eligible = [peer for peer in self.peers.values()
+                    if now - peer.connected_at >= CHURN_MIN_AGE and peer.am_choking]
+        if not eligible:
             return
-        # Filter out connected and blacklisted peers
-        peer_addrs = set(peer_addrs).difference(self.blacklisted_peers).difference(self.connected_addrs)
-
-        if peer_addrs:
-            peer_addrs = peer_addrs[:self.max_connections]
-            # Connect to peer & handshake
-            pending_peers = asyncio.gather(*[self._cold_connect_peer(ip, port) for ip, port in peer_addrs])
-            loop = asyncio.get_event_loop()
-            peers = loop.run_until_complete(pending_peers)
-
-            for peer_pos in range(len(peers)):
-                peer = peers[peer_pos]
-                # Failed connection / handshake -> peer == None
-                if peer:
-                    self.connected_addrs.add((peer.host, peer.port))
-                    # Run the peer
-                    self.peer_tasks[peer.their_id] = asyncio.ensure_future(self._start_peer(peer))
-                else:
-                    # Port & ip were bad, ban future connections
-                    self.blacklisted_peers.add(peer_addrs[peer_pos])
+
+        # Drop seeds and leechers in proportion to their share of the eligible peers to keep the ratio intact.
+        seeds = [peer for peer in eligible
+                 if len(self.session.owned_pieces[peer.their_id]) == self.session.file.total_pieces]
+        leechers = [peer for peer in eligible
+                    if len(self.session.owned_pieces[peer.their_id]) != self.session.file.total_pieces]
+        seed_drops = round(to_drop * len(seeds) / len(eligible))
+
+        for peer in self._pick_slowest(seeds, seed_drops) + self._pick_slowest(leechers, to_drop - seed_drops):
+            addr = (peer.host, peer.port)
+            if addr in self.candidates:
+                # Don't immediately redial the peer we just dropped.
+                self.candidates[addr].next_attempt = now + BACKOFF_BASE
+            self.terminate_peer(peer)
+
+    async def run_optimizer(self):
+        while self.session.active:
+            await asyncio.sleep(CHURN_INTERVAL)
+            self.replace_slowest_peers()
 
     async def shutdown(self):
-        for task in self.peer_tasks.values():
+        if self.dialer_task:
+            self.dialer_task.cancel()
+        if self.optimizer_task:
+            self.optimizer_task.cancel()
+        tasks = list(self.dial_tasks) + list(self.peer_tasks.values())
+        for task in tasks:
             task.cancel()
-        if self.peer_tasks:
-            await asyncio.wait(self.peer_tasks.values())
-        self.server.close()
-        await self.server.wait_closed()
\ No newline at end of file
+        if tasks:
+            await asyncio.wait(tasks)
+        for peer in list(self.peers.values()):
+            # Cancelled before their task got to run
+            self.terminate_peer(peer)
+        if self.server:
+            # The sockets are only ours to close if start_server opened them
+            if self.utp:
+                self.utp.close()
+            self.server.close()
+            await self.server.wait_closed()
@@ -0,0 +1,97 @@
+# Peer Exchange (ut_pex) over the extension protocol (BEP 10 & BEP 11).
+# Connected peers periodically tell each other which peers they have connected to/dropped since the last message,
+# so the swarm can grow without going through the tracker.
+import asyncio
+import struct
+
+import clock
+import event_log
+from session import Session
+from utils import bencode, bdecode, BDecodeError
+
+UT_PEX_ID = 1  # The id we assign ut_pex in our extension handshake
+PEX_INTERVAL = 60  # Seconds between our PEX messages
+PEX_MIN_INTERVAL = 45  # PEX messages received more often than this from one peer are ignored
+MAX_PEX_PEERS = 50  # Max added/dropped peers per message
+
+
+def encode_peers(addrs: list[tuple[int, int]]) -> bytes:
+    return b''.join(struct.pack("!IH", ip, port) for ip, port in addrs)
+
+
+def decode_peers(data: bytes) -> list[tuple[int, int]]:
+    # ip == 4 bytes,  port == 2 bytes -> each peer is 6 bytes of data
+    if len(data) % 6:
+        raise ValueError()
+    return list(struct.iter_unpack("!IH", data))  # List[(ip: int, port: int)]
+
+
+class PeerExchange:
+    peer_manager = None  # PeerManager, not imported to avoid an import cycle through Peer
+    session: Session = None
+
+    advertised: set[tuple[int, int]] = set()  # Addresses included in the last round of messages
+    advertised_to: set[str] = set()  # Peers which have been sent the full list of advertised addresses
+    last_received: dict[str, float] = {}  # Maps peer_id -> time their last PEX message was accepted
+
+    def __init__(self, peer_manager, session: Session):
+        self.peer_manager = peer_manager
+        self.session = session
+        self.advertised = set()
+        self.advertised_to = set()
+        self.last_received = {}
+
+    def handle_message(self, peer, payload: bytes):
+        """ Feeds the peers added by a ut_pex message to the dialer & forgets the ones it dropped """
+        now = clock.now()
+        # -inf, not 0, so a peer's first message is accepted however early in the clock it arrives
+        if now - self.last_received.get(peer.their_id, float('-inf')) < PEX_MIN_INTERVAL:
+            return  # Flooding us, ignore
+        self.last_received[peer.their_id] = now
+
+        try:
+            data, _ = bdecode(payload)
+            if not isinstance(data, dict):
+                raise ValueError()
+            added, dropped = data.get('added', b''), data.get('dropped', b'')
+            if not isinstance(added, bytes) or not isinstance(dropped, bytes):
+                raise ValueError()
+            added, dropped = decode_peers(added), decode_peers(dropped)
+        except (BDecodeError, ValueError):
+            event_log.event('pex', 'malformed', peer.their_id, self.session.label)
+            return
+
+        # connect_to_peers takes care of duplicates & blacklisted addresses
+        self.peer_manager.connect_to_peers(added[:MAX_PEX_PEERS])
+        self.peer_manager.forget_peers(dropped[:MAX_PEX_PEERS])
+
+    def broadcast(self):
+        peers = self.peer_manager.peers
+        # Can only advertise peers whose listening port we know
+        current = {(peer.host, peer.listen_port) for peer in peers.values() if peer.listen_port}
+        added = list(current - self.advertised)[:MAX_PEX_PEERS]
+        dropped = list(self.advertised - current)[:MAX_PEX_PEERS]
+
+        self.advertised_to &= peers.keys()
+        self.last_received = {peer_id: t for peer_id, t in self.last_received.items() if peer_id in peers}
+
+        for peer in peers.values():
+            if 'ut_pex' not in peer.extension_ids:
+                continue
+            own_addr = (peer.host, peer.listen_port)
+            if peer.their_id in self.advertised_to:
+                msg = {'added': encode_peers([addr for addr in added if addr != own_addr]),
+                       'dropped': encode_peers(dropped)}
+            else:
+                # First message to this peer, send everyone we know about
+                full = [addr for addr in (self.advertised | set(added)) if addr != own_addr][:MAX_PEX_PEERS]
+                msg = {'added': encode_peers(full), 'dropped': b''}
+                self.advertised_to.add(peer.their_id)
+            peer.send_extended('ut_pex', bencode(msg))
+
+        self.advertised = (self.advertised - set(dropped)) | set(added)
+
+    async def run(self):
+        while self.session.active:
+            await asyncio.sleep(PEX_INTERVAL)
+            self.broadcast()
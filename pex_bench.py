@@ -0,0 +1,122 @@
+# Tracker-less swarm on loopback where peers can only find each other through PEX.  The torrent's announce url has a
+# scheme no client supports & the DHT is off, so the only address a leecher is given is the node before it in a
+# chain: leecher 0 knows the seeder, leecher i knows leecher i - 1.  The rest of the swarm has to come in over ut_pex.
+# Checks every node learns every other node's address & every leecher ends up with the seeder's exact data.
+#
+#   python pex_bench.py --leechers 8 --size 16MiB --pex-interval 1
+#
+# Prints one JSON object.
+import argparse
+import asyncio
+import hashlib
+import ipaddress
+import json
+import os
+import tempfile
+import time
+
+import bootstrap
+import pex
+from shard_bench import make_torrents
+from swarm_bench import _Node, parse_size
+
+NO_TRACKER = 'wss://tracker.invalid/announce'  # Unsupported, the torrent starts without an announcer
+LOOPBACK = int(ipaddress.IPv4Address('127.0.0.1'))
+SAMPLE_INTERVAL = 0.5
+
+
+def _known_addrs(node: _Node) -> set[tuple[int, int]]:
+    """ Listening addresses a node has learned, whether it is connected to them or not """
+    peer_manager = node.torrent.peer_manager
+    if peer_manager is None:
+        return set()
+    known = set(peer_manager.candidates)
+    known.update((peer.host, peer.listen_port) for peer in peer_manager.peers.values() if peer.listen_port)
+    return known
+
+
+def _file_digest(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+async def bench(args) -> dict:
+    # Short intervals so the chain spreads within seconds rather than minutes
+    pex.PEX_INTERVAL = args.pex_interval
+    pex.PEX_MIN_INTERVAL = args.pex_interval / 2
+
+    with tempfile.TemporaryDirectory() as directory:
+        (metainfo_path, _), = make_torrents(directory, 1, args.size, args.piece_size, NO_TRACKER)
+        seeder = _Node('-OH0001-S00000000000', directory, 0, 0)
+        leechers = []
+        for i in range(args.leechers):
+            leecher_dir = os.path.join(directory, f'leecher{i}')
+            os.mkdir(leecher_dir)
+            leechers.append(_Node(f'-OH0001-L{i:011d}', leecher_dir, 0, 0))
+
+        await seeder.start(metainfo_path)
+        start = time.perf_counter()
+        await asyncio.gather(*[node.start(metainfo_path) for node in leechers])
+        if any(node.torrent.announcer for node in [seeder] + leechers):
+            raise RuntimeError('Torrent has a tracker, the run would not show PEX at work')
+        chain = [seeder] + leechers
+        for previous, node in zip(chain, leechers):
+            node.torrent.peer_manager.connect_to_peers([(LOOPBACK, previous.port)])
+
+        everyone = {(LOOPBACK, node.port) for node in chain}
+        discovered_at = None
+        while time.perf_counter() - start < args.timeout:
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            now = time.perf_counter() - start
+            if discovered_at is None and all(everyone - {(LOOPBACK, node.port)} <= _known_addrs(node)
+                                             for node in chain):
+                discovered_at = now
+            for node in leechers:
+                if node.completed_at is None and node.is_complete():
+                    node.completed_at = now
+            if discovered_at is not None and all(node.completed_at is not None for node in leechers):
+                break
+
+        elapsed = time.perf_counter() - start
+        known = [len(_known_addrs(node) & everyone) for node in chain]
+        connections = [node.torrent.peer_manager.peer_count for node in chain]
+        for node in chain:
+            await node.shutdown()
+
+        name = os.path.basename(metainfo_path)[:-len('.torrent')]
+        expected = _file_digest(os.path.join(directory, name))
+        intact = sum(1 for i, node in enumerate(leechers) if node.completed_at is not None
+                     and _file_digest(os.path.join(directory, f'leecher{i}', name)) == expected)
+
+    completion_times = [node.completed_at for node in leechers if node.completed_at is not None]
+    return {
+        'leechers': args.leechers,
+        'size': args.size,
+        'pex_interval': args.pex_interval,
+        'discovered': discovered_at is not None,
+        'discovery_seconds': round(discovered_at, 2) if discovered_at is not None else None,
+        'known_min': min(known),  # Out of leechers + 1, a node's own address included
+        'connections_min': min(connections),
+        'completed': len(completion_times),
+        'intact': intact,
+        'completion_max': round(max(completion_times), 2) if completion_times else None,
+        'seconds': round(elapsed, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tracker-less PEX discovery on loopback')
+    parser.add_argument('--leechers', type=int, default=6)
+    parser.add_argument('--size', type=parse_size, default=8 * 2 ** 20, help='File size, e.g. 16MiB')
+    parser.add_argument('--piece-size', type=parse_size, default=2 ** 18)
+    parser.add_argument('--pex-interval', type=float, default=1, help='Seconds between PEX messages')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--loop', default=bootstrap.LOOP_AUTO)
+    args = parser.parse_args()
+    args.loop = bootstrap.resolve_loop(args.loop)
+
+    print(json.dumps(bootstrap.run(bench(args), args.loop)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
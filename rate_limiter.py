@@ -0,0 +1,81 @@
+# Hierarchical token buckets used to cap upload & download bandwidth.
+# Buckets are chained peer -> torrent -> global and a transfer has to be paid for at every level.
+import asyncio
+
+import clock
+
+BURST_TIME = 0.1  # Seconds worth of tokens a bucket can bank, keeps the output smooth
+MIN_BURST = 2 ** 14  # Always allow at least one block through without waiting
+LIMITED_READ_SIZE = 2 ** 14  # Read size used when a download limit applies, smaller reads -> smoother throughput
+
+
+class TokenBucket:
+    """
+    Token bucket which may go into debt.  A transfer always takes its tokens straight away and the caller then sleeps
+    until the debt has been paid off, so waiters never poll and are served in the order they arrived.
+    """
+    rate: float = 0  # Bytes per second, 0 means unlimited
+    capacity: float = 0
+    tokens: float = 0
+    last_update: float = 0.0
+    parent: 'TokenBucket' = None
+
+    def __init__(self, rate: float = 0, parent: 'TokenBucket' = None):
+        self.parent = parent
+        self.last_update = clock.now()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float):
+        """ Can be called at any time, waits already in progress keep their old duration """
+        self._refill()
+        self.rate = rate
+        self.capacity = max(rate * BURST_TIME, MIN_BURST)
+        if not rate:
+            # Unlimited transfers don't pay, so drop any debt rather than charging it once a limit is set again
+            self.tokens = self.capacity
+        self.tokens = min(self.tokens, self.capacity)
+
+    def limited(self):
+        bucket = self
+        while bucket:
+            if bucket.rate:
+                return True
+            bucket = bucket.parent
+        return False
+
+    def _refill(self):
+        now = clock.now()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def _take(self, num_bytes: int) -> float:
+        """ Takes num_bytes from the bucket, returns how long to wait before they may be used """
+        if not self.rate:
+            return 0
+        self._refill()
+        self.tokens -= num_bytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    async def consume(self, num_bytes: int):
+        delay = 0
+        bucket = self
+        while bucket:
+            delay = max(delay, bucket._take(num_bytes))
+            bucket = bucket.parent
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class RateLimiter:
+    """ Global upload & download buckets shared by every torrent """
+    download: TokenBucket = None
+    upload: TokenBucket = None
+
+    def __init__(self, download_rate: float = 0, upload_rate: float = 0):
+        self.download = TokenBucket(download_rate)
+        self.upload = TokenBucket(upload_rate)
+
+    def set_limits(self, download_rate: float, upload_rate: float):
+        self.download.set_rate(download_rate)
+        self.upload.set_rate(upload_rate)
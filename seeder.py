@@ -1,70 +1,132 @@
 # Class that coordinates the distribution of downloaded pieces to other peers.
-# Employs optimistic choking to control upload rates
+# Employs tit-for-tat choking while downloading & upload rate based choking once seeding, see
+# http://bittorrent.org/bittorrentecon.pdf
 import random
 
+import clock
 from peer_manager import PeerManager
 from peer import Peer
 from session import Session
 import asyncio
 
 
-# TODO: Still needs anti-snubbing rules + upload-only seeding (when the download completes).
 class Seeder:
     peer_manager: PeerManager = None
     session: Session = None
 
-    current_unchoked: set[Peer] = []
+    current_unchoked: dict[str, Peer] = {}  # Maps peer_id -> peer, in the order they were unchoked
     optimistic_unchoke: Peer = None
+    unchoked_since: dict[str, float] = {}  # Maps peer_id -> time it was last unchoked
+    iteration: int = 0
 
     CHOKING_WAIT: int = 10
     OPTIMISTIC_UNCHOKE_RATE: int = 3
     MAX_UNCHOKED: int = 4
 
-    def __init__(self, peer_manager: PeerManager, session: Session):
+    SNUB_TIME: int = 60  # Peers which haven't sent us a block in this long are snubbing us
+    NEW_PEER_TIME: int = 60  # Peers connected for less than this are 3x as likely to be optimistically unchoked
+    NEW_PEER_WEIGHT: int = 3
+    SEED_ROTATION_TIME: int = 60  # When seeding, peers unchoked for longer than this make way for others
+
+    def __init__(self, peer_manager: PeerManager, session: Session, rng: random.Random = None):
         self.peer_manager = peer_manager
         self.session = session
+        self.rng = rng or random.Random()  # Seeded by the simulator so runs repeat
+
+        self.current_unchoked = {}
+        self.unchoked_since = {}
+
+    def snubbed(self, peer: Peer, now: float):
+        return now - max(peer.last_piece, peer.connected_at) > self.SNUB_TIME
+
+    def _held_slot_too_long(self, peer: Peer, now: float):
+        return peer.their_id in self.unchoked_since and now - self.unchoked_since[peer.their_id] > self.SEED_ROTATION_TIME
+
+    def _ranked_candidates(self, now: float) -> list[Peer]:
+        peers = list(self.peer_manager.peers.values())
+
+        if self.session.file.is_complete():
+            # Seeding: nothing to reciprocate, so prefer peers we can upload to fastest and rotate slots between them.
+            rates = self.session.peer_upload_rates
+            peers.sort(key=lambda p: (self._held_slot_too_long(p, now), -rates[p.their_id].rate()))
+        else:
+            # Leeching: tit-for-tat, reward peers which upload to us the fastest.  Snubbing peers only get
+            # optimistic unchokes.
+            rates = self.session.peer_download_rates
+            peers = [peer for peer in peers if not self.snubbed(peer, now)]
+            peers.sort(key=lambda p: rates[p.their_id].rate(), reverse=True)
+        return peers
+
+    def _choose_optimistic(self, unchoke: dict[str, Peer], now: float):
+        candidates = [peer for peer in self.peer_manager.peers.values()
+                      if peer.their_id not in unchoke and peer.peer_interested]
+        if not candidates:
+            return None
+
+        # Newly connected peers have nothing to offer yet, so give them a better chance of getting a first piece.
+        weights = [self.NEW_PEER_WEIGHT if now - peer.connected_at < self.NEW_PEER_TIME else 1
+                   for peer in candidates]
+        return self.rng.choices(candidates, weights=weights)[0]
+
+    def rechoke(self, now: float):
+        self.iteration += 1
+
+        # Unchoke peers in order until MAX_UNCHOKED interested peers have been unchoked.  Faster uninterested peers
+        # are unchoked too so they can start downloading as soon as they become interested.
+        # Dicts rather than sets of peers so the messages go out in the same order every run.
+        unchoke = {}
+        interested_count = 0
+        for candidate in self._ranked_candidates(now):
+            if interested_count == self.MAX_UNCHOKED:
+                break
+            unchoke[candidate.their_id] = candidate
+            if candidate.peer_interested:
+                interested_count += 1
+
+        optim_unchoke = self.optimistic_unchoke
+        if (self.iteration % self.OPTIMISTIC_UNCHOKE_RATE == 0 or optim_unchoke is None
+                or optim_unchoke.their_id in unchoke or optim_unchoke.their_id not in self.peer_manager.peers):
+            optim_unchoke = self._choose_optimistic(unchoke, now)
+        if optim_unchoke:
+            unchoke[optim_unchoke.their_id] = optim_unchoke
+
+        # Decided per peer object, a peer which reconnected under the same id starts choked whatever we last told
+        # its old connection.  Only peers whose state changes are messaged.
+        for peer_id, peer in unchoke.items():
+            if peer.am_choking:
+                peer.am_choking = False
+                self.unchoked_since[peer_id] = now
+
+        for peer_id, peer in self.current_unchoked.items():
+            if peer_id not in unchoke:
+                self.unchoked_since.pop(peer_id, None)
+            if (unchoke.get(peer_id) is not peer and self.peer_manager.peers.get(peer_id) is peer
+                    and not peer.am_choking):
+                peer.am_choking = True
+
+        self.optimistic_unchoke = optim_unchoke
+        self.current_unchoked = unchoke
+
+    def peer_interested(self, peer: Peer):
+        """
+        Called when a peer becomes interested.  If a regular slot is free it is unchoked straight away rather than
+        waiting up to CHOKING_WAIT for the next rechoke.
+        """
+        now = clock.now()
+        if not peer.am_choking:
+            return
+        if not self.session.file.is_complete() and self.snubbed(peer, now):
+            return
+        taken = sum(1 for peer_id, unchoked in self.current_unchoked.items()
+                    if unchoked.peer_interested and unchoked is not self.optimistic_unchoke
+                    and self.peer_manager.peers.get(peer_id) is unchoked)
+        if taken >= self.MAX_UNCHOKED:
+            return
+        peer.am_choking = False
+        self.current_unchoked[peer.their_id] = peer
+        self.unchoked_since[peer.their_id] = now
 
     async def run(self):
-        iteration = 1
-
         while self.session.active:
-            candidates = list(self.peer_manager.peers.values())
-            candidates.sort(key=lambda p: self.session.peer_download_rates[p.their_id].rate(), reverse=True)
-
-            unchoked_count = 0
-
-            unchoke = set()
-            #  Unchoke peers which have uploaded the most to us and are interested in downloading from us.
-            for candidate in candidates[:]:
-                if candidate.peer_interested:
-                    unchoke.add(candidate)
-                    unchoked_count += 1
-                    candidates.remove(candidate)
-                    if unchoked_count == self.MAX_UNCHOKED:
-                        break
-
-            # If len(unchoke) < 4, make up the difference.
-            # Ensures 4 peers unchoked at a time (excluding optimistic unchoke)
-            unchoke.update(candidates[:self.MAX_UNCHOKED - unchoked_count])
-            candidates = candidates[self.MAX_UNCHOKED - unchoked_count:]
-            optim_unchoke = None
-
-            if iteration % self.OPTIMISTIC_UNCHOKE_RATE == 0:
-                # Select optimistic unchoke
-                if candidates:
-                    # TODO: Increase weighting for new peers
-                    optim_unchoke = random.choice(candidates)
-
-            for peer in unchoke.union({optim_unchoke}) - self.current_unchoked.union({self.optimistic_unchoke}):
-                if peer:
-                    peer.am_choking = True
-
-            for peer in self.current_unchoked.union({self.optimistic_unchoke}) - unchoke.union({optim_unchoke}):
-                if peer:
-                    peer.am_choking = False
-
-            self.optimistic_unchoke = optim_unchoke
-            self.current_unchoked = unchoke
-
-            iteration += 1
+            self.rechoke(clock.now())
             await asyncio.sleep(self.CHOKING_WAIT)
@@ -1,52 +1,121 @@
-from utils import RollingAverage20, PieceTracker
+import metrics
+from utils import RateMeter, PieceTracker
 from file import File
+from rate_limiter import RateLimiter, TokenBucket
 
 
 class Session:
     active: bool = False
     file: File = None
+    listen_port: int = 0  # Port advertised to peers & trackers
+    label: str = ''  # Identifies the torrent in metrics, the info_hash in hex
 
     uploaded: int = 0
+    downloaded: int = 0
     piece_tracker: PieceTracker = None
-    peer_download_rates: dict[str, RollingAverage20] = {}  # TODO: Hook up to peer
+    peer_download_rates: dict[str, RateMeter] = {}
+    peer_upload_rates: dict[str, RateMeter] = {}
+    # Session-wide rates
+    download_rate: RateMeter = None
+    upload_rate: RateMeter = None
+
+    # Bandwidth caps.  Per-peer buckets draw from this torrent's buckets, which draw from the global ones.
+    download_limit: TokenBucket = None
+    upload_limit: TokenBucket = None
+    peer_download_limits: dict[str, TokenBucket] = {}
+    peer_upload_limits: dict[str, TokenBucket] = {}
 
     peers_unchoking: set[str] = set()
     interesting: set[str] = set()
+    # Interesting peers we can request from, they unchoke us or gave us allowed fast pieces.  Kept up to date by the
+    # peers so the downloader doesn't have to scan them.
+    available_peers: set[str] = set()
 
     num_file_pieces: int = 0
-    # Maps piece num -> peer owners
+    # Maps piece num -> peer owners, pieces nobody has announced have no entry
     piece_owners: dict[int, set[str]] = {}
     # Maps peer_id-> pieces owned
     owned_pieces: dict[str, set[int]] = {}
 
-    def __init__(self, file: File, piece_tracker: PieceTracker):
-        self.piece_owners = {i: set() for i in range(file.total_pieces)}
+    def __init__(self, file: File, piece_tracker: PieceTracker, rate_limiter: RateLimiter = None):
+        self.piece_owners = {}
+        self.owned_pieces = {}
+        self.peers_unchoking = set()
+        self.interesting = set()
+        self.available_peers = set()
         self.piece_tracker = piece_tracker
         self.file = file
+        self.label = file.info_hash.hex() if file.info_hash else ''
+        self.peer_download_rates = {}
+        self.peer_upload_rates = {}
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+
+        rate_limiter = rate_limiter or RateLimiter()
+        self.download_limit = TokenBucket(parent=rate_limiter.download)
+        self.upload_limit = TokenBucket(parent=rate_limiter.upload)
+        self.peer_download_limits = {}
+        self.peer_upload_limits = {}
 
     def terminate_peer(self, peer_id: str):
-        for piece, owners in self.piece_owners.items():
-            if peer_id in owners:
-                self.piece_owners[piece].remove(peer_id)
-                self.piece_tracker.update(self.piece_tracker.get_rarity(piece) - 1, piece)
+        for piece in self.owned_pieces[peer_id]:
+            owners = self.piece_owners[piece]
+            owners.remove(peer_id)
+            if not owners:
+                del self.piece_owners[piece]
+            self.piece_tracker.update(self.piece_tracker.get_rarity(piece) - 1, piece)
 
         del self.peer_download_rates[peer_id]
+        del self.peer_upload_rates[peer_id]
+        del self.peer_download_limits[peer_id]
+        del self.peer_upload_limits[peer_id]
         del self.owned_pieces[peer_id]
+        metrics.PEER_DOWNLOADED.remove(self.label, peer_id)
+        metrics.PEER_UPLOADED.remove(self.label, peer_id)
 
         if peer_id in self.interesting:
             self.interesting.remove(peer_id)
         if peer_id in self.peers_unchoking:
             self.peers_unchoking.remove(peer_id)
+        self.available_peers.discard(peer_id)
 
     def add_piece_owner(self, peer_id: str, piece: int):
+        if piece in self.owned_pieces[peer_id] or not 0 <= piece < self.file.total_pieces:
+            return  # Repeated or invalid Have
         self.owned_pieces[peer_id].add(piece)
-        self.piece_owners[piece].add(peer_id)
+        self.piece_owners.setdefault(piece, set()).add(peer_id)
         self.piece_tracker.update(self.piece_tracker.get_rarity(piece) + 1, piece)
 
     def add_peer(self, peer_id: str):
-        self.peer_download_rates[peer_id] = RollingAverage20()
+        self.peer_download_rates[peer_id] = RateMeter()
+        self.peer_upload_rates[peer_id] = RateMeter()
+        self.peer_download_limits[peer_id] = TokenBucket(parent=self.download_limit)
+        self.peer_upload_limits[peer_id] = TokenBucket(parent=self.upload_limit)
         self.owned_pieces[peer_id] = set()
 
+    def set_limits(self, download_rate: float, upload_rate: float):
+        """ Caps this torrent's bandwidth in bytes/sec, 0 for unlimited """
+        self.download_limit.set_rate(download_rate)
+        self.upload_limit.set_rate(upload_rate)
+
+    def set_peer_limits(self, peer_id: str, download_rate: float, upload_rate: float):
+        self.peer_download_limits[peer_id].set_rate(download_rate)
+        self.peer_upload_limits[peer_id].set_rate(upload_rate)
+
+    def record_download(self, peer_id: str, num_bytes: int):
+        self.downloaded += num_bytes
+        self.download_rate.record(num_bytes)
+        self.peer_download_rates[peer_id].record(num_bytes)
+        metrics.DOWNLOADED.add(num_bytes, self.label)
+        metrics.PEER_DOWNLOADED.add(num_bytes, self.label, peer_id)
+
+    def record_upload(self, peer_id: str, num_bytes: int):
+        self.uploaded += num_bytes
+        self.upload_rate.record(num_bytes)
+        self.peer_upload_rates[peer_id].record(num_bytes)
+        metrics.UPLOADED.add(num_bytes, self.label)
+        metrics.PEER_UPLOADED.add(num_bytes, self.label, peer_id)
+
     def am_unchoked(self, peer_id: str):
         self.peers_unchoking.add(peer_id)
 
@@ -54,9 +123,14 @@ class Session:
         if peer_id in self.peers_unchoking:
             self.peers_unchoking.remove(peer_id)
 
+    def set_available(self, peer_id: str, available: bool):
+        if available:
+            self.available_peers.add(peer_id)
+        else:
+            self.available_peers.discard(peer_id)
+
     def register_bitfield(self, peer_id: str, bitfield: list[int]):
-        interesting = False
-        for piece, have in enumerate(bitfield):
+        # Ignore the spare bits at the end of the last byte
+        for piece, have in enumerate(bitfield[:self.file.total_pieces]):
             if have:
-                interesting = interesting and self.add_piece_owner(peer_id, piece)
-        return interesting
\ No newline at end of file
+                self.add_piece_owner(peer_id, piece)
\ No newline at end of file
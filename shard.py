@@ -0,0 +1,313 @@
+# Runs torrents across several worker processes, each with its own event loop & Engine owning a shard of the
+# torrents.  The control process owns the listening port: it reads each incoming handshake and passes the socket
+# (SCM_RIGHTS) to the worker whose shard the info_hash belongs to.  Workers report their stats back periodically.
+import asyncio
+import multiprocessing
+import os
+import pickle
+import socket
+from collections import deque
+
+import bootstrap
+import event_log
+from engine import Engine, DEFAULT_PORT, MAX_CONNECTIONS, CACHE_SIZE
+from messages import Handshake, MessageParsingError
+from peer import HANDSHAKE_WAIT
+from utils import parse_metainfo
+
+STATS_INTERVAL = 1  # Seconds between worker stat reports
+MAX_CONTROL_MSG = 64 * 1024
+
+
+def shard_of(info_hash: bytes, num_shards: int) -> int:
+    return int.from_bytes(info_hash[:4], 'big') % num_shards
+
+
+class _Channel:
+    """
+    Message channel over a SOCK_SEQPACKET socket, so each message keeps its boundaries & can carry file descriptors.
+    Messages are pickled tuples.  What the socket buffer can't take is queued & sent once it is writable.
+    """
+    sock: socket.socket = None
+    on_message = None  # Called with (msg, fds)
+    pending: deque = deque()  # (data, fds) waiting for the socket, the fds are our own duplicates
+
+    def __init__(self, sock: socket.socket, on_message):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.on_message = on_message
+        self.pending = deque()
+
+    def start(self):
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._readable)
+
+    def close(self):
+        if self.sock.fileno() == -1:
+            return  # Already closed
+        try:
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(self.sock.fileno())
+            loop.remove_writer(self.sock.fileno())
+        except RuntimeError:
+            pass  # Loop already closed
+        while self.pending:
+            _, fds = self.pending.popleft()
+            for fd in fds:
+                os.close(fd)
+        self.sock.close()
+
+    def send(self, msg: tuple, fds: list[int] = ()):
+        """ Sends now if nothing is queued & the socket has room, the caller may close fds straight after """
+        data = pickle.dumps(msg)
+        if not self.pending:
+            try:
+                socket.send_fds(self.sock, [data], list(fds))
+                return
+            except (BlockingIOError, InterruptedError):
+                asyncio.get_running_loop().add_writer(self.sock.fileno(), self._writable)
+        self.pending.append((data, [os.dup(fd) for fd in fds]))
+
+    def _writable(self):
+        while self.pending:
+            data, fds = self.pending[0]
+            try:
+                socket.send_fds(self.sock, [data], fds)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self.close()  # Other side exited
+                return
+            self.pending.popleft()
+            for fd in fds:
+                os.close(fd)
+        asyncio.get_running_loop().remove_writer(self.sock.fileno())
+
+    def _readable(self):
+        while True:
+            try:
+                data, fds, _, _ = socket.recv_fds(self.sock, MAX_CONTROL_MSG, 1)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b''
+            if not data:
+                self.close()  # Other side exited
+                return
+            self.on_message(pickle.loads(data), fds)
+
+
+class _Worker:
+    """ Runs in each worker process """
+    shard: int = 0
+    sock: socket.socket = None
+    engine_args: dict = None
+    engine: Engine = None
+    channel: _Channel = None
+    done: asyncio.Event = None
+
+    def __init__(self, shard: int, sock: socket.socket, engine_args: dict):
+        self.shard = shard
+        self.sock = sock
+        self.engine_args = engine_args
+
+    def _handle_message(self, msg: tuple, fds: list[int]):
+        command, *args = msg
+        if command == 'conn':
+            handshake, = args
+            asyncio.ensure_future(self._accept(fds[0], handshake))
+        elif command == 'add':
+            metainfo_path, info_hash = args
+            asyncio.ensure_future(self._add_torrent(metainfo_path, info_hash))
+        elif command == 'remove':
+            info_hash, = args
+            asyncio.ensure_future(self.engine.remove_torrent(info_hash))
+        elif command == 'limits':
+            self.engine.set_limits(*args)
+        elif command == 'stop':
+            self.done.set()
+
+    async def _add_torrent(self, metainfo_path: str, info_hash: bytes):
+        """ Starts a torrent, telling the control process if it can't be added """
+        try:
+            torrent = self.engine.add_torrent(metainfo_path)
+        except ValueError as e:
+            if info_hash not in self.engine.torrents:  # Else the torrent was already added from another path
+                self.channel.send(('add_failed', info_hash, metainfo_path, repr(e)))
+            return
+        try:
+            await torrent.start()
+        except OSError as e:
+            await self.engine.remove_torrent(info_hash)
+            self.channel.send(('add_failed', info_hash, metainfo_path, repr(e)))
+
+    async def _accept(self, fd: int, handshake: bytes):
+        sock = socket.socket(fileno=fd)
+        try:
+            reader, writer = await asyncio.open_connection(sock=sock)
+        except OSError:
+            sock.close()
+            return
+        await self.engine.dispatch(reader, writer, handshake)
+
+    async def run(self):
+        self.done = asyncio.Event()
+        self.engine = Engine(**self.engine_args)
+        await self.engine.start(listen=False)
+        self.channel = _Channel(self.sock, self._handle_message)
+        self.channel.start()
+        try:
+            while not self.done.is_set():
+                self.channel.send(('stats', self.shard, self.engine.stats()))
+                try:
+                    await asyncio.wait_for(self.done.wait(), STATS_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.engine.shutdown()
+            self.channel.close()
+
+
+def _worker_main(shard: int, sock: socket.socket, engine_args: dict, loop: str):
+    bootstrap.run(_Worker(shard, sock, engine_args).run(), loop)
+
+
+class ShardedEngine:
+    """
+    Control process of a multi-process engine.  Same interface as Engine for adding torrents & limits, connection
+    and cache limits apply per worker.
+    """
+    my_id: str = ''
+    port: int = DEFAULT_PORT
+    num_workers: int = 0
+    loop: str = bootstrap.LOOP_AUTO  # Event loop used by the workers
+
+    workers: list[multiprocessing.Process] = []
+    channels: list[_Channel] = []
+    shard_stats: list[dict] = []  # Last stats reported by each worker
+    info_hashes: set[bytes] = set()  # Torrents in any shard, connections for others are dropped straight away
+    failed: dict[bytes, str] = {}  # Maps info_hash -> why a worker couldn't add it
+
+    server: socket.socket = None
+    accept_task: asyncio.Task = None
+
+    def __init__(self, my_id: str, download_dir: str, port: int = DEFAULT_PORT, num_workers: int = None,
+                 max_connections: int = MAX_CONNECTIONS, cache_size: int = CACHE_SIZE,
+                 loop: str = bootstrap.LOOP_AUTO):
+        self.my_id = my_id
+        self.port = port
+        self.loop = bootstrap.resolve_loop(loop)
+        self.num_workers = num_workers or os.cpu_count()
+        self.engine_args = {
+            'my_id': my_id,
+            'download_dir': download_dir,
+            'port': port,  # Advertised port, the workers don't listen on it
+            'max_connections': max_connections,
+            'cache_size': cache_size,
+        }
+        self.workers = []
+        self.channels = []
+        self.shard_stats = [{} for _ in range(self.num_workers)]
+        self.info_hashes = set()
+        self.failed = {}
+
+    async def start(self):
+        self.server = socket.create_server(('', self.port), backlog=1024)
+        self.server.setblocking(False)
+        self.port = self.engine_args['port'] = self.server.getsockname()[1]
+
+        context = multiprocessing.get_context('spawn')
+        for shard in range(self.num_workers):
+            ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            worker = context.Process(target=_worker_main, args=(shard, theirs, self.engine_args, self.loop),
+                                     daemon=True)
+            worker.start()
+            theirs.close()
+            channel = _Channel(ours, self._handle_message)
+            channel.start()
+            self.workers.append(worker)
+            self.channels.append(channel)
+
+        self.accept_task = asyncio.ensure_future(self._accept_loop())
+
+    def _handle_message(self, msg: tuple, fds: list[int]):
+        command, *args = msg
+        if command == 'stats':
+            shard, stats = args
+            self.shard_stats[shard] = stats
+        elif command == 'add_failed':
+            info_hash, metainfo_path, error = args
+            self.info_hashes.discard(info_hash)
+            self.failed[info_hash] = error
+            event_log.event('shard', 'add_failed', torrent=info_hash.hex(), path=metainfo_path, error=error)
+
+    def add_torrent(self, metainfo_path: str) -> bytes:
+        parsed = parse_metainfo(metainfo_path)
+        if parsed is None:
+            raise ValueError(f'Invalid metainfo file: {metainfo_path}')
+        _, info_hash = parsed
+        self.info_hashes.add(info_hash)
+        self.failed.pop(info_hash, None)
+        self.channels[shard_of(info_hash, self.num_workers)].send(('add', os.path.abspath(metainfo_path), info_hash))
+        return info_hash
+
+    def remove_torrent(self, info_hash: bytes):
+        self.info_hashes.discard(info_hash)
+        self.channels[shard_of(info_hash, self.num_workers)].send(('remove', info_hash))
+
+    def set_limits(self, download_rate: float, upload_rate: float):
+        """ Global limits in bytes/sec, split evenly between the workers """
+        for channel in self.channels:
+            channel.send(('limits', download_rate / self.num_workers, upload_rate / self.num_workers))
+
+    def stats(self) -> dict:
+        """ Sum of the latest stats of every shard """
+        total = {}
+        for stats in self.shard_stats:
+            for key, value in stats.items():
+                total[key] = total.get(key, 0) + value
+        return total
+
+    async def _accept_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, _ = await loop.sock_accept(self.server)
+            asyncio.ensure_future(self._route(conn))
+
+    async def _read_handshake(self, conn: socket.socket) -> bytes:
+        # Read exactly the handshake, anything the peer sent after it stays in the socket for the worker
+        loop = asyncio.get_running_loop()
+        handshake = b''
+        while len(handshake) < Handshake.length:
+            data = await loop.sock_recv(conn, Handshake.length - len(handshake))
+            if not data:
+                raise asyncio.IncompleteReadError(handshake, Handshake.length)
+            handshake += data
+        return handshake
+
+    async def _route(self, conn: socket.socket):
+        try:
+            handshake = await asyncio.wait_for(self._read_handshake(conn), HANDSHAKE_WAIT)
+            info_hash = Handshake.info_hash(handshake)
+            if info_hash in self.info_hashes:
+                self.channels[shard_of(info_hash, self.num_workers)].send(('conn', handshake), [conn.fileno()])
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, MessageParsingError, OSError) as e:
+            event_log.event('shard', 'route_failed', error=e)
+        finally:
+            # The worker has its own copy of the socket
+            conn.close()
+
+    async def shutdown(self):
+        if self.accept_task:
+            self.accept_task.cancel()
+        if self.server:
+            self.server.close()
+        for channel in self.channels:
+            try:
+                channel.send(('stop',))
+            except OSError:
+                pass  # Worker already gone
+        loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            await loop.run_in_executor(None, worker.join)
+        for channel in self.channels:
+            channel.close()
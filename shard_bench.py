@@ -0,0 +1,159 @@
+# Loopback benchmark for the sharded engine.  Seeds synthetic torrents from 1, 2, 4.. worker processes and measures
+# how fast a set of client processes can pull blocks from them.  Clients use the fast extension's allowed fast pieces
+# so they can download without waiting to be unchoked.
+#
+#   python shard_bench.py --workers 1 2 4 --duration 10
+#
+# Prints one JSON object per worker count.
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+import bootstrap
+from messages import Handshake, Message, MsgID, IncompleteMessage
+from shard import ShardedEngine
+from utils import bencode
+
+PIECE_SIZE = 2 ** 18
+BLOCK_SIZE = 2 ** 14
+PIPELINE = 32  # Requests kept in flight per connection
+
+
+def make_torrents(directory: str, count: int, size: int, piece_size: int = PIECE_SIZE,
+                  announce: str = 'http://127.0.0.1:9/announce') -> list[tuple[str, bytes]]:
+    """
+    Writes count random files & their metainfo, returns [(metainfo path, info_hash)].  By default nothing is listening
+    on the announce url, announces just fail
+    """
+    torrents = []
+    for i in range(count):
+        data = os.urandom(size)
+        name = f'bench{i}.bin'
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+        info = {
+            'name': name,
+            'length': size,
+            'piece length': piece_size,
+            'pieces': b''.join(hashlib.sha1(data[j:j + piece_size]).digest() for j in range(0, size, piece_size)),
+        }
+        metainfo_path = os.path.join(directory, name + '.torrent')
+        with open(metainfo_path, 'wb') as f:
+            f.write(bencode({'announce': announce, 'info': info}))
+        torrents.append((metainfo_path, hashlib.sha1(bencode(info)).digest()))
+    return torrents
+
+
+async def _download(port: int, info_hash: bytes, peer_id: str, deadline: float) -> int:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(Handshake.tobytes(info_hash, peer_id, Handshake.reserved_bytes(Handshake.FastExtension)))
+    await reader.readexactly(Handshake.length)
+
+    allowed = []
+    received = 0
+    in_flight = 0
+    buffer = b''
+    try:
+        while time.time() < deadline:
+            buffer += await asyncio.wait_for(reader.read(2 ** 16), deadline - time.time())
+            while buffer:
+                try:
+                    msg, buffer = Message.parse_first(buffer)
+                except IncompleteMessage:
+                    break
+                if msg.id == MsgID.AllowedFast:
+                    allowed.append(msg.piece)
+                elif msg.id == MsgID.Piece:
+                    received += len(msg.block)
+                    in_flight -= 1
+                elif msg.id == MsgID.RejectRequest:
+                    in_flight -= 1
+
+            # Keep re-requesting the blocks of the allowed fast pieces
+            while allowed and in_flight < PIPELINE:
+                piece = allowed[(received // BLOCK_SIZE + in_flight) % len(allowed)]
+                begin = (in_flight * BLOCK_SIZE) % PIECE_SIZE
+                writer.write(bytes(Message.new(MsgID.Request, piece=piece, begin=begin, block_length=BLOCK_SIZE)))
+                in_flight += 1
+    except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+    return received
+
+
+def _client_main(port: int, info_hashes: list[bytes], connections: int, duration: float, client: int, results):
+    async def run():
+        deadline = time.time() + duration
+        peer_ids = [f'-BENCH-{client:04d}{i:09d}' for i in range(connections * len(info_hashes))]
+        coros = [_download(port, info_hash, peer_ids[i * len(info_hashes) + j], deadline)
+                 for i in range(connections) for j, info_hash in enumerate(info_hashes)]
+        return sum(r for r in await asyncio.gather(*coros, return_exceptions=True) if isinstance(r, int))
+    results.put(bootstrap.run(run()))
+
+
+async def bench(num_workers: int, torrents: list[tuple[str, bytes]], directory: str, clients: int,
+                connections: int, duration: float) -> dict:
+    engine = ShardedEngine('-OH0001-BENCHMARK000', directory, port=0, num_workers=num_workers)
+    await engine.start()
+    for metainfo_path, _ in torrents:
+        engine.add_torrent(metainfo_path)
+    while engine.stats().get('running', 0) < len(torrents):
+        await asyncio.sleep(0.1)
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    info_hashes = [info_hash for _, info_hash in torrents]
+    processes = [context.Process(target=_client_main,
+                                 args=(engine.port, info_hashes, connections, duration, i, results))
+                 for i in range(clients)]
+    start = time.time()
+    for process in processes:
+        process.start()
+    loop = asyncio.get_running_loop()
+    received = sum([await loop.run_in_executor(None, results.get) for _ in processes])
+    elapsed = time.time() - start
+    for process in processes:
+        process.join()
+    uploaded = engine.stats().get('uploaded', 0)
+    await engine.shutdown()
+
+    return {
+        'workers': num_workers,
+        'torrents': len(torrents),
+        'connections': clients * connections * len(torrents),
+        'seconds': round(elapsed, 2),
+        'bytes_received': received,
+        'bytes_uploaded': uploaded,
+        'throughput_mb_s': round(received / elapsed / 2 ** 20, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sharded engine loopback benchmark')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--torrents', type=int, default=16)
+    parser.add_argument('--size', type=int, default=8 * 2 ** 20, help='Bytes per torrent')
+    parser.add_argument('--clients', type=int, default=4, help='Client processes')
+    parser.add_argument('--connections', type=int, default=2, help='Connections per client per torrent')
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        torrents = make_torrents(directory, args.torrents, args.size)
+        baseline = None
+        for num_workers in args.workers:
+            result = bootstrap.run(bench(num_workers, torrents, directory, args.clients, args.connections,
+                                       args.duration))
+            baseline = baseline or result['throughput_mb_s'] / num_workers
+            result['scaling_efficiency'] = round(result['throughput_mb_s'] / (baseline * num_workers), 2)
+            print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,457 @@
+# Discrete-event simulation of a swarm, for comparing piece picking & choking policies.  Every virtual peer runs the
+# project's own PeerManager / Peer / Downloader / Uploader / Seeder, but on an event loop whose clock is virtual: when
+# nothing is ready to run the loop jumps straight to the next timer instead of sleeping.  Connections are in-memory
+# streams with modeled bandwidth & latency and the piece data is held once in memory, shared by every peer.  A run
+# is deterministic for a given --seed & PYTHONHASHSEED, --check-determinism verifies it by running each policy twice in
+# the same process & reporting whether the results match, wall clock timings aside.  The exit status is 1 if any differ.
+# Wall time grows a little faster than the number of leechers.  With the defaults on one core, 50 leechers take about
+# 6 seconds, 200 about 30 seconds & 1000 about 3.5 minutes.  So a thousand peers is the practical scale, and several
+# thousand means a run of tens of minutes.
+#
+#   python sim.py --seeders 5 --leechers 1000 --size 16MiB --picker rarest random --unchoke-slots 2 4 8
+#   PYTHONHASHSEED=0 python sim.py --seeders 2 --leechers 50 --check-determinism
+#
+# Prints one JSON object per (picker, unchoke slots) policy.
+import argparse
+import asyncio
+import gc
+import hashlib
+import itertools
+import json
+import math
+import random
+import selectors
+import socket
+import statistics
+import struct
+import sys
+import time
+
+import clock
+from downloader import Downloader
+from file import File
+from peer_manager import PeerManager, TRANSPORT_TCP
+from seeder import Seeder
+from session import Session
+from swarm_bench import parse_size
+from uploader import Uploader
+from utils import PieceTracker
+
+PORT = 6881
+TRACKER_PEERS = 50  # Addresses a node is given when it joins, as a tracker would
+ANNOUNCE_INTERVAL = 300  # Virtual seconds between a node's announces while it needs peers
+MAX_SEND_BACKLOG = 0.5  # Seconds of queued upload a writer's drain() lets through before blocking
+DELIVERY_TICK = 0.001  # Resolution of simulated arrival times, seconds
+GC_THRESHOLD = 10000  # Allocations between young generation collections while simulating
+WALL_CLOCK_FIELDS = ('wall_seconds', 'speedup')  # Differ between runs however deterministic the simulation is
+
+
+class SimulationStalled(Exception):
+    """ Nothing is left to run & no timer is pending, the virtual clock can't move """
+    pass
+
+
+class _VirtualSelector(selectors.BaseSelector):
+    """
+    Never touches a real file descriptor.  Waiting on it means nothing is ready to run, so rather than blocking it
+    moves the loop's clock forward to the next timer.
+    """
+    def __init__(self, loop: 'VirtualTimeLoop'):
+        self.loop = loop
+        self.keys = {}
+
+    def register(self, fileobj, events, data=None):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        key = selectors.SelectorKey(fileobj, fd, events, data)
+        self.keys[fd] = key
+        return key
+
+    def unregister(self, fileobj):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        return self.keys.pop(fd)
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise SimulationStalled()
+        self.loop.virtual_time += timeout
+        return []
+
+    def get_map(self):
+        return self.keys
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """ An event loop whose time() only moves when every task is waiting.  Has no real I/O, only timers """
+    virtual_time: float = 0.0
+
+    def __init__(self):
+        self.virtual_time = 0.0
+        super().__init__(_VirtualSelector(self))
+
+    def time(self) -> float:
+        return self.virtual_time
+
+
+class _Capacity:
+    """ One direction of a node's link.  Transfers queue behind each other at rate bytes/sec, 0 for unlimited """
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.busy_until = 0.0
+
+    def transfer(self, start: float, size: int) -> float:
+        """ Returns the time the last byte is through """
+        if not self.rate:
+            return start
+        self.busy_until = max(self.busy_until, start) + size / self.rate
+        return self.busy_until
+
+
+def _tick(when: float) -> float:
+    """ Rounds a delivery time up to the next DELIVERY_TICK """
+    return math.ceil(when / DELIVERY_TICK) * DELIVERY_TICK
+
+
+class _Stream:
+    """
+    One direction of a simulated connection.  Data arriving within the same DELIVERY_TICK is delivered in one go, so
+    a burst of small messages wakes the receiver once & deliveries across the swarm share loop iterations.
+    """
+    def __init__(self, sender: 'SimNode', receiver: 'SimNode', reader: asyncio.StreamReader, latency: float):
+        self.sender = sender
+        self.receiver = receiver
+        self.reader = reader  # The receiving end's
+        self.latency = latency
+        self.last_arrival = 0.0
+        self.pending = None  # Data waiting for the latest scheduled delivery, at pending_at
+        self.pending_at = 0.0
+        self.eof = False
+        self.eof_pending = False  # EOF follows the latest delivery
+
+    def send(self, data: bytes):
+        loop = asyncio.get_running_loop()
+        sent = self.sender.upload.transfer(loop.time(), len(data))
+        arrival = self.receiver.download.transfer(sent + self.latency, len(data))
+        # Delivered in order, like TCP
+        self.last_arrival = max(arrival, self.last_arrival)
+        when = _tick(self.last_arrival)
+        if self.pending is not None and when == self.pending_at:
+            self.pending += data
+            return
+        self.pending, self.pending_at = bytearray(data), when
+        loop.call_at(when, self._deliver, self.pending)
+
+    def _deliver(self, data: bytearray):
+        latest = data is self.pending
+        if latest:
+            self.pending = None
+        if not self.eof:
+            self.sender.sent += len(data)
+            self.reader.feed_data(data)
+        if latest and self.eof_pending:
+            self.close(False)
+
+    def close(self, delay: bool = True):
+        """ EOF reaches the reader after the data already sent, or immediately when delay is False """
+        if delay:
+            loop = asyncio.get_running_loop()
+            when = _tick(max(self.last_arrival, loop.time() + self.latency))
+            if self.pending is not None and when == self.pending_at:
+                self.eof_pending = True
+            else:
+                loop.call_at(when, self.close, False)
+        elif not self.eof:
+            self.eof = True
+            self.reader.feed_eof()
+
+
+class SimWriter:
+    """ Stands in for asyncio.StreamWriter, writes go over the simulated network to the other end's reader """
+    def __init__(self, outgoing: _Stream, incoming: _Stream, peername: tuple[str, int]):
+        self.outgoing = outgoing
+        self.incoming = incoming
+        self.peername = peername
+        self.closed = False
+
+    def write(self, data: bytes):
+        if not self.closed and data:
+            self.outgoing.send(bytes(data))
+
+    def writelines(self, data):
+        self.write(b''.join(data))
+
+    async def drain(self):
+        # Like a full socket buffer, block while the node's uplink is backed up
+        loop = asyncio.get_running_loop()
+        backlog = self.outgoing.sender.upload.busy_until - loop.time()
+        if backlog > MAX_SEND_BACKLOG:
+            await asyncio.sleep(backlog - MAX_SEND_BACKLOG)
+        if self.closed:
+            raise ConnectionResetError()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.outgoing.close()
+        self.incoming.close(delay=False)
+        self.outgoing.peer_writer.closed = True
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name: str, default=None):
+        return self.peername if name == 'peername' else default
+
+
+class SimFile(File):
+    """ Piece data lives in one buffer shared by the whole swarm.  Nothing is written, verified data matches it """
+    def __init__(self, content: bytes, piece_size: int, piece_hashes: list[bytes]):
+        self.content = content
+        super().__init__('', len(content), piece_size, piece_hashes)
+
+    def _allocate(self, file_size: int):
+        pass
+
+    def _read(self, offset: int, length: int) -> bytes:
+        return self.content[offset:offset + length]
+
+    def _write(self, offset: int, data: bytes):
+        pass
+
+
+class SimPeerManager(PeerManager):
+    """ Dials other nodes over the simulated network """
+    node: 'SimNode' = None
+
+    async def _open_connection(self, host: str, port: int, transport: str = None):
+        reader, writer = await self.node.network.connect(self.node, host, port)
+        return reader, writer, TRANSPORT_TCP
+
+
+class RandomPicker(Downloader):
+    def pick_piece(self, peer_id: str, candidate_pieces: set[int]) -> int:
+        return random.choice(sorted(candidate_pieces))
+
+
+class SequentialPicker(Downloader):
+    def pick_piece(self, peer_id: str, candidate_pieces: set[int]) -> int:
+        return min(candidate_pieces)
+
+
+PICKERS = {'rarest': Downloader, 'random': RandomPicker, 'sequential': SequentialPicker}
+
+
+class SimNode:
+    """ One virtual peer, wired up like engine.Torrent.start() minus trackers, DHT & PEX """
+    def __init__(self, network: 'SimNetwork', index: int, file: SimFile, rate: float, latency: float,
+                 picker: type[Downloader], unchoke_slots: int, seed: int):
+        self.network = network
+        self.ip = socket.inet_ntoa(struct.pack('!I', (10 << 24) + index + 1))
+        self.addr = (struct.unpack('!I', socket.inet_aton(self.ip))[0], PORT)
+        self.latency = latency  # One way, to any other node
+        self.upload = _Capacity(rate)
+        self.download = _Capacity(rate)
+        self.sent = 0
+        self.file = file
+        self.started_at = None
+        self.completed_at = None
+        self.tasks = []
+
+        self.session = Session(file, PieceTracker(file.total_pieces))
+        self.peer_manager = SimPeerManager(f'-SM0001-{index:012d}', self.session, port=PORT)
+        self.peer_manager.node = self
+        self.uploader = Uploader(file, self.session)
+        completed_requests = asyncio.Queue()
+        self.peer_manager.uploader = self.uploader
+        self.peer_manager.completed_requests = completed_requests
+        self.downloader = picker(file, self.peer_manager, self.session, completed_requests)
+        self.peer_manager.downloader = self.downloader
+        self.seeder = Seeder(self.peer_manager, self.session, rng=random.Random(seed * 1000003 + index))
+        self.seeder.MAX_UNCHOKED = unchoke_slots
+        self.peer_manager.seeder = self.seeder
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.started_at = loop.time()
+        self.peer_manager.start()
+        self.tasks = [asyncio.ensure_future(self.uploader.run()), asyncio.ensure_future(self.seeder.run()),
+                      asyncio.ensure_future(self._announce())]
+        if not self.file.is_complete():
+            download = asyncio.ensure_future(self.downloader.run())
+            download.add_done_callback(self._download_done)
+            self.tasks.append(download)
+
+    def _download_done(self, _):
+        if self.file.is_complete():
+            self.completed_at = asyncio.get_running_loop().time()
+
+    async def _announce(self):
+        """ A tracker handing out random members of the swarm """
+        while self.session.active:
+            if not self.peer_manager.peer_count or self.peer_manager.needs_peers():
+                self.peer_manager.connect_to_peers(self.network.sample(self, TRACKER_PEERS))
+            await asyncio.sleep(ANNOUNCE_INTERVAL)
+
+    async def shutdown(self):
+        self.session.active = False
+        for task in self.tasks:
+            task.cancel()
+        await self.peer_manager.shutdown()
+
+
+class SimNetwork:
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self.nodes = {}  # Maps (ip, port) -> SimNode
+
+    def add(self, node: SimNode):
+        self.nodes[node.addr] = node
+
+    def sample(self, node: SimNode, count: int) -> list[tuple[int, int]]:
+        addrs = [addr for addr in self.nodes if addr != node.addr]
+        return self.rng.sample(addrs, min(count, len(addrs)))
+
+    async def connect(self, node: SimNode, host: str, port: int) -> tuple[asyncio.StreamReader, SimWriter]:
+        target = self.nodes.get((struct.unpack('!I', socket.inet_aton(host))[0], port))
+        latency = node.latency + (target.latency if target else 0)
+        await asyncio.sleep(latency)  # SYN
+        if target is None or not target.session.active:
+            await asyncio.sleep(latency)
+            raise ConnectionRefusedError()
+
+        reader, their_reader = asyncio.StreamReader(), asyncio.StreamReader()
+        outgoing = _Stream(node, target, their_reader, latency)
+        incoming = _Stream(target, node, reader, latency)
+        writer = SimWriter(outgoing, incoming, (target.ip, port))
+        their_writer = SimWriter(incoming, outgoing, (node.ip, PORT))
+        outgoing.peer_writer, incoming.peer_writer = their_writer, writer
+        asyncio.ensure_future(target.peer_manager.handle_conn(their_reader, their_writer))
+        await asyncio.sleep(latency)  # SYN-ACK
+        return reader, writer
+
+
+def jain_index(values: list[float]) -> float:
+    """ 1 when every value is equal, down to 1/n when one value takes everything """
+    total = sum(value * value for value in values)
+    return sum(values) ** 2 / (len(values) * total) if total else 1.0
+
+
+def make_content(size: int, piece_size: int, seed: int) -> tuple[bytes, list[bytes]]:
+    content = random.Random(seed).randbytes(size)
+    return content, [hashlib.sha1(content[i:i + piece_size]).digest() for i in range(0, size, piece_size)]
+
+
+async def simulate(args, picker: str, unchoke_slots: int) -> dict:
+    loop = asyncio.get_running_loop()
+    clock.set_source(loop.time)
+    random.seed(args.seed)  # The Downloader's endgame & the pickers use the module's generator
+    rng = random.Random(args.seed)
+    network = SimNetwork(rng)
+    content, piece_hashes = make_content(args.size, args.piece_size, args.seed)
+    info_hash = hashlib.sha1(b''.join(piece_hashes)).digest()
+
+    def node(index: int, complete: bool) -> SimNode:
+        file = SimFile(content, args.piece_size, piece_hashes)
+        file.info_hash = info_hash
+        if complete:
+            file.mark_complete(range(file.total_pieces))
+        return SimNode(network, index, file, args.rate, rng.uniform(*args.latency) / 2, PICKERS[picker],
+                       unchoke_slots, args.seed)
+
+    seeders = [node(i, True) for i in range(args.seeders)]
+    leechers = [node(args.seeders + i, False) for i in range(args.leechers)]
+    for member in seeders + leechers:
+        network.add(member)
+
+    # The nodes live for the whole run, keep the garbage collector from rescanning them.  Every message allocates
+    # short lived objects, so collect less often too.
+    gc.freeze()
+    thresholds = gc.get_threshold()
+    gc.set_threshold(GC_THRESHOLD, *thresholds[1:])
+    wall_start = time.perf_counter()
+    for member in seeders:
+        member.start()
+    for member in leechers:
+        # Leechers trickle in over the arrival window
+        loop.call_at(rng.uniform(0, args.arrival), member.start)
+
+    while loop.time() < args.max_time and not all(member.completed_at for member in leechers):
+        await asyncio.sleep(1)
+    virtual_seconds = loop.time()
+    wall_seconds = time.perf_counter() - wall_start
+
+    finished = [member for member in leechers if member.completed_at is not None]
+    durations = [member.completed_at - member.started_at for member in finished]
+    # Share ratio fairness: how evenly leechers gave back what they took
+    ratios = [member.sent / args.size for member in finished]
+    for member in seeders + leechers:
+        await member.shutdown()
+    clock.set_source()
+    gc.set_threshold(*thresholds)
+    gc.unfreeze()
+
+    return {
+        'picker': picker,
+        'unchoke_slots': unchoke_slots,
+        'seeders': args.seeders,
+        'leechers': args.leechers,
+        'size': args.size,
+        'piece_size': args.piece_size,
+        'rate': args.rate,
+        'completed': len(finished),
+        'completion_mean': round(statistics.mean(durations), 2) if durations else None,
+        'completion_median': round(statistics.median(durations), 2) if durations else None,
+        'completion_max': round(max(durations), 2) if durations else None,
+        'completion_fairness': round(jain_index(durations), 4) if durations else None,
+        'share_ratio_fairness': round(jain_index(ratios), 4) if ratios else None,
+        'seeder_upload_share': round(sum(member.sent for member in seeders) / max(1, sum(
+            member.sent for member in seeders + leechers)), 4),
+        'virtual_seconds': round(virtual_seconds, 2),
+        'wall_seconds': round(wall_seconds, 2),
+        'speedup': round(virtual_seconds / wall_seconds, 1),
+    }
+
+
+def run(args, picker: str, unchoke_slots: int) -> dict:
+    with asyncio.Runner(loop_factory=VirtualTimeLoop) as runner:
+        return runner.run(simulate(args, picker, unchoke_slots))
+
+
+def _without_wall_clock(result: dict) -> dict:
+    return {key: value for key, value in result.items() if key not in WALL_CLOCK_FIELDS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Deterministic swarm simulator')
+    parser.add_argument('--seeders', type=int, default=2)
+    parser.add_argument('--leechers', type=int, default=200)
+    parser.add_argument('--size', type=parse_size, default=4 * 2 ** 20, help='File size, e.g. 16MiB')
+    parser.add_argument('--piece-size', type=parse_size, default=2 ** 18)
+    parser.add_argument('--rate', type=parse_size, default=2 ** 20, help='Upload & download cap per peer')
+    parser.add_argument('--latency', type=float, nargs=2, default=[0.02, 0.2], metavar=('MIN', 'MAX'),
+                        help='Range of round trip times, each node gets one at random')
+    parser.add_argument('--arrival', type=float, default=60, help='Virtual seconds over which leechers join')
+    parser.add_argument('--max-time', type=float, default=3600, help='Virtual seconds before giving up')
+    parser.add_argument('--picker', nargs='+', choices=list(PICKERS), default=['rarest'])
+    parser.add_argument('--unchoke-slots', type=int, nargs='+', default=[Seeder.MAX_UNCHOKED])
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--check-determinism', action='store_true', help='Run each policy twice & compare')
+    args = parser.parse_args()
+
+    deterministic = True
+    for picker, unchoke_slots in itertools.product(args.picker, args.unchoke_slots):
+        result = run(args, picker, unchoke_slots)
+        if args.check_determinism:
+            again = run(args, picker, unchoke_slots)
+            result['deterministic'] = _without_wall_clock(result) == _without_wall_clock(again)
+            deterministic &= result['deterministic']
+        print(json.dumps(result), flush=True)
+    if not deterministic:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+# Reproducible swarm on loopback: a mock HTTP or UDP tracker plus seeders & leechers, each one an Engine running the
+# project's PeerManager / Downloader / Seeder.  Every node can be capped in bandwidth and given extra latency, which
+# a proxy in front of its listening port adds to each direction of every connection.  All nodes share this process,
+# so CPU & memory figures cover the whole swarm.
+#
+#   python swarm_bench.py --seeders 2 --leechers 8 --size 64MiB --latency 0.02 --rate 5MiB
+#
+# Prints one JSON object.
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import statistics
+import tempfile
+import time
+
+import bootstrap
+from engine import Engine
+from mock_tracker import MockTracker
+from shard_bench import make_torrents
+
+TRACKER_INTERVAL = 10  # Short, so leechers find the peers which join after them
+SAMPLE_INTERVAL = 1  # Seconds between aggregate download rate samples, completion times are as precise as this
+PROXY_READ_SIZE = 2 ** 16
+
+
+def parse_size(text: str) -> int:
+    """ '16MiB', '512KiB', '1GiB' or a number of bytes """
+    for suffix, factor in (('GiB', 2 ** 30), ('MiB', 2 ** 20), ('KiB', 2 ** 10)):
+        if text.endswith(suffix):
+            return int(float(text[:-len(suffix)]) * factor)
+    return int(text)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _delayed_pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, delay: float):
+    """ Copies reader to writer, each chunk arriving delay seconds after it was read """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    async def deliver():
+        while True:
+            due, data = await queue.get()
+            await asyncio.sleep(max(0.0, due - loop.time()))
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+
+    delivery = asyncio.ensure_future(deliver())
+    try:
+        while data := await reader.read(PROXY_READ_SIZE):
+            queue.put_nowait((loop.time() + delay, data))
+        queue.put_nowait((loop.time() + delay, b''))
+        await delivery
+    except ConnectionError:
+        pass
+    finally:
+        delivery.cancel()
+        writer.close()
+
+
+class _LatencyProxy:
+    """ Listens on a node's advertised port & forwards to its real one, delaying both directions """
+    def __init__(self, port: int, target_port: int, delay: float):
+        self.port = port
+        self.target_port = target_port
+        self.delay = delay
+        self.server = None
+        self.connections = set()  # Tasks forwarding each connection
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', self.port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            target_reader, target_writer = await asyncio.open_connection('127.0.0.1', self.target_port)
+        except OSError:
+            writer.close()
+            return
+        task = asyncio.ensure_future(asyncio.gather(_delayed_pipe(reader, target_writer, self.delay),
+                                                    _delayed_pipe(target_reader, writer, self.delay)))
+        self.connections.add(task)
+        task.add_done_callback(self.connections.discard)
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+        for task in self.connections:
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+
+class _Node:
+    """ One peer of the swarm """
+    def __init__(self, peer_id: str, directory: str, latency: float, rate: int):
+        self.port = _free_port()  # What the tracker & other peers see
+        self.latency = latency
+        self.rate = rate
+        self.engine = Engine(peer_id, directory, port=self.port)
+        self.engine.enable_utp = False  # The proxy only handles TCP
+        self.proxy = None
+        self.server = None
+        self.torrent = None
+        self.completed_at = None
+
+    async def start(self, metainfo_path: str):
+        if self.latency:
+            # The engine listens on a private port behind the proxy but still advertises the proxy's port
+            target_port = _free_port()
+            await self.engine.start(listen=False)
+            self.server = await asyncio.start_server(self.engine.handle_conn, '127.0.0.1', target_port)
+            self.proxy = _LatencyProxy(self.port, target_port, self.latency / 2)
+            await self.proxy.start()
+        else:
+            await self.engine.start()
+        if self.rate:
+            self.engine.set_limits(self.rate, self.rate)
+        self.torrent = self.engine.add_torrent(metainfo_path)
+        await self.torrent.start()
+
+    def is_complete(self) -> bool:
+        return self.torrent.file is not None and self.torrent.file.is_complete()
+
+    async def shutdown(self):
+        if self.proxy:
+            await self.proxy.close()
+        if self.server:
+            self.server.close()
+        await self.engine.shutdown()
+
+
+def _cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def bench(args) -> dict:
+    tracker = MockTracker(interval=TRACKER_INTERVAL)
+    await tracker.start(udp_port=0 if args.tracker == 'udp' else None)
+    announce = tracker.udp_announce_url if args.tracker == 'udp' else tracker.announce_url
+
+    with tempfile.TemporaryDirectory() as directory:
+        (metainfo_path, _), = make_torrents(directory, 1, args.size, args.piece_size, announce)
+        seeders = [_Node(f'-OH0001-S{i:011d}', directory, args.latency, args.rate) for i in range(args.seeders)]
+        leechers = []
+        for i in range(args.leechers):
+            leecher_dir = os.path.join(directory, f'leecher{i}')
+            os.mkdir(leecher_dir)
+            leechers.append(_Node(f'-OH0001-L{i:011d}', leecher_dir, args.latency, args.rate))
+
+        for node in seeders:
+            await node.start(metainfo_path)
+        cpu_start = _cpu_seconds()
+        start = time.perf_counter()
+        await asyncio.gather(*[node.start(metainfo_path) for node in leechers])
+
+        samples = []
+        last_downloaded = 0
+        while time.perf_counter() - start < args.timeout:
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            now = time.perf_counter() - start
+            for node in leechers:
+                if node.completed_at is None and node.is_complete():
+                    node.completed_at = now
+            downloaded = sum(node.engine.stats()['downloaded'] for node in leechers)
+            samples.append([round(now, 2), round((downloaded - last_downloaded) / SAMPLE_INTERVAL / 2 ** 20, 2)])
+            last_downloaded = downloaded
+            if all(node.completed_at is not None for node in leechers):
+                break
+
+        elapsed = time.perf_counter() - start
+        cpu = _cpu_seconds() - cpu_start
+        downloaded = sum(node.engine.stats()['downloaded'] for node in leechers)
+        completion_times = [node.completed_at for node in leechers if node.completed_at is not None]
+        for node in seeders + leechers:
+            await node.shutdown()
+    await tracker.close()
+
+    return {
+        'loop': args.loop,
+        'tracker': args.tracker,
+        'seeders': args.seeders,
+        'leechers': args.leechers,
+        'size': args.size,
+        'piece_size': args.piece_size,
+        'latency': args.latency,
+        'rate': args.rate,
+        'completed': len(completion_times),
+        'seconds': round(elapsed, 2),
+        'completion_min': round(min(completion_times), 2) if completion_times else None,
+        'completion_median': round(statistics.median(completion_times), 2) if completion_times else None,
+        'completion_max': round(max(completion_times), 2) if completion_times else None,
+        'bytes_downloaded': downloaded,
+        'throughput_mb_s': round(downloaded / elapsed / 2 ** 20, 2),
+        'cpu_seconds': round(cpu, 2),
+        'cpu_seconds_per_gb': round(cpu / (downloaded / 2 ** 30), 2) if downloaded else None,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),  # KiB on Linux
+        'download_rate_mb_s': samples,  # [[seconds, MB/s]]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated swarm benchmark on loopback')
+    parser.add_argument('--seeders', type=int, default=1)
+    parser.add_argument('--leechers', type=int, default=4)
+    parser.add_argument('--size', type=parse_size, default=32 * 2 ** 20, help='File size, e.g. 64MiB')
+    parser.add_argument('--piece-size', type=parse_size, default=2 ** 18)
+    parser.add_argument('--rate', type=parse_size, default=0, help='Upload & download cap per peer, 0 for none')
+    parser.add_argument('--latency', type=float, default=0, help='Round trip seconds added to every connection')
+    parser.add_argument('--tracker', choices=['http', 'udp'], default='http')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--loop', default=bootstrap.LOOP_AUTO)
+    args = parser.parse_args()
+    args.loop = bootstrap.resolve_loop(args.loop)
+
+    print(json.dumps(bootstrap.run(bench(args), args.loop)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# Tracing spans around the hot paths & an on-demand profiler, for finding which stage limits throughput on a live
+# client.  Disabled tracing costs nothing: enable() swaps each traced method for a timing wrapper & disable() puts
+# the original back.  Spans go to a ring buffer which exports as Chrome trace JSON (chrome://tracing, Perfetto).
+import cProfile
+import functools
+import importlib
+import io
+import json
+import marshal
+import os
+import pstats
+import threading
+import time
+from collections import deque
+
+from aiohttp import web
+
+RING_SIZE = 2 ** 18  # Spans kept, the oldest are dropped first
+PROFILE_LINES = 40  # Functions listed in a profile summary
+
+# (module, class, method, span name).  Synchronous methods only, a coroutine's span would end at its first await.
+SPANS = [
+    ('messages', 'Message', 'parse_first', 'parse'),
+    ('peer', 'Peer', 'handle_message', 'handle_message'),
+    ('file', 'File', 'store_block', 'store_block'),
+    ('file', 'File', 'complete_piece', 'complete_piece'),
+    ('file', 'Piece', 'valid_hash', 'hash'),
+    ('file', 'File', '_read', 'disk_read'),
+    ('file', 'File', '_write', 'disk_write'),
+    ('downloader', 'Downloader', 'issue_requests', 'issue_requests'),
+]
+
+_spans: deque = deque(maxlen=RING_SIZE)  # (name, start ns, duration ns, thread id)
+_originals: dict[tuple[type, str], object] = {}  # Maps (class, method) -> the method enable() replaced
+_profiler: cProfile.Profile = None
+
+
+def _traced(function, name: str):
+    record = _spans.append
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            record((name, start, time.perf_counter_ns() - start, threading.get_ident()))
+    return wrapper
+
+
+def is_enabled() -> bool:
+    return bool(_originals)
+
+
+def enable(size: int = RING_SIZE):
+    """ Starts recording spans into a fresh ring buffer of size spans """
+    global _spans
+    disable()
+    _spans = deque(maxlen=size)
+    for module_name, class_name, method, name in SPANS:
+        cls = getattr(importlib.import_module(module_name), class_name)
+        original = cls.__dict__[method]
+        _originals[(cls, method)] = original
+        if isinstance(original, staticmethod):
+            setattr(cls, method, staticmethod(_traced(original.__func__, name)))
+        else:
+            setattr(cls, method, _traced(original, name))
+
+
+def disable():
+    """ Restores the untraced methods, spans already recorded are kept for export """
+    for (cls, method), original in _originals.items():
+        setattr(cls, method, original)
+    _originals.clear()
+
+
+def chrome_trace() -> dict:
+    pid = os.getpid()
+    return {
+        'displayTimeUnit': 'ms',
+        'traceEvents': [{'name': name, 'cat': 'bt', 'ph': 'X', 'ts': start / 1000, 'dur': duration / 1000,
+                         'pid': pid, 'tid': tid} for name, start, duration, tid in list(_spans)],
+    }
+
+
+def export(path: str):
+    with open(path, 'w') as f:
+        json.dump(chrome_trace(), f)
+
+
+def summary() -> dict[str, dict]:
+    """ Maps span name -> count, total & max milliseconds, over the spans in the buffer """
+    totals = {}
+    for name, _, duration, _ in list(_spans):
+        entry = totals.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        entry['count'] += 1
+        entry['total_ms'] += duration / 1e6
+        entry['max_ms'] = max(entry['max_ms'], duration / 1e6)
+    return totals
+
+
+# Profiling.  cProfile only sees the thread that started it, i.e. the event loop's.
+
+def profiling() -> bool:
+    return _profiler is not None
+
+
+def start_profiler():
+    global _profiler
+    if _profiler is None:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def _stop() -> cProfile.Profile:
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.disable()
+        profiler.create_stats()
+    return profiler
+
+
+def stop_profiler(path: str = None) -> str:
+    """ Returns the top functions by cumulative time, the full stats are dumped to path if given """
+    profiler = _stop()
+    if profiler is None:
+        return ''
+    if path:
+        profiler.dump_stats(path)
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_LINES)
+    return out.getvalue()
+
+
+def stop_profiler_stats() -> bytes:
+    """ The full stats in the format Profile.dump_stats writes, for pstats or snakeviz.  Empty if not profiling """
+    profiler = _stop()
+    return marshal.dumps(profiler.stats) if profiler is not None else b''
+
+
+def routes() -> list[web.RouteDef]:
+    """ Debug endpoints to toggle tracing & profiling on a running engine, served next to its metrics """
+    async def trace_start(request: web.Request) -> web.Response:
+        try:
+            size = int(request.query.get('size', RING_SIZE))
+        except ValueError:
+            size = 0
+        if size <= 0:
+            raise web.HTTPBadRequest(text='size must be a positive integer\n')
+        enable(size)
+        return web.Response(text='tracing\n')
+
+    async def trace_stop(request: web.Request) -> web.Response:
+        disable()
+        return web.json_response(chrome_trace())
+
+    async def profile_start(request: web.Request) -> web.Response:
+        start_profiler()
+        return web.Response(text='profiling\n')
+
+    async def profile_stop(request: web.Request) -> web.Response:
+        # The stats are only ever returned, a caller chosen path would let any local page overwrite our files
+        if request.query.get('format') == 'pstats':
+            return web.Response(body=stop_profiler_stats(), content_type='application/octet-stream')
+        return web.Response(text=stop_profiler())
+
+    return [
+        web.post('/debug/trace/start', trace_start),
+        web.post('/debug/trace/stop', trace_stop),
+        web.post('/debug/profile/start', profile_start),
+        web.post('/debug/profile/stop', profile_stop),
+    ]
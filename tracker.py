@@ -1,19 +1,51 @@
 import asyncio
+import heapq
+import ipaddress
 import random
+import socket
 import struct
 import time
 import urllib.parse
 from enum import Enum
-from typing import Optional
+from typing import Callable
 
 import aiohttp
+import yarl
 
+import clock
+import event_log
+import metrics
 from utils import bdecode
 from session import Session
 
-RESEND_TIMEOUT = 15
 REQUEST_TIMEOUT = 60
 
+# HTTP trackers, one connection pool for every torrent
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_PER_HOST = 4
+HTTP_KEEPALIVE = 60  # Seconds idle connections are kept open, most trackers announce far less often
+DNS_CACHE_TTL = 5 * 60
+
+# UDP trackers (BEP 15)
+RETRANSMIT_TIMEOUT = 15  # Requests are retransmitted after RETRANSMIT_TIMEOUT * 2^n seconds
+MAX_RETRANSMITS = 3  # i.e. give up after 15 + 30 + 60 + 120 seconds
+CONNECTION_ID_LIFETIME = 60
+MAX_SCRAPE_HASHES = 74  # Most info hashes that fit in one scrape request
+DEFAULT_INTERVAL = 30 * 60  # Used until a tracker tells us its interval
+
+# Trackers which fail are skipped for TRACKER_BACKOFF * 2^(failures - 1) seconds, capped at MAX_TRACKER_BACKOFF
+TRACKER_BACKOFF = 60
+MAX_TRACKER_BACKOFF = 60 * 60
+TIER_FALLBACK_DELAY = 5  # Seconds to wait on a tier before also trying the next one
+STOPPED_TIMEOUT = 5
+
+# Announce scheduling, across every torrent
+MIN_ANNOUNCE_INTERVAL = 5 * 60  # Closest early announces get when the tracker doesn't give a min interval
+ANNOUNCE_JITTER = 0.1  # Regular announces are made up to 10% early, so torrents started together drift apart
+MAX_CONCURRENT_ANNOUNCES = 8
+ANNOUNCE_RATE = 10  # Most announces started per second
+PEER_CHECK_INTERVAL = 5  # Seconds between checks for torrents which are short of peers or just completed
+
 class TrackerEvent(Enum):
     none = 0
     completed = 1
@@ -21,281 +53,654 @@ class TrackerEvent(Enum):
     stopped = 3
 
 
-class _UDPProtocol(asyncio.BaseProtocol):
+class UDPTrackerClient(asyncio.DatagramProtocol):
+    """
+    UDP tracker protocol (BEP 15) over a single socket shared by every torrent.  Responses are matched to requests by
+    transaction id and connection ids are reused for as long as they are valid.
+    """
+    protocol_id: int = 0x41727101980  # Magic constant
+
+    connect_action: int = 0
+    announce_action: int = 1
+    scrape_action: int = 2
+    error_action: int = 3
+
+    transport: asyncio.DatagramTransport = None
+    starting: asyncio.Future = None
+    pending: dict[int, tuple[asyncio.Future, tuple[str, int]]] = {}  # Maps tx_id -> (response, tracker addr)
+    connections: dict[tuple[str, int], tuple[int, float]] = {}  # Maps tracker addr -> (connection id, expiry time)
+    connecting: dict[tuple[str, int], asyncio.Future] = {}  # Connect requests in flight, shared by their waiters
+    addresses: dict[tuple[str, int], tuple[str, int]] = {}  # Maps (hostname, port) -> resolved addr
+
     def __init__(self):
-        self.buffer: bytes = b''
-        self.con_update: Optional[asyncio.Future] = None
-        self.transport = None
-        self.exception = None
+        self.pending = {}
+        self.connections = {}
+        self.connecting = {}
+        self.addresses = {}
+
+    async def _start(self):
+        # The socket is opened on first use
+        if self.starting is None:
+            loop = asyncio.get_running_loop()
+            self.starting = asyncio.ensure_future(
+                loop.create_datagram_endpoint(lambda: self, local_addr=('0.0.0.0', 0)))
+        await self.starting
 
     def connection_made(self, transport):
-        """
-        Called when a connection is made.
-
-        The transport argument is the transport representing the connection. The protocol is responsible for storing
-        the reference to its transport.
-        """
         self.transport = transport
 
-    def connection_lost(self, exc):
-        """
-        Called when the connection is lost or closed.
-
-        The argument is either an exception object or None. The latter means a regular EOF is received, or the
-        connection was aborted or closed by this side of the connection.
-        """
-        self.exception = exc or EOFError()
-        self.set_con_update()
+    def close(self):
+        for future, _ in self.pending.values():
+            future.cancel()
+        if self.transport:
+            self.transport.close()
 
     def datagram_received(self, data, addr):
-        """
-        Called when a datagram is received. data is a bytes object containing the incoming data. addr is the address
-        of the peer sending the data; the exact format depends on the transport.
-        """
-        self.buffer += data
-        self.set_con_update()
+        if len(data) < 8:
+            return
+        action, tx_id = struct.unpack(">ii", data[:8])
+        if tx_id not in self.pending:
+            return  # Late reply to a retransmitted request
+        future, tracker_addr = self.pending[tx_id]
+        if tracker_addr != addr[:2] or future.done():
+            return
+
+        if action == self.error_action:
+            # Most likely an expired connection id, get a new one next time
+            self.connections.pop(tracker_addr, None)
+            future.set_exception(ValueError(data[8:].decode('utf-8', errors='replace')))
+        else:
+            future.set_result((action, data[8:]))
 
     def error_received(self, exc):
-        """
-        Called when a previous send or receive operation raises an OSError. exc is the OSError instance.
+        pass  # Requests time out & are retransmitted
+
+    async def _resolve(self, host: str, port: int) -> tuple[str, int]:
+        if (host, port) not in self.addresses:
+            loop = asyncio.get_running_loop()
+            info = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            self.addresses[(host, port)] = info[0][4][:2]
+        return self.addresses[(host, port)]
+
+    def _new_tx_id(self) -> int:
+        tx_id = random.randint(-2 ** 31, 2 ** 31 - 1)
+        while tx_id in self.pending:
+            tx_id = random.randint(-2 ** 31, 2 ** 31 - 1)
+        return tx_id
+
+    async def _send(self, addr: tuple[str, int], packet: Callable[[int], bytes], action: int, timeout: float,
+                    tx_id: int) -> bytes:
+        """ Sends packet(tx_id) & returns the body of the response """
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tx_id] = (future, addr)
+        try:
+            self.transport.sendto(packet(tx_id), addr)
+            resp_action, body = await asyncio.wait_for(future, timeout)
+        finally:
+            del self.pending[tx_id]
+        if resp_action != action:
+            raise ValueError()
+        return body
+
+    async def _connection_id(self, addr: tuple[str, int], timeout: float, tx_id: int) -> int:
+        conn_id, expires = self.connections.get(addr, (0, 0.0))
+        if expires > clock.now():
+            return conn_id
+
+        if addr not in self.connecting:
+            packet = lambda tx_id: struct.pack(">qii", self.protocol_id, self.connect_action, tx_id)
+            self.connecting[addr] = asyncio.ensure_future(self._send(addr, packet, self.connect_action, timeout,
+                                                                     tx_id))
+        try:
+            body = await asyncio.shield(self.connecting[addr])
+        finally:
+            if addr in self.connecting and self.connecting[addr].done():
+                del self.connecting[addr]
 
-        This method is called in rare conditions, when the transport (e.g. UDP) detects that a datagram could not
-        be delivered to its recipient. In many conditions though, undeliverable datagrams will be silently dropped.
+        if len(body) < 8:
+            raise ValueError()
+        conn_id, = struct.unpack(">q", body[:8])
+        self.connections[addr] = (conn_id, clock.now() + CONNECTION_ID_LIFETIME)
+        return conn_id
 
+    async def _request(self, host: str, port: int, packet: Callable[[int, int], bytes], action: int) -> bytes:
         """
-        self.exception = exc or EOFError()
-        self.set_con_update()
-
-    def set_con_update(self):
-        if self.con_update:
-            self.con_update.set_result(None)
-
-    async def read(self):
-        if not self.buffer:
-            self.con_update = asyncio.Future()
-            await self.con_update
-            self.con_update = None
-
-        if self.exception:
-            e = self.exception
-            self.exception = None
-            # TODO: LOG
-            raise e
-
-        data = self.buffer
-        self.buffer = b''
-        return data
+        Sends packet(conn_id, tx_id), retransmitting after 15 * 2^n seconds (BEP 15).  Raises ConnectionAbortedError
+        if the tracker never answers.  Retransmits keep their transaction ids, so a reply to an earlier attempt which
+        arrives late is still accepted
+        """
+        await self._start()
+        addr = await self._resolve(host, port)
+        connect_tx_id = self._new_tx_id()
+        tx_id = self._new_tx_id()
+        while tx_id == connect_tx_id:
+            tx_id = self._new_tx_id()
+        for n in range(MAX_RETRANSMITS + 1):
+            timeout = RETRANSMIT_TIMEOUT * 2 ** n
+            try:
+                conn_id = await self._connection_id(addr, timeout, connect_tx_id)
+                return await self._send(addr, lambda tx_id: packet(conn_id, tx_id), action, timeout, tx_id)
+            except asyncio.TimeoutError:
+                event_log.event('tracker', 'udp_timeout', addr=f'{host}:{port}', attempt=n)
+        raise ConnectionAbortedError()
+
+    async def announce(self, host: str, port: int, info_hash: bytes, peer_id: bytes, downloaded: int, left: int,
+                       uploaded: int, event: 'TrackerEvent', key: int, listen_port: int):
+        """ Returns (interval, [(ip: int, port: int)]) """
+        def packet(conn_id, tx_id):
+            return struct.pack(">qii20s20sqqqiIIiH", conn_id, self.announce_action, tx_id, info_hash, peer_id,
+                               downloaded, left, uploaded, event.value,
+                               0,  # 0 for unsupplied ip
+                               key,
+                               -1,  # num_want: Number of peers wanted in reply.  -1 for default
+                               listen_port)
+
+        body = await self._request(host, port, packet, self.announce_action)
+        if len(body) < 12:
+            raise ValueError()
+        interval, leechers, seeders = struct.unpack(">iii", body[:12])
 
+        # Remaining part of buffer should be list of peers [(ip, port), (ip, port), ...]
+        # ip == 4 bytes,  port == 2 bytes -> each peer is 6 bytes of data
+        if len(body[12:]) % 6:
+            raise ValueError()
+        return interval, list(struct.iter_unpack("!IH", body[12:]))
 
-class _UDPTracker:
-    protocol_id: int = 0x41727101980  # Magic constant
+    async def scrape(self, host: str, port: int, info_hashes: list[bytes]) -> dict[bytes, tuple[int, int, int]]:
+        """ Returns {info_hash: (seeders, completed, leechers)}, many torrents are scraped per request """
+        result = {}
+        for i in range(0, len(info_hashes), MAX_SCRAPE_HASHES):
+            batch = info_hashes[i:i + MAX_SCRAPE_HASHES]
 
-    connect_action: int = 0
-    announce_action: int = 1
-    # scrape_action: int = 2  probs wont do scraping
+            def packet(conn_id, tx_id):
+                return struct.pack(">qii", conn_id, self.scrape_action, tx_id) + b''.join(batch)
+
+            body = await self._request(host, port, packet, self.scrape_action)
+            if len(body) < 12 * len(batch):
+                raise ValueError()
+            for info_hash, stats in zip(batch, struct.iter_unpack(">iii", body[:12 * len(batch)])):
+                result[info_hash] = stats
+        return result
 
-    error_action: int = 3
 
-    protocol = None
-    transport = None
+class _UDPTracker:
+    """ Announces one torrent to a UDP tracker through the shared client """
+    min_interval: int = None  # UDP trackers don't send one
 
-    def __init__(self, parsed_announce: urllib.parse.ParseResult, server_port, peer_id, file, session: Session):
+    def __init__(self, parsed_announce: urllib.parse.ParseResult, server_port, peer_id, file, session: Session,
+                 client: UDPTrackerClient):
         self.file = file
         self.key = random.randint(0, 2 ** 32 - 1)
         self.peer_id = peer_id
         self.session = session
-        self.loop = asyncio.get_event_loop()
         self.server_port = server_port
         self.parsed_announce = parsed_announce
-
-    async def _wait_for(self, msg):
-        """
-        Send message and wait for response.  Request is resent every 15 seconds if no response has been received.  If
-        no reply has been received after 60 seconds, stops trying & raises ConnectionAbortedError
-        """
-        start = time.time()
-        resp = b''
-
-        while time.time() - start < REQUEST_TIMEOUT:
-            self.transport.sendto(msg)
-            try:
-                resp = await asyncio.wait_for(self.protocol.read(), RESEND_TIMEOUT)
-            except asyncio.TimeoutError:
-                # TODO: Log
-                # want to resend request every 15 secs
-                pass
-            except Exception as e:
-                # TODO: LOG
-                raise e
-
-        if not resp:
-            raise ConnectionAbortedError()
-
-        return resp
-
-    async def _connect(self):
-        tx_id = random.randint(1, 2 ** 32 - 1)
-        msg = struct.pack(">qii", _UDPTracker.protocol_id, _UDPTracker.connect_action, tx_id)
-        resp = await self._wait_for(msg)
-
-        if len(resp) < 16:
-            raise ValueError()
-
-        action, resp_tx_id, conn_id = struct.unpack(">iiq", resp)
-
-        if tx_id != resp_tx_id or action != self.connect_action:
-            raise ValueError()
-
-        return conn_id
+        self.client = client
 
     async def announce(self, event: TrackerEvent):
+        downloaded = self.file.pieces_completed * self.file.piece_size  # Not really exact but yolo
+        return await self.client.announce(self.parsed_announce.hostname, self.parsed_announce.port,
+                                          self.file.info_hash, self.peer_id.encode('latin-1'), downloaded,
+                                          self.file.file_size - downloaded, self.session.uploaded, event, self.key,
+                                          self.server_port)
+
+    async def scrape(self) -> tuple[int, int, int]:
+        stats = await self.client.scrape(self.parsed_announce.hostname, self.parsed_announce.port,
+                                         [self.file.info_hash])
+        return stats[self.file.info_hash]
+
+
+class HTTPTrackerClient:
+    """
+    Connection pool shared by every HTTP tracker of every torrent.  Connections are kept alive between announces,
+    DNS lookups are cached and the number of connections to any one tracker is capped.
+    """
+    session: aiohttp.ClientSession = None
+    keepalive: bool = True
+
+    def __init__(self, keepalive: bool = True):
+        self.keepalive = keepalive
+
+    def _session(self) -> aiohttp.ClientSession:
+        # Created on first use, it has to be made inside the running loop
+        if self.session is None:
+            reuse = {'keepalive_timeout': HTTP_KEEPALIVE} if self.keepalive else {'force_close': True}
+            connector = aiohttp.TCPConnector(limit=HTTP_MAX_CONNECTIONS, limit_per_host=HTTP_MAX_PER_HOST,
+                                             ttl_dns_cache=DNS_CACHE_TTL, **reuse)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+        return self.session
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+    async def _get(self, url: str, query: list[tuple[str, object]]) -> dict:
+        # urlencode percent-encodes bytes values (info_hash, peer_id) byte by byte
+        separator = '&' if '?' in url else '?'
         try:
-            self.transport, self.protocol = self.loop.create_datagram_endpoint(
-                _UDPProtocol, remote_addr=(self.parsed_announce.hostname, self.parsed_announce.port))
-
-            tx_id = random.randint(1, 2 ** 32 - 1)
-            conn_id = await self._connect()
-            msg = struct.pack(">q", conn_id,  # connection_id
-                              "i", self.announce_action,
-                              'i', tx_id,  # tx_id
-                              '20s', self.file.info_hash,
-                              '20s', self.peer_id,
-                              'q', self.file.pieces_completed * self.file.piece_size,  # downloaded
-                              # Not really exact but yolo
-                              'q', self.file.file_size - self.file.pieces_completed * self.file.piece_size,  # remaining
-                              'q', self.session.uploaded,
-                              'i', event,
-                              'I', 0,  # 0 for unsupplied ip
-                              'I', self.key,
-                              'i', -1,  # num_want: Number of peers wanted in reply.  -1 for default
-                              'H', self.server_port)
-
-            resp = await self._wait_for(msg)
-            if len(resp) < 20:
-                raise ValueError()
+            # encoded=True stops the query being quoted a second time
+            url = yarl.URL(url + separator + urllib.parse.urlencode(query), encoded=True)
+            async with self._session().get(url) as response:
+                body = await response.read()
+        except asyncio.TimeoutError:
+            event_log.event('tracker', 'http_timeout', url=str(url))
+            raise ConnectionAbortedError()
 
-            action, resp_tx_id, interval, leechers, seeders, peers = struct.unpack('>5i', resp[:20])
-            if tx_id != resp_tx_id or action != self.announce_action:
-                raise ValueError()
+        data, _ = bdecode(body, raw_keys=True)
+        if not isinstance(data, dict):
+            raise ValueError()
+        if b'failure reason' in data:
+            raise ValueError(data[b'failure reason'])
+        elif b'warning message' in data:
+            message = bytes(data[b'warning message']).decode('utf-8', 'replace')
+            event_log.event('tracker', 'warning', url=str(url), message=message)
+        return data
 
-            # Remaining part of buffer should be list of peers [(ip, port), (ip, port), ...]
-            # ip == 4 bytes,  port == 2 bytes -> each peer is 6 bytes of data
-            # Need to ensure remaining buffer only consists of a list of peers.
-            if not len(resp[20:]) % 6 == 0:
-                raise ValueError()
-            peers = list(struct.iter_unpack(">iH", resp[20:]))  # List[(ip: int, port: int)]
+    async def announce(self, url: str, query: list[tuple[str, object]]) -> tuple[int, int, list[tuple[int, int]], bytes]:
+        """ Returns (interval, min interval or None, [(ip: int, port: int)], tracker id) """
+        data = await self._get(url, query)
+        peers = data.get(b'peers', b'')
+        if isinstance(peers, list):
+            # Non-compact response: list of dicts
+            addrs = []
+            for entry in peers:
+                try:
+                    addrs.append((int(ipaddress.IPv4Address(entry[b'ip'].decode('ascii'))), entry[b'port']))
+                except (KeyError, ValueError, AttributeError):
+                    pass  # IPv6 or malformed
+            peers = addrs
+        else:
+            # In compact mode peers is string consisting of ip & port only.  I.e.:
+            # ip,port,ip,port,...
+            if len(peers) % 6:
+                raise ValueError('Malformed compact peer list')
+            peers = list(struct.iter_unpack("!IH", peers))  # List[(ip: int, port: int)]
 
-            return interval, peers
+        return data.get(b'interval', DEFAULT_INTERVAL), data.get(b'min interval'), peers, data.get(b'tracker id')
 
-        finally:
-            self.transport.close()
+    async def scrape(self, announce_url: str, info_hashes: list[bytes]) -> dict[bytes, tuple[int, int, int]]:
+        """
+        Returns {info_hash: (seeders, completed, leechers)}.  Many info hashes are sent in one request, the scrape url
+        is derived from the announce url (BEP 48).
+        """
+        scrape_url = scrape_url_for(announce_url)
+        if scrape_url is None:
+            raise ValueError('Tracker does not support scraping')
+
+        result = {}
+        for i in range(0, len(info_hashes), MAX_SCRAPE_HASHES):
+            data = await self._get(scrape_url, [('info_hash', info_hash)
+                                                for info_hash in info_hashes[i:i + MAX_SCRAPE_HASHES]])
+            for info_hash, stats in data.get(b'files', {}).items():
+                if isinstance(stats, dict):
+                    result[info_hash] = (stats.get(b'complete', 0), stats.get(b'downloaded', 0),
+                                         stats.get(b'incomplete', 0))
+        return result
+
+
+def scrape_url_for(announce_url: str):
+    """ The scrape url is the announce url with the last 'announce' in the path replaced, None if there isn't one """
+    parsed = urllib.parse.urlparse(announce_url)
+    head, _, tail = parsed.path.rpartition('/')
+    if not tail.startswith('announce'):
+        return None
+    return parsed._replace(path=f"{head}/scrape{tail[len('announce'):]}").geturl()
 
 
 class _HTTPTracker:
-    def __init__(self, parsed_announce: urllib.parse.ParseResult, server_port, file, peer_id, session):
+    """ Announces one torrent to an HTTP tracker through the shared client """
+    min_interval: int = None
+
+    def __init__(self, parsed_announce: urllib.parse.ParseResult, server_port, file, peer_id, session,
+                 client: HTTPTrackerClient):
         self.server_port = server_port
         self.file = file
         self.announce_url = parsed_announce.geturl()
         self.peer_id = peer_id
         self.session = session
-        self.tracker_id = ''
+        self.client = client
+        self.tracker_id = None
 
     async def announce(self, event: TrackerEvent):
-        params = {
-            'info_hash': urllib.parse.quote(self.file.info_hash),
-            'peer_id': self.peer_id,
-            'port': self.server_port,
-            'uploaded': self.session.uploaded,
-            'downloaded': self.file.pieces_completed * self.file.piece_size,
-            'remaining': self.file.file_size - self.file.pieces_completed * self.file.piece_size,
-            'compact': 1,
-            'event': event.name,
-        }
-        if self.tracker_id :
-            params['trackerid'] = self.tracker_id
-
-        url = f"{self.announce_url}?{urllib.parse.urlencode(params)}"
-        try:
-            timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.get(url) as response:
-                    resp_bytes = await response.read()
-
-            data, _ = bdecode(resp_bytes.decode('utf-8'), strict=False)
-            if 'failure reason' in data:
-                raise ValueError(data['failure reason'])
-            elif 'warning message' in data:
-                # LOG WARNING MESSAGE
-                pass
-
-            if isinstance(data['peers'], dict):
-                peers = [(entry['ip'], entry['port']) for entry in data['peers'].items()]
-            else:
-                # In compact mode peers is string consisting of ip & port only.  I.e.:
-                # ip,port,ip,port,...
-
-                data['peers'] = data['peers'].encode('utf-8')
-                if not len(data['peers']) % 6 == 0:
-                    raise ValueError()  # LOG
-                peers = list(struct.iter_unpack("!IH", data['peers']))  # List[(ip: int, port: int)]
-
-            self.tracker_id = data['tracker id']
-            return data['interval'], peers
-
-        except asyncio.TimeoutError:
-            raise ConnectionAbortedError()  # TODO: Log
-        except Exception as e:
-            raise e  # TODO: Log
+        downloaded = self.file.pieces_completed * self.file.piece_size
+        query = [
+            ('info_hash', self.file.info_hash),
+            ('peer_id', self.peer_id.encode('latin-1')),
+            ('port', self.server_port),
+            ('uploaded', self.session.uploaded),
+            ('downloaded', downloaded),
+            ('left', self.file.file_size - downloaded),
+            ('compact', 1),
+        ]
+        if event != TrackerEvent.none:
+            query.append(('event', event.name))
+        if self.tracker_id:
+            query.append(('trackerid', self.tracker_id))
+
+        interval, self.min_interval, peers, tracker_id = await self.client.announce(self.announce_url, query)
+        self.tracker_id = tracker_id or self.tracker_id
+        return interval, peers
+
+    async def scrape(self) -> tuple[int, int, int]:
+        stats = await self.client.scrape(self.announce_url, [self.file.info_hash])
+        return stats.get(self.file.info_hash, (0, 0, 0))
+
+
+class _Tracker:
+    """ A tracker from the announce list with its own backoff """
+    url: str = ''
+    scheme: str = ''  # Labels its metrics
+    client = None  # _UDPTracker or _HTTPTracker
+    failures: int = 0
+    next_attempt: float = 0.0
+    announced: bool = False  # True once it has accepted an announce, so it should be told when we stop
+
+    def __init__(self, url: str, client):
+        self.url = url
+        self.scheme = urllib.parse.urlparse(url).scheme
+        self.client = client
+
+    def ready(self, now: float) -> bool:
+        return self.next_attempt <= now
+
+    def failed(self):
+        self.failures += 1
+        self.next_attempt = clock.now() + min(TRACKER_BACKOFF * 2 ** (self.failures - 1), MAX_TRACKER_BACKOFF)
+
+    def succeeded(self):
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.announced = True
 
 
 class Announcer:
-    interval = 0
+    """
+    Announces to the trackers of the announce list (BEP 12).  Tiers are tried in order, the trackers of a tier are
+    announced to concurrently & the first to respond is moved to the front of its tier.  Peers are handed to the
+    PeerManager as each response arrives, deduplicated across the trackers of an announce.
+
+    When to announce is up to an AnnounceScheduler, usually the one every torrent of an engine shares.
+    """
+    interval = DEFAULT_INTERVAL
+    min_interval = MIN_ANNOUNCE_INTERVAL
     server_port: int = -1
-    announce_url = None
-
-    def __init__(self, metainfo, server_port, peer_id, file, session, peer_manager):
-
-        self.announce_url = urllib.parse.urlparse(metainfo['announce'])
+    tiers: list[list[_Tracker]] = []
+    stragglers: set[asyncio.Task] = set()  # Announces still running after another tracker responded
+    udp_client: UDPTrackerClient = None
+    owns_udp_client: bool = False
+    http_client: HTTPTrackerClient = None
+    owns_http_client: bool = False
+
+    # Scheduling state
+    event: TrackerEvent = None  # Event waiting to be sent, None when there isn't one
+    last_announce: float = 0.0  # When a tracker last responded
+    was_complete: bool = False  # Complete when started, trackers aren't sent completed then
+
+    def __init__(self, metainfo, server_port, peer_id, file, session, peer_manager,
+                 udp_client: UDPTrackerClient = None, http_client: HTTPTrackerClient = None):
+        """ The clients are shared between torrents, they are created for this torrent if they aren't given """
         self.server_port = server_port
         self.peer_manager = peer_manager
+        self.file = file
         self.session = session
+        self.stragglers = set()
+        self.udp_client = udp_client
+        self.owns_udp_client = udp_client is None
+        self.http_client = http_client
+        self.owns_http_client = http_client is None
+        self.was_complete = file.is_complete()
+
+        self.tiers = []
+        for urls in metainfo.get('announce-list') or [[metainfo['announce']]]:
+            tier = []
+            for url in urls:
+                parsed = urllib.parse.urlparse(url)
+                if parsed.scheme == 'udp':
+                    self.udp_client = self.udp_client or UDPTrackerClient()
+                    tier.append(_Tracker(url, _UDPTracker(parsed, server_port, peer_id, file, session,
+                                                          self.udp_client)))
+                elif parsed.scheme in ('http', 'https'):
+                    self.http_client = self.http_client or HTTPTrackerClient()
+                    tier.append(_Tracker(url, _HTTPTracker(parsed, server_port, file, peer_id, session,
+                                                           self.http_client)))
+                else:
+                    event_log.event('tracker', 'unsupported', torrent=session.label, url=url)
+            # Trackers within a tier are tried in a random order
+            random.shuffle(tier)
+            if tier:
+                self.tiers.append(tier)
+
+        if not self.tiers:
+            raise ValueError('No supported trackers in the announce list')
+
+    async def _announce_to(self, tracker: _Tracker, tier: list[_Tracker], event: TrackerEvent, seen: set) -> bool:
+        start = time.perf_counter()
+        try:
+            interval, peers = await tracker.client.announce(event)
+        except Exception as e:
+            metrics.ANNOUNCE_FAILURES.inc(tracker.scheme)
+            event_log.event('tracker', 'announce_failed', torrent=self.session.label, url=tracker.url, error=e)
+            tracker.failed()
+            return False
+
+        metrics.ANNOUNCE_LATENCY.observe(time.perf_counter() - start, tracker.scheme)
+        tracker.succeeded()
+        if tracker in tier:
+            tier.remove(tracker)
+            tier.insert(0, tracker)
+        self.interval = interval
+        self.min_interval = tracker.client.min_interval or min(interval, MIN_ANNOUNCE_INTERVAL)
+        self.last_announce = clock.now()
+
+        new_peers = [addr for addr in peers if addr not in seen]
+        seen.update(new_peers)
+        if new_peers:
+            self.peer_manager.connect_to_peers(new_peers)
+        return True
+
+    async def announce(self, event: TrackerEvent) -> bool:
+        """
+        Returns True if any tracker responded.  A tier which hasn't responded within TIER_FALLBACK_DELAY is left
+        running while the next tier is tried, so a slow or dead primary tracker doesn't hold up getting peers.
+        """
+        loop = asyncio.get_running_loop()
+        seen = set()
+        pending = set()
+        responded = False
+
+        for tier in self.tiers:
+            now = clock.now()
+            pending |= {asyncio.ensure_future(self._announce_to(tracker, tier, event, seen))
+                        for tracker in tier if tracker.ready(now)}
+            deadline = loop.time() + TIER_FALLBACK_DELAY
+            while pending and not responded and loop.time() < deadline:
+                done, pending = await asyncio.wait(pending, timeout=deadline - loop.time(),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                responded = any(task.result() for task in done)
+            if responded:
+                break
+
+        while pending and not responded:
+            # Every tier has been tried, wait on whichever announces are still running
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            responded = any(task.result() for task in done)
+
+        # Slower trackers still add their peers once they respond
+        self.stragglers |= pending
+        for task in pending:
+            task.add_done_callback(self.stragglers.discard)
+        return responded
+
+    def notify(self, event: TrackerEvent):
+        """
+        Queues an event for the next announce.  Events coalesce, the most important one pending is sent: started
+        already tells the tracker how much is left, so a completed queued behind it is dropped.
+        """
+        if self.event is None or EVENT_PRIORITY[event] > EVENT_PRIORITY[self.event]:
+            self.event = event
+
+    def poll(self) -> bool:
+        """ Called periodically by the scheduler, True if the torrent should announce as soon as it's allowed """
+        if not self.was_complete and self.file.is_complete():
+            self.was_complete = True
+            self.notify(TrackerEvent.completed)
+        if self.event is not None:
+            return True
+        return not self.file.is_complete() and self.peer_manager.needs_peers()
+
+    def _ready_at(self) -> float:
+        """ When the first tracker is out of backoff """
+        return min(tracker.next_attempt for tier in self.tiers for tracker in tier)
+
+    def _retry_delay(self) -> float:
+        # Every tracker failed, wait until the first one is out of backoff
+        return max(1.0, self._ready_at() - clock.now())
 
-        if self.announce_url.scheme == 'udp':
-            self.tracker = _UDPTracker(self.announce_url, server_port, peer_id, file, session)
-        elif self.announce_url.scheme == 'http':
-            self.tracker = _HTTPTracker(self.announce_url, server_port, peer_id, file, session)
-        else:
-            raise ValueError(f'Invalid announce url: {metainfo["announce"]}')
+    async def _disconnect(self):
+        """
+        Tells the trackers we're stopping.  Only trackers which accepted an announce are told, so a torrent stopped
+        before its started announce got through sends nothing at all.
+        """
+        self.event = None
+        for task in self.stragglers:
+            task.cancel()
+        trackers = [tracker for tier in self.tiers for tracker in tier if tracker.announced]
+        await asyncio.gather(*[asyncio.wait_for(tracker.client.announce(TrackerEvent.stopped), STOPPED_TIMEOUT)
+                               for tracker in trackers], return_exceptions=True)
+        if self.owns_udp_client and self.udp_client:
+            self.udp_client.close()
+        if self.owns_http_client and self.http_client:
+            await self.http_client.close()
 
-    async def _connect(self):
-        self.interval, peers = await self.tracker.announce(TrackerEvent.started)
-        return peers
+    async def run(self):
+        """ Announces on a scheduler of its own, for a torrent running outside an engine """
+        scheduler = AnnounceScheduler()
+        scheduler.add(self)
+        try:
+            await scheduler.run()
+        finally:
+            await scheduler.remove(self)
 
-    async def _announce(self):
-        _, peers = await self.tracker.announce(TrackerEvent.none)
-        return peers
 
-    async def _disconnect(self):
-        await self.tracker.announce(TrackerEvent.stopped)
+EVENT_PRIORITY = {TrackerEvent.none: 0, TrackerEvent.completed: 1, TrackerEvent.started: 2, TrackerEvent.stopped: 3}
 
-    async def run(self):
+
+class AnnounceScheduler:
+    """
+    Decides when each torrent announces.  A heap ordered by due time holds one entry per torrent.  Regular announces
+    are jittered so torrents added together spread out, events & torrents short of peers announce early but never
+    closer together than the tracker's min interval (events aside).  At most MAX_CONCURRENT_ANNOUNCES run at once
+    and new ones start at most ANNOUNCE_RATE per second, so the engine's tracker traffic stays smooth however many
+    torrents become due together.
+    """
+    queue: list[list] = []  # Heap of [due, seq, announcer], announcer is None once the entry is superseded
+    entries: dict[Announcer, list] = {}  # Live entry of each announcer
+    announcing: dict[Announcer, asyncio.Task] = {}
+    slots: asyncio.Semaphore = None
+    wakeup: asyncio.Event = None
+    seq: int = 0
+    last_start: float = 0.0
+    last_poll: float = 0.0
+
+    def __init__(self):
+        self.queue = []
+        self.entries = {}
+        self.announcing = {}
+        self.slots = asyncio.Semaphore(MAX_CONCURRENT_ANNOUNCES)
+        self.wakeup = asyncio.Event()
+
+    def _schedule(self, announcer: Announcer, due: float):
+        if (entry := self.entries.pop(announcer, None)) is not None:
+            entry[-1] = None
+        self.seq += 1
+        entry = [due, self.seq, announcer]
+        self.entries[announcer] = entry
+        heapq.heappush(self.queue, entry)
+        self.wakeup.set()
+
+    def _advance(self, announcer: Announcer, due: float):
+        """ Moves a waiting announcer's next announce earlier, never later """
+        entry = self.entries.get(announcer)
+        if entry is not None and due < entry[0]:
+            self._schedule(announcer, due)
+
+    def add(self, announcer: Announcer):
+        announcer.notify(TrackerEvent.started)
+        self._schedule(announcer, clock.now())
+
+    def notify(self, announcer: Announcer, event: TrackerEvent):
+        """ Events are sent as soon as a slot is free, min interval only holds back regular announces """
+        announcer.notify(event)
+        self._advance(announcer, clock.now())
+
+    async def remove(self, announcer: Announcer):
+        """
+        Stops scheduling the announcer and sends stopped.  It doesn't wait for a slot, slow announces could hold
+        every slot for minutes & each stopped is already cut off after STOPPED_TIMEOUT
+        """
+        if (entry := self.entries.pop(announcer, None)) is not None:
+            entry[-1] = None
+        if (task := self.announcing.pop(announcer, None)) is not None:
+            task.cancel()
+        await announcer._disconnect()
+
+    def _poll(self, now: float):
+        self.last_poll = now
+        for announcer in list(self.entries):
+            if announcer.poll():
+                due = now if announcer.event is not None else announcer.last_announce + announcer.min_interval
+                self._advance(announcer, max(due, announcer._ready_at()))
+
+    async def _announce(self, announcer: Announcer):
         try:
-            peers = await self._connect()
-            self.peer_manager.connect_to_peers(peers)
-
-            while self.session.active:
-                await asyncio.sleep(self.interval)
-                peers = self._announce()
-                self.peer_manager.connect_to_peers(peers)
-
-        except ConnectionAbortedError:
-            # Terminal error, abort entire program.
-            # TODO: LOG
-            pass
-        except ValueError:
-            # Another terminal error: invalid message from tracker
-            # TODO: LOG
-            pass
+            event = announcer.event or TrackerEvent.none
+            announcer.event = None
+            responded = await announcer.announce(event)
         finally:
-            await self._disconnect()
+            self.announcing.pop(announcer, None)
+
+        now = clock.now()
+        if not responded:
+            # Events are resent, a regular announce just waits for the trackers' backoff like the retry of an event
+            if event is not TrackerEvent.none:
+                announcer.notify(event)
+            delay = announcer._retry_delay()
+        elif announcer.event is not None:
+            delay = 0  # Another event came in while announcing
+        else:
+            delay = announcer.interval * (1 - random.uniform(0, ANNOUNCE_JITTER))
+        self._schedule(announcer, now + delay)
 
+    async def run(self):
+        while True:
+            now = clock.now()
+            if now - self.last_poll >= PEER_CHECK_INTERVAL:
+                self._poll(now)
+            while self.queue and self.queue[0][-1] is None:
+                heapq.heappop(self.queue)
+
+            if not self.queue or self.queue[0][0] > now:
+                timeout = PEER_CHECK_INTERVAL
+                if self.queue:
+                    timeout = min(timeout, self.queue[0][0] - now)
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Smooth out bursts: wait for a free slot & space out announce starts
+            await self.slots.acquire()
+            await asyncio.sleep(max(0.0, self.last_start + 1 / ANNOUNCE_RATE - clock.now()))
+            if not self.queue or self.queue[0][-1] is None or self.queue[0][0] > clock.now():
+                self.slots.release()  # Removed or rescheduled while waiting
+                continue
+            _, _, announcer = heapq.heappop(self.queue)
+            del self.entries[announcer]
+            self.last_start = clock.now()
+            task = asyncio.ensure_future(self._announce(announcer))
+            # Released by a callback, the coroutine never runs if the task is cancelled straight away
+            task.add_done_callback(lambda _: self.slots.release())
+            self.announcing[announcer] = task
@@ -0,0 +1,73 @@
+# Announce latency & connection reuse of the shared HTTP tracker client against the local mock tracker.  Many
+# torrents announce concurrently through one client, once with keep-alive and once with a new connection per request.
+#
+#   python tracker_bench.py --torrents 200 --rounds 5
+#
+# Prints one JSON object per mode.
+import argparse
+import asyncio
+import hashlib
+import json
+import statistics
+import time
+
+import bootstrap
+from mock_tracker import MockTracker
+from tracker import HTTPTrackerClient
+
+
+def _percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+async def bench(keepalive: bool, args) -> dict:
+    tracker = MockTracker()
+    await tracker.start()
+    client = HTTPTrackerClient(keepalive=keepalive)
+    info_hashes = [hashlib.sha1(str(i).encode()).digest() for i in range(args.torrents)]
+    latencies = []
+
+    async def announce(i: int, info_hash: bytes):
+        query = [('info_hash', info_hash), ('peer_id', f'-BENCH-{i:013d}'.encode()), ('port', 6881 + i % 1000),
+                 ('uploaded', 0), ('downloaded', 0), ('left', 1), ('compact', 1)]
+        start = time.perf_counter()
+        await client.announce(tracker.announce_url, query)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        await asyncio.gather(*[announce(i, info_hash) for i, info_hash in enumerate(info_hashes)])
+    scrape_start = time.perf_counter()
+    scraped = await client.scrape(tracker.announce_url, info_hashes)
+    scrape_time = time.perf_counter() - scrape_start
+    elapsed = time.perf_counter() - start
+
+    await client.close()
+    await tracker.close()
+    return {
+        'keepalive': keepalive,
+        'announces': len(latencies),
+        'announces_per_sec': round(len(latencies) / elapsed),
+        'latency_p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'latency_p99_ms': round(_percentile(latencies, 0.99) * 1000, 2),
+        'connections': len(tracker.connections),
+        'connections_per_announce': round(len(tracker.connections) / (len(latencies) + tracker.scrapes), 3),
+        'scraped': len(scraped),
+        'scrape_requests': tracker.scrapes,
+        'scrape_ms': round(scrape_time * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP tracker client benchmark')
+    parser.add_argument('--torrents', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    for keepalive in (True, False):
+        print(json.dumps(bootstrap.run(bench(keepalive, args))), flush=True)
+
+
+if __name__ == '__main__':
+    main()
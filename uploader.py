@@ -0,0 +1,145 @@
+# Torrent-wide upload scheduler.  Queues the requests peers send us and serves them round-robin so one greedy peer
+# can't starve the rest, reading neighbouring blocks of the same piece from disk in one go.  Each peer's blocks are
+# sent by a task of its own, so a peer held up by its upload limit or a full socket buffer doesn't stall the others.
+import asyncio
+from collections import deque
+
+from file import File
+from session import Session
+
+MAX_QUEUED_REQUESTS = 64  # Per peer, requests past this are dropped
+UPLOAD_BATCH = 32  # Max requests served per scheduling round
+HOT_PIECES = 4  # Number of recently read pieces suggested to fast extension peers
+
+
+class Uploader:
+    file: File = None
+    session: Session = None
+
+    # Maps peer_id -> queued (piece, begin, length) requests
+    queues: dict[str, deque[tuple[int, int, int]]] = {}
+    peers: dict = {}  # Maps peer_id -> Peer with queued requests
+    # Round-robin order of peers with queued requests.  Peers whose queue was dropped are skipped lazily.
+    turns: deque[str] = None
+    waiting: set[str] = set()  # Peers in turns, so none gets a second place in the line
+    sending: dict[str, asyncio.Task] = {}  # Maps peer_id -> task sending its last batch, skipped until it is done
+    work_available: asyncio.Event = None
+    hot_pieces: deque[int] = None  # Most recently read pieces, likely still in the OS page cache
+
+    def __init__(self, file: File, session: Session):
+        self.file = file
+        self.session = session
+        self.queues = {}
+        self.peers = {}
+        self.turns = deque()
+        self.waiting = set()
+        self.sending = {}
+        self.work_available = asyncio.Event()
+        self.hot_pieces = deque(maxlen=HOT_PIECES)
+
+    def enqueue(self, peer, piece: int, begin: int, length: int) -> bool:
+        """ Returns False if the request was dropped """
+        if peer.am_choking and piece not in peer.allowed_fast_out:
+            return False
+        if not self.file.have_block(piece, begin, length):
+            return False
+
+        queue = self.queues.setdefault(peer.their_id, deque())
+        if len(queue) >= MAX_QUEUED_REQUESTS:
+            return False
+
+        self.peers[peer.their_id] = peer
+        queue.append((piece, begin, length))
+        self._add_turn(peer.their_id)
+        return True
+
+    def _add_turn(self, peer_id: str):
+        if peer_id not in self.waiting and peer_id not in self.sending:
+            self.waiting.add(peer_id)
+            self.turns.append(peer_id)
+            self.work_available.set()
+
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def cancel(self, peer_id: str, piece: int, begin: int, length: int):
+        queue = self.queues.get(peer_id)
+        if queue and (piece, begin, length) in queue:
+            queue.remove((piece, begin, length))
+
+    def choke_peer(self, peer) -> list[tuple[int, int, int]]:
+        """ Drops a newly choked peer's queued requests, except allowed fast ones.  Returns the dropped requests """
+        queue = self.queues.get(peer.their_id)
+        if not queue:
+            return []
+        dropped = [req for req in queue if req[0] not in peer.allowed_fast_out]
+        self.queues[peer.their_id] = deque(req for req in queue if req[0] in peer.allowed_fast_out)
+        return dropped
+
+    def drop_peer(self, peer_id: str):
+        """ Drops all queued requests of a peer we choked or disconnected from """
+        self.queues.pop(peer_id, None)
+        self.peers.pop(peer_id, None)
+
+    def _next_batch(self) -> list[tuple[object, int, int, int]]:
+        # Take one request per peer per pass
+        batch = []
+        while self.turns and len(batch) < UPLOAD_BATCH:
+            peer_id = self.turns.popleft()
+            self.waiting.discard(peer_id)
+            queue = self.queues.get(peer_id)
+            if not queue or peer_id in self.sending:
+                continue  # Peers still sending get their turn back once done
+            batch.append((self.peers[peer_id], *queue.popleft()))
+            if queue:
+                self.waiting.add(peer_id)
+                self.turns.append(peer_id)
+        return batch
+
+    def _read_batch(self, batch: list[tuple[object, int, int, int]]) -> list[bytes]:
+        """ Reads the blocks for a batch, with one disk read per piece """
+        spans = {}  # Maps piece -> (start, end) covering every requested block of that piece
+        for _, piece, begin, length in batch:
+            start, end = spans.get(piece, (begin, begin + length))
+            spans[piece] = (min(start, begin), max(end, begin + length))
+
+        data = {piece: self.file.get_block(piece, start, end - start) for piece, (start, end) in spans.items()}
+        for piece in data:
+            if piece not in self.hot_pieces:
+                self.hot_pieces.append(piece)
+
+        blocks = []
+        for _, piece, begin, length in batch:
+            start = begin - spans[piece][0]
+            blocks.append(data[piece][start:start + length])
+        return blocks
+
+    async def _send(self, peer, blocks: list[tuple[int, int, bytes]]):
+        try:
+            for piece, begin, block in blocks:
+                await peer.send_piece(piece, begin, block)
+        except Exception:
+            pass  # Disconnects are handled by the peer's own task
+        finally:
+            self.sending.pop(peer.their_id, None)
+            if self.queues.get(peer.their_id):
+                self._add_turn(peer.their_id)
+
+    async def run(self):
+        try:
+            while self.session.active:
+                batch = self._next_batch()
+                if not batch:
+                    self.work_available.clear()
+                    await self.work_available.wait()
+                    continue
+
+                # send_piece waits on the peer's upload limit & socket buffer, so every peer gets its own task
+                by_peer = {}  # Maps peer_id -> (peer, [(piece, begin, block)])
+                for (peer, piece, begin, _), block in zip(batch, self._read_batch(batch)):
+                    by_peer.setdefault(peer.their_id, (peer, []))[1].append((piece, begin, block))
+                for peer_id, (peer, blocks) in by_peer.items():
+                    self.sending[peer_id] = asyncio.ensure_future(self._send(peer, blocks))
+        finally:
+            for task in list(self.sending.values()):
+                task.cancel()
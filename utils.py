@@ -1,9 +1,11 @@
-import bisect
 import hashlib
-import time
+import math
 from enum import Enum
 from typing import Union
 
+import clock
+import event_log
+
 
 class BDecodeError(Exception):
     pass
@@ -14,40 +16,47 @@ class BEncodeError(Exception):
 
 
 class BEncoding(Enum):
-    Dict: str = 'd'
-    List: str = 'I'
-    Integer: str = 'i'
-    End: str = 'e'
+    Dict: bytes = b'd'
+    List: bytes = b'l'
+    Integer: bytes = b'i'
+    End: bytes = b'e'
+
+
+# Strings are encoded/decoded as bytes, except dict keys which are decoded to str.
 
 
-def bencode_str(text: str) -> str:
-    return str(len(text)) + ":" + text
+def bencode_str(text: Union[str, bytes]) -> bytes:
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    return str(len(text)).encode('ascii') + b":" + text
 
 
-def bdecode_str(data: str) -> tuple[str, str]:
+def bdecode_str(data: bytes) -> tuple[bytes, bytes]:
     try:
-        str_len = int(data[0])
-        return data[2: 2 + str_len], data[str_len + 2:]  # +1 for len, +1 for ':'
+        sep = data.index(b':')
+        str_len = int(data[:sep])
+        if str_len < 0 or len(data) < sep + 1 + str_len:
+            raise BDecodeError()
+        return data[sep + 1: sep + 1 + str_len], data[sep + 1 + str_len:]
     except ValueError:
         # str_len isn't an int -> not a string
         raise BDecodeError()
 
 
-def bencode_int(data: int) -> str:
-    data = BEncoding.Integer + str(data) + BEncoding.End
-    return data
+def bencode_int(data: int) -> bytes:
+    return BEncoding.Integer.value + str(data).encode('ascii') + BEncoding.End.value
 
 
-def bdecode_int(data: str) -> tuple[int, str]:
-    if data[0] != BEncoding.Integer:
+def bdecode_int(data: bytes) -> tuple[int, bytes]:
+    if data[:1] != BEncoding.Integer.value:
         raise BDecodeError()
 
     try:
-        int_end = data.index(BEncoding.End)
+        int_end = data.index(BEncoding.End.value)
 
-        if data[1] == '0' and int_end != 2:
+        if data[1:2] == b'0' and int_end != 2:
             raise BDecodeError()
-        elif data[1] == '-' and data[2] == '0':
+        elif data[1:3] == b'-0':
             raise BDecodeError()
 
         return int(data[1:int_end]), data[int_end + 1:]
@@ -56,73 +65,80 @@ def bdecode_int(data: str) -> tuple[int, str]:
         raise BDecodeError()
 
 
-#  NB: Doesn't enforce lexicographic ordering
-def bencode_dict(data: dict) -> str:
-    elements = [BEncoding.Dict]
+def bencode_dict(data: dict) -> bytes:
+    elements = [BEncoding.Dict.value]
 
-    for k, v in data.items():
+    # Keys must be sorted as raw strings
+    items = sorted((k.encode('utf-8') if isinstance(k, str) else k, v) for k, v in data.items())
+    for k, v in items:
         elements.extend([bencode_str(k), bencode(v)])
-    elements.append(BEncoding.End)
-    return ''.join(elements)
+    elements.append(BEncoding.End.value)
+    return b''.join(elements)
 
 
-#  NB: Doesn't enforce lexicographic ordering
-def bdecode_dict(data: str) -> tuple[dict, str]:
-    if data[0] != BEncoding.Dict:
+#  NB: Doesn't enforce lexicographic ordering.  raw_keys keeps keys as bytes, i.e. for keys which are info hashes
+def bdecode_dict(data: bytes, raw_keys: bool = False) -> tuple[dict, bytes]:
+    if data[:1] != BEncoding.Dict.value:
         raise BDecodeError()
 
     d = {}
-    while data[0] != BEncoding.End:
+    data = data[1:]
+    while data[:1] != BEncoding.End.value:
+        if not data:
+            raise BDecodeError()
         key, data = bdecode_str(data)
-        element, data = bdecode(data)
-        d[key] = element
+        element, data = bdecode(data, raw_keys=raw_keys)
+        d[key if raw_keys else key.decode('utf-8', errors='replace')] = element
 
-    return d, data
+    return d, data[1:]
 
 
-def bencode_list(data: list) -> str:
-    elements = [BEncoding.List]
+def bencode_list(data: list) -> bytes:
+    elements = [BEncoding.List.value]
 
     for ele in data:
         elements.append(bencode(ele))
 
-    elements.append(BEncoding.End)
-    return ''.join(elements)
+    elements.append(BEncoding.End.value)
+    return b''.join(elements)
 
 
-def bdecode_list(data: str) -> tuple[list, str]:
-    if data[0] != BEncoding.List:
+def bdecode_list(data: bytes, raw_keys: bool = False) -> tuple[list, bytes]:
+    if data[:1] != BEncoding.List.value:
         raise BDecodeError()
 
     d = []
-    while data[0] != BEncoding.End:
-        element, data = bdecode(data)
+    data = data[1:]
+    while data[:1] != BEncoding.End.value:
+        if not data:
+            raise BDecodeError()
+        element, data = bdecode(data, raw_keys=raw_keys)
         d.append(element)
 
-    return d, data
+    return d, data[1:]
 
 
-def bdecode(data: str, strict=True) -> tuple[Union[str, int, dict, list], str]:
-    indicator = data[0]
+def bdecode(data: bytes, strict=True, raw_keys=False) -> tuple[Union[bytes, int, dict, list], bytes]:
+    indicator = data[:1]
 
-    if indicator == BEncoding.Integer:
+    if indicator == BEncoding.Integer.value:
         return bdecode_int(data)
     elif indicator.isdigit():
         return bdecode_str(data)
-    elif indicator == BEncoding.List:
-        return bdecode_list(data)
-    elif indicator == BEncoding.Dict:
-        return bdecode_dict(data)
+    elif indicator == BEncoding.List.value:
+        return bdecode_list(data, raw_keys)
+    elif indicator == BEncoding.Dict.value:
+        return bdecode_dict(data, raw_keys)
     elif not strict:
-        return data, ''
+        return data, b''
     else:
         raise BDecodeError()
 
 
-def bencode(data: Union[str, int, dict, list]) -> str:
+def bencode(data: Union[bytes, str, int, dict, list]) -> bytes:
     if isinstance(data, int):
         return bencode_int(data)
-    elif isinstance(data, str):
+    elif isinstance(data, (str, bytes)):
         return bencode_str(data)
     elif isinstance(data, list):
         return bencode_list(data)
@@ -134,84 +150,126 @@ def bencode(data: Union[str, int, dict, list]) -> str:
 
 def parse_metainfo(file_dir: str) -> tuple[dict[str, Union[str, int]], bytes]:
     try:
-        metainfo = open(file_dir).read()
-        metainfo, remaining = bdecode_dict(metainfo)
+        with open(file_dir, 'rb') as f:
+            metainfo, remaining = bdecode_dict(f.read())
 
-        # Ensure file has requisite keys
-        if metainfo.keys() >= {'announce', 'info'} and not remaining:
+        # Ensure file has requisite keys.  announce may be left out if there is an announce-list (BEP 12)
+        if 'info' not in metainfo or not metainfo.keys() & {'announce', 'announce-list'} or remaining:
             raise ValueError()
-        if metainfo['info'].keys() >= {'piece length', 'pieces', 'length', 'name'}:
+        if not metainfo['info'].keys() >= {'piece length', 'pieces', 'length', 'name'}:
             raise ValueError()
 
-        info_hash = hashlib.sha1(bencode_dict(metainfo['info']).encode('utf-8')).digest()
+        info_hash = hashlib.sha1(bencode_dict(metainfo['info'])).digest()
+        if 'announce' in metainfo:
+            metainfo['announce'] = metainfo['announce'].decode('utf-8')
+        if 'announce-list' in metainfo:
+            metainfo['announce-list'] = [[url.decode('utf-8') for url in tier]
+                                         for tier in metainfo['announce-list']]
 
         # Pieces is a string consisting of the concatenation of all 20-byte sha1 hash values
-        # So split them up + encode them
-        metainfo['info']['piece hashes'] = [metainfo['info']['pieces'][i * 20:i * 21].encode('utf-8')
-                                            for i in range(metainfo['info']['pieces'])]
+        # So split them up
+        pieces = metainfo['info']['pieces']
+        metainfo['info']['piece hashes'] = [pieces[i:i + 20] for i in range(0, len(pieces), 20)]
 
         return metainfo, info_hash
 
-    except BDecodeError:
-        # TODO LOG
-        pass
-    except ValueError:
-        # TODO: LOG
-        pass
-    except:
-        # TODO: LOG
-        pass
-
-
-class RollingAverage20:
-    times: list[float] = []
-    values: list[int] = []
+    except Exception as e:
+        event_log.event('metainfo', 'invalid', path=file_dir, error=e)
+
+
+def allowed_fast_set(ip: int, info_hash: bytes, num_pieces: int, k: int) -> list[int]:
+    """ Canonical allowed fast set for an IPv4 peer, as specified in BEP 6 """
+    k = min(k, num_pieces)
+    allowed = []
+    x = (ip & 0xFFFFFF00).to_bytes(4, 'big') + info_hash
+    while len(allowed) < k:
+        x = hashlib.sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(allowed) == k:
+                break
+            index = int.from_bytes(x[i:i + 4], 'big') % num_pieces
+            if index not in allowed:
+                allowed.append(index)
+    return allowed
+
+
+class RateMeter:
+    """
+    Bytes per second over the last `timeframe` seconds.  Samples are summed into a fixed ring of time buckets, so
+    record() and rate() are O(1) and memory use doesn't depend on the number of samples.
+    """
     timeframe: int = 20
-
-    def _trim(self):
-        cutoff = time.time() - self.timeframe
-
-        for i in range(len(self.times)-1, -1, -1):
-            if not self.times[i] > cutoff:
-                self.times = self.times[i + 1:]
-                self.values = self.values[i + 1:]
-                return
+    bucket_width: float = 1.0
+
+    buckets: list[int] = []
+    total: int = 0  # Sum of buckets
+    current: int = 0  # Absolute number of the newest bucket i.e. int(time / bucket_width)
+
+    def __init__(self, timeframe: int = 20, bucket_width: float = 1.0):
+        self.timeframe = timeframe
+        self.bucket_width = bucket_width
+        self.buckets = [0] * math.ceil(timeframe / bucket_width)
+        self.current = int(clock.now() / bucket_width)
+
+    def _advance(self):
+        # Zero the buckets which have left the window.  At most len(buckets) iterations.
+        bucket = int(clock.now() / self.bucket_width)
+        elapsed = bucket - self.current
+        if elapsed <= 0:
+            return
+
+        if elapsed >= len(self.buckets):
+            for i in range(len(self.buckets)):
+                self.buckets[i] = 0
+            self.total = 0
+        else:
+            for i in range(self.current + 1, bucket + 1):
+                i %= len(self.buckets)
+                self.total -= self.buckets[i]
+                self.buckets[i] = 0
+        self.current = bucket
 
     def rate(self):
-        self._trim()
-        return sum(self.values) / self.timeframe
+        self._advance()
+        return self.total / self.timeframe
 
     def record(self, value):
-        self.times.append(time.time())
-        self.values.append(value)
+        self._advance()
+        self.buckets[self.current % len(self.buckets)] += value
+        self.total += value
 
 
 class PieceTracker:
-    rarities = []
-    pieces = []
+    """
+    Pieces ordered by rarity, least owned first.  Pieces are kept in a set per rarity so a Have moves a piece between
+    buckets in O(1), there are only as many buckets as distinct rarities.  Ties are broken arbitrarily.
+    """
+    rarities: dict[int, int] = {}  # Maps piece -> rarity
+    buckets: dict[int, set[int]] = {}  # Maps rarity -> pieces, no empty sets
     size = 0
 
     def __init__(self, total_pieces):
-        self.rarities = [0] * total_pieces
-        self.pieces = [i for i in range(total_pieces)]
+        self.rarities = {i: 0 for i in range(total_pieces)}
+        self.buckets = {0: set(range(total_pieces))} if total_pieces else {}
+        self.size = total_pieces
 
     def add(self, rarity, value):
-        pos = bisect.bisect_left(self.rarities, rarity)
-        self.rarities.insert(pos, rarity)
-        self.pieces.insert(pos, value)
+        self.buckets.setdefault(rarity, set()).add(value)
+        self.rarities[value] = rarity
         self.size += 1
 
     def get_rarity(self, value):
-        pos = bisect.bisect_left(self.pieces, value)
-        return self.rarities[pos]
+        return self.rarities[value]
 
     def remove(self, value):
-        pos = bisect.bisect_left(self.pieces, value)
-        self.pieces.pop(pos)
-        self.rarities.pop(pos)
+        rarity = self.rarities.pop(value)
+        bucket = self.buckets[rarity]
+        bucket.remove(value)
+        if not bucket:
+            del self.buckets[rarity]
         self.size -= 1
 
-    # Change first instance of value's priority with specified priority
+    # Change value's rarity
     # Note in this torrent client all values are unique
     def update(self, rarity, value):
         self.remove(value)
@@ -220,28 +278,29 @@ class PieceTracker:
     # Given a list of values, reorders the values in terms of rarity
     # Most rare-> least rare
     def raritise(self, values):
-        new_order = []
-        for value in self.pieces:
-            if value in values:
-                new_order.append(value)
-                values.remove(value)
-        return new_order
-
-    # Given a list of values, return value with lowest priority
+        return sorted((value for value in values if value in self.rarities),
+                      key=lambda value: (self.rarities[value], value))
+
+    # Given a list of values, return value with lowest rarity
     def get_rarest(self, values):
-        for value in self.pieces:
-            if value in values:
-                return value
+        if not isinstance(values, (set, frozenset)):
+            values = set(values)
+        for rarity in sorted(self.buckets):
+            # Walk the smaller side & stop at the first piece in both
+            smaller, larger = sorted((self.buckets[rarity], values), key=len)
+            for value in smaller:
+                if value in larger:
+                    return value
 
     def poll(self):
         if self.size:
-            self.size -= 1
-            self.rarities.pop(0)
-            return self.pieces.pop(0)
+            value = self.peek()
+            self.remove(value)
+            return value
 
     def peek(self):
         if self.size:
-            return self.pieces[0]
+            return next(iter(self.buckets[min(self.buckets)]))
 
     def __len__(self):
         return self.size
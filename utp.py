@@ -0,0 +1,538 @@
+# uTP (BEP 29) transport: reliable, ordered streams over a single UDP socket with LEDBAT congestion control, so bulk
+# transfers back off as soon as they start adding queueing delay to the link.
+# Connections are exposed as an (asyncio.StreamReader, UTPStreamWriter) pair, the same interface Peer uses for TCP.
+# The window we advertise shrinks as the reader falls behind, so a slow reader (e.g. one held back by a download
+# limit) slows the sender down instead of buffering without bound.
+import asyncio
+import random
+import socket
+import struct
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+# Packet types
+ST_DATA = 0
+ST_FIN = 1
+ST_STATE = 2
+ST_RESET = 3
+ST_SYN = 4
+
+VERSION = 1
+SELECTIVE_ACK = 1  # Extension type
+
+# type_ver, extension, connection_id, timestamp_microseconds, timestamp_difference_microseconds, wnd_size, seq_nr, ack_nr
+HEADER = struct.Struct(">BBHIIIHH")
+PACKET_SIZE = 1400
+MAX_PAYLOAD = PACKET_SIZE - HEADER.size
+
+RECV_WINDOW = 1024 * 1024  # Receive window, bytes.  Less whatever the reader hasn't consumed yet is advertised.
+WRITE_HIGH_WATER = 256 * 1024  # drain() blocks while more than this is waiting to be sent
+SOCKET_BUFFER = 4 * 1024 * 1024  # UDP send & receive buffers, a full window sent in one go mustn't overflow them
+
+# LEDBAT
+TARGET_DELAY = 100000  # Microseconds of queueing delay we aim to add
+MAX_CWND_INCREASE = 3000  # Bytes per RTT
+MIN_CWND = 2 * PACKET_SIZE
+SLOW_START_EXIT_DELAY = TARGET_DELAY * 3 // 4  # Slow start ends once the queueing delay we add passes this
+BASE_DELAY_HISTORY = 2  # Minutes of delay minimums the base delay is taken from
+
+MIN_RTO = 0.5
+INITIAL_RTO = 1.0
+DUPLICATE_ACKS = 3  # Acks past a missing packet before it is considered lost
+MAX_RETRANSMISSIONS = 8
+CONNECTION_TIMEOUT = 30  # Seconds without hearing from the other side
+KEEPALIVE_INTERVAL = 10  # Idle connections send a state packet this often so the other side doesn't time out
+TICK = 0.1  # Seconds between retransmission timer checks
+
+
+def _timestamp() -> int:
+    return int(time.monotonic() * 1000000) & 0xFFFFFFFF
+
+
+def _seq_lt(a: int, b: int) -> bool:
+    """ a < b with 16 bit wrap around """
+    return a != b and (b - a) & 0xFFFF < 0x8000
+
+
+def _delay_lt(a: int, b: int) -> bool:
+    """ a < b with 32 bit wrap around.  Delays are differences of unsynchronised clocks, any value can wrap """
+    return a != b and (b - a) & 0xFFFFFFFF < 0x80000000
+
+
+class _OutPacket:
+    seq_nr: int = 0
+    packet_type: int = ST_DATA
+    payload: bytes = b''
+    sent_at: float = 0.0
+    transmissions: int = 0
+    sacks_past: int = 0  # Number of later packets acked while this one wasn't
+
+    def __init__(self, seq_nr: int, packet_type: int, payload: bytes):
+        self.seq_nr = seq_nr
+        self.packet_type = packet_type
+        self.payload = payload
+
+
+class _CountingReader(asyncio.StreamReader):
+    """ StreamReader which counts the bytes it holds, StreamReader doesn't expose it """
+    buffered: int = 0
+
+    def feed_data(self, data: bytes):
+        self.buffered += len(data)
+        super().feed_data(data)
+
+    async def read(self, n: int = -1) -> bytes:
+        data = await super().read(n)
+        if n >= 0:  # read(-1) is made of read(limit) calls, which have already counted themselves
+            self.buffered -= len(data)
+        return data
+
+    async def readexactly(self, n: int) -> bytes:
+        data = await super().readexactly(n)
+        self.buffered -= len(data)
+        return data
+
+    async def readuntil(self, separator: bytes = b'\n') -> bytes:
+        data = await super().readuntil(separator)
+        self.buffered -= len(data)
+        return data
+
+
+class UTPConnection:
+    manager: 'UTPSocketManager' = None
+    addr: tuple[str, int] = None
+    recv_id: int = 0
+    send_id: int = 0
+
+    seq_nr: int = 1  # Next sequence number to send
+    ack_nr: int = 0  # Last in-order sequence number received
+
+    reader: asyncio.StreamReader = None
+    send_buffer: bytearray = None
+    out_packets: dict[int, _OutPacket] = {}  # Sent, not yet acked
+    reorder_buffer: dict[int, tuple[int, bytes]] = {}  # Out of order packets: seq_nr -> (type, payload)
+
+    connected: asyncio.Future = None
+    drained: asyncio.Event = None
+    closing: bool = False
+    fin_sent: bool = False
+    reading_paused: bool = False  # The reader's buffer is full, in-order data is neither delivered nor acked
+
+    # Congestion control
+    cwnd: float = MIN_CWND
+    slow_start: bool = True  # cwnd grows by the bytes acked until a loss, or the delay nears the target
+    ssthresh: float = RECV_WINDOW  # Slow start after a timeout stops here
+    bytes_in_flight: int = 0
+    peer_wnd: int = RECV_WINDOW
+    reply_micro: int = 0  # Delay of the peer's packets to us, echoed back to them
+    delay_sample: int = 0  # Delay of our packets to the peer, as measured by them
+    base_delays: deque = None  # Per-minute minimum delay samples
+    rtt: float = 0.0
+    rtt_var: float = 0.0
+    rto: float = INITIAL_RTO
+    last_ack: int = 0
+    duplicate_acks: int = 0
+    last_received: float = 0.0
+    last_sent: float = 0.0
+    retransmissions: int = 0
+
+    def __init__(self, manager: 'UTPSocketManager', addr: tuple[str, int], recv_id: int, send_id: int):
+        self.manager = manager
+        self.addr = addr
+        self.recv_id = recv_id
+        self.send_id = send_id
+
+        # The reader calls pause_reading() past 2 * limit buffered & resume_reading() once it is back under limit
+        self.reader = _CountingReader(limit=RECV_WINDOW // 2)
+        self.reader.set_transport(self)
+        self.send_buffer = bytearray()
+        self.out_packets = {}
+        self.reorder_buffer = {}
+        self.base_delays = deque(maxlen=BASE_DELAY_HISTORY)
+        self.connected = asyncio.get_running_loop().create_future()
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.last_received = time.monotonic()
+
+    # Sending
+
+    def _send_packet(self, packet_type: int, seq_nr: int, payload: bytes = b''):
+        extension = b''
+        if self.reorder_buffer and packet_type == ST_STATE:
+            extension = self._selective_ack()
+
+        # A SYN is addressed with the id we receive on, everything else with the id the peer receives on
+        conn_id = self.recv_id if packet_type == ST_SYN else self.send_id
+        header = HEADER.pack(packet_type << 4 | VERSION, SELECTIVE_ACK if extension else 0, conn_id,
+                             _timestamp(), self.reply_micro, self._recv_window(), seq_nr, self.ack_nr)
+        self.manager.sendto(header + extension + payload, self.addr)
+        self.last_sent = time.monotonic()
+
+    def _recv_window(self) -> int:
+        return max(0, RECV_WINDOW - self.reader.buffered)
+
+    def _selective_ack(self) -> bytes:
+        # Bit i of the mask acks packet ack_nr + 2 + i.  Mask length must be a multiple of 4 bytes.
+        offsets = [(seq - self.ack_nr - 2) & 0xFFFF for seq in self.reorder_buffer]
+        mask = bytearray(min(((max(offsets) // 32) + 1) * 4, 64))
+        for offset in offsets:
+            if offset < len(mask) * 8:
+                mask[offset // 8] |= 1 << (offset % 8)
+        return struct.pack(">BB", 0, len(mask)) + bytes(mask)
+
+    def _transmit(self, packet: _OutPacket):
+        packet.sent_at = time.monotonic()
+        packet.transmissions += 1
+        if packet.transmissions > 1:
+            self.retransmissions += 1
+        self._send_packet(packet.packet_type, packet.seq_nr, packet.payload)
+
+    def _queue_packet(self, packet_type: int, payload: bytes = b''):
+        packet = _OutPacket(self.seq_nr, packet_type, payload)
+        self.seq_nr = (self.seq_nr + 1) & 0xFFFF
+        self.out_packets[packet.seq_nr] = packet
+        self.bytes_in_flight += len(payload)
+        self._transmit(packet)
+
+    def _flush(self):
+        window = min(self.cwnd, self.peer_wnd)
+        while self.send_buffer and self.bytes_in_flight < window:
+            payload = bytes(self.send_buffer[:MAX_PAYLOAD])
+            del self.send_buffer[:MAX_PAYLOAD]
+            self._queue_packet(ST_DATA, payload)
+
+        if len(self.send_buffer) <= WRITE_HIGH_WATER:
+            self.drained.set()
+        if self.closing and not self.send_buffer and not self.fin_sent:
+            self.fin_sent = True
+            self._queue_packet(ST_FIN)
+
+    def write(self, data: bytes):
+        if self.closing:
+            return
+        self.send_buffer += data
+        if len(self.send_buffer) > WRITE_HIGH_WATER:
+            self.drained.clear()
+        self._flush()
+
+    async def drain(self):
+        await self.drained.wait()
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            self._flush()
+
+    def abort(self, exc: Optional[Exception] = None):
+        if exc:
+            self.reader.set_exception(exc)
+        else:
+            self.reader.feed_eof()
+        if not self.connected.done():
+            self.connected.set_exception(exc or ConnectionRefusedError())
+        self.closing = True
+        self.drained.set()
+        self.manager.remove(self)
+
+    # Receiving.  The reader treats the connection as its transport for flow control.
+
+    def pause_reading(self):
+        self.reading_paused = True
+
+    def resume_reading(self):
+        self.reading_paused = False
+        self._deliver_ready()
+        if self.manager.connections.get((self.addr, self.recv_id)) is self:
+            # Window update, the sender may be waiting on a closed window
+            self._send_packet(ST_STATE, self.seq_nr)
+
+    def packet_received(self, packet_type: int, extension: int, timestamp: int, timestamp_diff: int, wnd_size: int,
+                        seq_nr: int, ack_nr: int, data: bytes):
+        self.last_received = time.monotonic()
+        self.reply_micro = (_timestamp() - timestamp) & 0xFFFFFFFF
+        self.delay_sample = timestamp_diff
+
+        if packet_type == ST_RESET:
+            self.abort(ConnectionResetError())
+            return
+
+        selective_ack = b''
+        # Walk the extension chain, only selective acks are understood
+        while extension and len(data) >= 2:
+            next_extension, length = data[0], data[1]
+            if extension == SELECTIVE_ACK:
+                selective_ack = data[2:2 + length]
+            extension, data = next_extension, data[2 + length:]
+
+        if not self.connected.done():
+            if packet_type != ST_STATE:
+                return
+            # SYN-ACK: the state packet doesn't consume a sequence number, their first data packet uses seq_nr
+            self.ack_nr = (seq_nr - 1) & 0xFFFF
+            self.connected.set_result(None)
+
+        self.peer_wnd = wnd_size
+        self._handle_ack(ack_nr, selective_ack)
+
+        if packet_type in (ST_DATA, ST_FIN):
+            if self.reading_paused:
+                pass  # Dropped unacked, the sender overran our window & resends once the reader catches up
+            elif seq_nr == (self.ack_nr + 1) & 0xFFFF:
+                self._deliver(packet_type, data)
+                self._deliver_ready()
+            elif _seq_lt(self.ack_nr, seq_nr):
+                self.reorder_buffer[seq_nr] = (packet_type, data)
+            self._send_packet(ST_STATE, self.seq_nr)
+
+        self._flush()
+        if self.fin_sent and not self.out_packets:
+            # Our FIN was acked
+            self.manager.remove(self)
+
+    def _deliver_ready(self):
+        """ Delivers buffered packets which are now next in order, until the reader is full """
+        while not self.reading_paused and (next_seq := (self.ack_nr + 1) & 0xFFFF) in self.reorder_buffer:
+            self._deliver(*self.reorder_buffer.pop(next_seq))
+
+    def _deliver(self, packet_type: int, data: bytes):
+        self.ack_nr = (self.ack_nr + 1) & 0xFFFF
+        if packet_type == ST_FIN:
+            self.reader.feed_eof()
+        elif data:
+            self.reader.feed_data(data)
+
+    def _handle_ack(self, ack_nr: int, selective_ack: bytes):
+        acked = [seq for seq in self.out_packets if not _seq_lt(ack_nr, seq)]
+        for offset in range(len(selective_ack) * 8):
+            if selective_ack[offset // 8] & (1 << (offset % 8)):
+                seq = (ack_nr + 2 + offset) & 0xFFFF
+                if seq in self.out_packets:
+                    acked.append(seq)
+
+        if not acked:
+            # Repeated acks from a receiver whose window is closed mean it is full, not that a packet was lost
+            if ack_nr == self.last_ack and self.out_packets and self.peer_wnd >= MAX_PAYLOAD:
+                self.duplicate_acks += 1
+                if self.duplicate_acks == DUPLICATE_ACKS:
+                    self._lost((ack_nr + 1) & 0xFFFF)
+            return
+        self.last_ack = ack_nr
+        self.duplicate_acks = 0
+
+        bytes_acked = 0
+        now = time.monotonic()
+        for seq in acked:
+            packet = self.out_packets.pop(seq)
+            bytes_acked += len(packet.payload)
+            if packet.transmissions == 1:
+                # Karn's algorithm: only time packets which weren't retransmitted
+                self._update_rtt(now - packet.sent_at)
+        self.bytes_in_flight -= bytes_acked
+
+        # Packets several selective acks behind are considered lost
+        if selective_ack:
+            newest = max(acked, key=lambda seq: (seq - ack_nr) & 0xFFFF)
+            for packet in list(self.out_packets.values()):
+                if _seq_lt(packet.seq_nr, newest):
+                    packet.sacks_past += 1
+                    if packet.sacks_past == DUPLICATE_ACKS:
+                        self._lost(packet.seq_nr)
+
+        if self.delay_sample:
+            self._ledbat(bytes_acked)
+
+    def _update_rtt(self, sample: float):
+        if not self.rtt:
+            self.rtt, self.rtt_var = sample, sample / 2
+        else:
+            self.rtt_var += (abs(self.rtt - sample) - self.rtt_var) / 4
+            self.rtt += (sample - self.rtt) / 8
+        self.rto = max(self.rtt + 4 * self.rtt_var, MIN_RTO)
+
+    def _ledbat(self, bytes_acked: int):
+        # delay_sample is the one way delay the other side measured for our packets, the minimum over the last few
+        # minutes is taken as the delay of an empty queue.  Both clocks are arbitrary 32 bit microsecond counters, so
+        # the comparisons & the difference are done modulo 2^32.
+        minute = int(time.monotonic() // 60)
+        if not self.base_delays or self.base_delays[-1][0] != minute:
+            self.base_delays.append((minute, self.delay_sample))
+        elif _delay_lt(self.delay_sample, self.base_delays[-1][1]):
+            self.base_delays[-1] = (minute, self.delay_sample)
+        base_delay = self.base_delays[0][1]
+        for _, delay in self.base_delays:
+            if _delay_lt(delay, base_delay):
+                base_delay = delay
+        queuing_delay = (self.delay_sample - base_delay) & 0xFFFFFFFF
+        if queuing_delay >= 0x80000000:
+            queuing_delay = 0  # Below the base delay, i.e. a new minimum
+
+        if self.slow_start:
+            if queuing_delay < SLOW_START_EXIT_DELAY and self.cwnd < self.ssthresh:
+                self.cwnd += bytes_acked
+                return
+            self.slow_start = False
+
+        off_target = (TARGET_DELAY - queuing_delay) / TARGET_DELAY
+        window_factor = min(bytes_acked, self.cwnd) / max(self.cwnd, bytes_acked)
+        self.cwnd = max(self.cwnd + MAX_CWND_INCREASE * off_target * window_factor, MIN_CWND)
+
+    def _lost(self, seq_nr: int):
+        packet = self.out_packets.get(seq_nr)
+        if packet:
+            self.cwnd = self.ssthresh = max(self.cwnd / 2, MIN_CWND)
+            self.slow_start = False
+            self._transmit(packet)
+
+    def tick(self, now: float):
+        """ Runs the retransmission timer """
+        if now - self.last_received > CONNECTION_TIMEOUT:
+            self.abort(ConnectionAbortedError('uTP connection timed out'))
+            return
+        if not self.out_packets:
+            if now - self.last_sent > KEEPALIVE_INTERVAL and self.connected.done():
+                self._send_packet(ST_STATE, self.seq_nr)
+            return
+
+        oldest = min(self.out_packets.values(), key=lambda p: p.sent_at)
+        if now - oldest.sent_at > self.rto:
+            # A closed window means the reader is slow, not the link.  Keep probing, CONNECTION_TIMEOUT still applies.
+            window_closed = self.peer_wnd < MAX_PAYLOAD
+            if oldest.transmissions > MAX_RETRANSMISSIONS and not window_closed:
+                self.abort(ConnectionAbortedError('uTP connection timed out'))
+                return
+            if not window_closed:
+                # Timeout: collapse the window, then slow start back up to half of what it was
+                self.ssthresh = max(self.cwnd / 2, MIN_CWND)
+                self.cwnd = MIN_CWND
+                self.slow_start = True
+            self.rto = min(self.rto * 2, CONNECTION_TIMEOUT)
+            self._transmit(oldest)
+
+
+class UTPStreamWriter:
+    """ Subset of asyncio.StreamWriter used by Peer """
+
+    def __init__(self, conn: UTPConnection):
+        self.conn = conn
+
+    def write(self, data: bytes):
+        self.conn.write(data)
+
+    async def drain(self):
+        await self.conn.drain()
+
+    def close(self):
+        self.conn.close()
+
+    def is_closing(self):
+        return self.conn.closing
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self.conn.addr
+        return default
+
+
+class UTPSocketManager(asyncio.DatagramProtocol):
+    """ Multiplexes every uTP connection over one UDP socket """
+    transport: asyncio.DatagramTransport = None
+    connections: dict[tuple[tuple[str, int], int], UTPConnection] = {}  # Maps (addr, recv_id) -> connection
+    tick_task: asyncio.Task = None
+
+    def __init__(self, on_connection: Callable[[asyncio.StreamReader, UTPStreamWriter], Awaitable] = None):
+        # Called with every accepted connection, same signature as an asyncio.start_server callback
+        self.on_connection = on_connection
+        self.connections = {}
+
+    async def start(self, port: int, host: str = '0.0.0.0'):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port))
+        sock = self.transport.get_extra_info('socket')
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+            except OSError:
+                pass  # Keep the system default
+        self.tick_task = asyncio.ensure_future(self._run_timers())
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def sendto(self, data: bytes, addr: tuple[str, int]):
+        if self.transport:
+            self.transport.sendto(data, addr)
+
+    def remove(self, conn: UTPConnection):
+        self.connections.pop((conn.addr, conn.recv_id), None)
+
+    async def connect(self, host: str, port: int) -> tuple[asyncio.StreamReader, UTPStreamWriter]:
+        addr = (host, port)
+        recv_id = random.randint(0, 0xFFFE)
+        while (addr, recv_id) in self.connections:
+            recv_id = random.randint(0, 0xFFFE)
+
+        conn = UTPConnection(self, addr, recv_id, recv_id + 1)
+        self.connections[(addr, recv_id)] = conn
+        conn._queue_packet(ST_SYN)
+        try:
+            await conn.connected
+        except BaseException:
+            self.remove(conn)
+            raise
+        return conn.reader, UTPStreamWriter(conn)
+
+    def datagram_received(self, data, addr):
+        if len(data) < HEADER.size:
+            return
+        type_ver, extension, conn_id, timestamp, timestamp_diff, wnd_size, seq_nr, ack_nr = HEADER.unpack_from(data)
+        packet_type, version = type_ver >> 4, type_ver & 0xF
+        if version != VERSION or packet_type > ST_SYN:
+            return
+
+        conn = self.connections.get((addr, conn_id))
+        if conn:
+            conn.packet_received(packet_type, extension, timestamp, timestamp_diff, wnd_size, seq_nr, ack_nr,
+                                 data[HEADER.size:])
+        elif packet_type == ST_SYN and (addr, (conn_id + 1) & 0xFFFF) in self.connections:
+            # Retransmitted SYN, our state packet was lost
+            conn = self.connections[(addr, (conn_id + 1) & 0xFFFF)]
+            conn._send_packet(ST_STATE, conn.seq_nr)
+        elif packet_type == ST_SYN and self.on_connection:
+            self._accept(addr, conn_id, timestamp, seq_nr)
+        elif packet_type != ST_RESET:
+            header = HEADER.pack(ST_RESET << 4 | VERSION, 0, conn_id, _timestamp(), 0, 0, 0, seq_nr)
+            self.sendto(header, addr)
+
+    def _accept(self, addr: tuple[str, int], conn_id: int, timestamp: int, seq_nr: int):
+        recv_id = (conn_id + 1) & 0xFFFF
+        conn = UTPConnection(self, addr, recv_id, conn_id)
+        conn.seq_nr = random.randint(0, 0xFFFF)
+        conn.ack_nr = seq_nr
+        conn.reply_micro = (_timestamp() - timestamp) & 0xFFFFFFFF
+        conn.connected.set_result(None)
+        self.connections[(addr, recv_id)] = conn
+
+        conn._send_packet(ST_STATE, conn.seq_nr)
+        asyncio.ensure_future(self.on_connection(conn.reader, UTPStreamWriter(conn)))
+
+    def error_received(self, exc):
+        pass  # ICMP errors, connections time out on their own
+
+    async def _run_timers(self):
+        while True:
+            await asyncio.sleep(TICK)
+            now = time.monotonic()
+            for conn in list(self.connections.values()):
+                conn.tick(now)
+
+    def close(self):
+        if self.tick_task:
+            self.tick_task.cancel()
+        for conn in list(self.connections.values()):
+            conn.abort()
+        if self.transport:
+            self.transport.close()
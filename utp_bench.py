@@ -0,0 +1,216 @@
+# uTP over a lossy loopback link.  Two UTPSocketManagers on 127.0.0.1, each dropping & delaying (with jitter, so
+# packets also arrive out of order) the datagrams it sends.  Random data is written through one connection & the
+# receiver checks it arrives complete & in order.  A slow reader scenario checks flow control: the sender has to be
+# held back by the advertised window, so the receive buffer stays around RECV_WINDOW however far behind the reader is.
+# A dead peer scenario cuts the link mid transfer: the sender has to time the connection out, its reader has to end
+# with the error rather than spin on it & the event loop has to stay responsive throughout.
+#
+#   python utp_bench.py --size 8MiB --loss 0.05 --delay 0.03
+#
+# Prints one JSON object per scenario.
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+
+import bootstrap
+import utp
+from swarm_bench import parse_size
+
+WRITE_SIZE = 2 ** 16
+READ_SIZE = 2 ** 14
+LAG_INTERVAL = 0.01  # Seconds between event loop lag samples
+MAX_LAG = 0.5  # Longest stall the dead peer scenario tolerates
+
+
+class _LossyManager(utp.UTPSocketManager):
+    """ Drops a fraction of outgoing datagrams & delays the rest by delay plus up to jitter seconds """
+    def __init__(self, on_connection=None, loss: float = 0.0, delay: float = 0.0, jitter: float = 0.0,
+                 seed: int = 0):
+        super().__init__(on_connection)
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.dropped = 0
+
+    def sendto(self, data: bytes, addr: tuple[str, int]):
+        if self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        if not self.delay and not self.jitter:
+            super().sendto(data, addr)
+            return
+        asyncio.get_running_loop().call_later(self.delay + self.rng.uniform(0, self.jitter), super().sendto, data, addr)
+
+    def port(self) -> int:
+        return self.transport.get_extra_info('sockname')[1]
+
+
+async def _receive(reader: asyncio.StreamReader, read_rate: float) -> tuple[bytes, int]:
+    """ Reads to EOF, at most read_rate bytes/sec if set.  Returns the sha1 & the most bytes the reader held """
+    digest = hashlib.sha1()
+    max_buffered = 0
+    while True:
+        max_buffered = max(max_buffered, reader.buffered)
+        data = await reader.read(READ_SIZE)
+        if not data:
+            return digest.digest(), max_buffered
+        digest.update(data)
+        if read_rate:
+            await asyncio.sleep(len(data) / read_rate)
+
+
+async def _read_like_peer(reader: asyncio.StreamReader, timeout: float) -> BaseException:
+    """ Reads until the connection fails, handling errors the way Peer.run does.  Returns the error """
+    while True:
+        try:
+            if not await asyncio.wait_for(reader.read(READ_SIZE), timeout):
+                return EOFError()
+        except asyncio.TimeoutError:
+            if (error := reader.exception()) is not None:
+                return error
+        except Exception as e:
+            return e
+
+
+async def _max_lag(stop: asyncio.Event) -> float:
+    loop = asyncio.get_running_loop()
+    worst = 0.0
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        worst = max(worst, loop.time() - start - LAG_INTERVAL)
+    return worst
+
+
+async def dead_peer(size: int, dead_timeout: float, seed: int, timeout: float) -> dict:
+    """ The receiver stops answering mid transfer, the sender's connection has to time out cleanly """
+    utp.CONNECTION_TIMEOUT = dead_timeout
+    data = random.Random(seed).randbytes(size)
+    async def discard(reader, writer):
+        while await reader.read(READ_SIZE):
+            pass
+
+    server = _LossyManager(discard, seed=seed + 1)
+    client = _LossyManager(None, seed=seed + 2)
+    await server.start(0, '127.0.0.1')
+    await client.start(0, '127.0.0.1')
+
+    stop = asyncio.Event()
+    lag = asyncio.ensure_future(_max_lag(stop))
+    reader, writer = await asyncio.wait_for(client.connect('127.0.0.1', server.port()), timeout)
+    conn = writer.conn
+    read = asyncio.ensure_future(_read_like_peer(reader, 1.0))
+    writer.write(data[:size // 2])
+    await asyncio.sleep(0.1)
+    server.loss = 1.0  # Dead from here on: no acks, no keepalives
+    start = time.perf_counter()
+    writer.write(data[size // 2:])
+    try:
+        error = await asyncio.wait_for(read, timeout)
+    except asyncio.TimeoutError:
+        error = None
+    elapsed = time.perf_counter() - start
+    stop.set()
+    max_lag = await lag
+    client.close()
+    server.close()
+
+    return {
+        'scenario': 'dead_peer',
+        'size': size,
+        'connection_timeout': dead_timeout,
+        'reader_error': repr(error),
+        'seconds_to_error': round(elapsed, 2),
+        'retransmissions': conn.retransmissions,
+        'max_loop_lag_ms': round(max_lag * 1000, 1),
+        'responsive': error is not None and max_lag < MAX_LAG,
+    }
+
+
+async def scenario(name: str, size: int, loss: float, delay: float, jitter: float, read_rate: float,
+                   seed: int, timeout: float) -> dict:
+    data = random.Random(seed).randbytes(size)
+    received = asyncio.get_running_loop().create_future()
+
+    async def on_connection(reader, writer):
+        try:
+            received.set_result(await _receive(reader, read_rate))
+        except Exception as e:
+            received.set_exception(e)
+
+    server = _LossyManager(on_connection, loss, delay, jitter, seed + 1)
+    client = _LossyManager(None, loss, delay, jitter, seed + 2)
+    await server.start(0, '127.0.0.1')
+    await client.start(0, '127.0.0.1')
+
+    start = time.perf_counter()
+    error = None
+    digest, max_buffered = None, 0
+    try:
+        reader, writer = await asyncio.wait_for(client.connect('127.0.0.1', server.port()), timeout)
+        conn = writer.conn
+        for i in range(0, size, WRITE_SIZE):
+            writer.write(data[i:i + WRITE_SIZE])
+            await writer.drain()
+        writer.close()
+        digest, max_buffered = await asyncio.wait_for(received, timeout - (time.perf_counter() - start))
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        error = repr(e)
+        conn = None
+    elapsed = time.perf_counter() - start
+    client.close()
+    server.close()
+
+    return {
+        'scenario': name,
+        'size': size,
+        'loss': loss,
+        'delay': delay,
+        'jitter': jitter,
+        'read_rate': read_rate,
+        'intact': digest == hashlib.sha1(data).digest(),
+        'error': error,
+        'seconds': round(elapsed, 2),
+        'throughput_mb_s': round(size / elapsed / 2 ** 20, 2),
+        'dropped_packets': server.dropped + client.dropped,
+        'retransmissions': conn.retransmissions if conn else None,
+        'max_buffered_bytes': max_buffered,  # Compare with utp.RECV_WINDOW
+    }
+
+
+async def bench(args) -> list[dict]:
+    scenarios = [
+        ('clean', args.size, 0.0, 0.0, 0.0, 0),
+        ('lossy', args.size, args.loss, args.delay, args.jitter, 0),
+        ('slow_reader', args.size, 0.0, args.delay, 0.0, args.read_rate),
+    ]
+    results = [await scenario(*params, args.seed, args.timeout) for params in scenarios]
+    results.append(await dead_peer(args.size, args.dead_timeout, args.seed, args.timeout))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='uTP transfer over a lossy loopback link')
+    parser.add_argument('--size', type=parse_size, default=4 * 2 ** 20, help='Bytes sent per scenario, e.g. 8MiB')
+    parser.add_argument('--loss', type=float, default=0.03, help='Fraction of datagrams dropped, each direction')
+    parser.add_argument('--delay', type=float, default=0.02, help='One way delay, seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Extra random delay, reorders packets')
+    parser.add_argument('--read-rate', type=parse_size, default=2 ** 20, help='Slow reader bytes/sec')
+    parser.add_argument('--dead-timeout', type=float, default=3, help='uTP CONNECTION_TIMEOUT for the dead peer')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--loop', default=bootstrap.LOOP_AUTO)
+    args = parser.parse_args()
+    args.loop = bootstrap.resolve_loop(args.loop)
+
+    for result in bootstrap.run(bench(args), args.loop):
+        print(json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    main()